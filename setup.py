@@ -18,6 +18,7 @@ setup(name='t2kdm',
     author_email='lukas.koch@mailbox.org',
     license='MIT',
     packages=['t2kdm'],
+    py_modules=['t2kdm_client'],
     install_requires=[
         'sh>=1.12.14',
         'six>=1.10.0',
@@ -49,19 +50,23 @@ setup(name='t2kdm',
     ],
     entry_points = {
         'console_scripts': [
-            't2kdm-ls=t2kdm.commands:ls.run_from_console',
-            't2kdm-replicas=t2kdm.commands:replicas.run_from_console',
+            't2kdm-ls=t2kdm_client:ls',
+            't2kdm-replicas=t2kdm_client:replicas',
             't2kdm-replicate=t2kdm.commands:replicate.run_from_console',
             't2kdm-remove=t2kdm.commands:remove.run_from_console',
-            't2kdm-SEs=t2kdm.commands:SEs.run_from_console',
+            't2kdm-SEs=t2kdm_client:SEs',
             't2kdm-get=t2kdm.commands:get.run_from_console',
             't2kdm-put=t2kdm.commands:put.run_from_console',
             't2kdm-check=t2kdm.commands:check.run_from_console',
+            't2kdm-verify=t2kdm.commands:verify.run_from_console',
+            't2kdm-execute=t2kdm.commands:execute.run_from_console',
             't2kdm-fix=t2kdm.commands:fix.run_from_console',
+            't2kdm-cache=t2kdm.commands:cache.run_from_console',
             't2kdm-cli=t2kdm.cli:run_cli',
             't2kdm-tests=t2kdm.tests:run_tests',
             't2kdm-config=t2kdm.configuration:run_configuration_wizard',
             't2kdm-maid=t2kdm.maid:run_maid',
+            't2kdm-daemon=t2kdm.daemon:run_daemon',
         ],
     },
     zip_safe=True)
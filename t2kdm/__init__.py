@@ -3,10 +3,10 @@
 Helpful tools to manage the T2K data on the grid.
 """
 
-import configuration
-import backends
-import storage
-import utils
+from t2kdm import configuration
+from t2kdm import backends
+from t2kdm import storage
+from t2kdm import utils
 import sys
 
 if sys.argv[0].endswith('t2kdm-config'):
@@ -21,6 +21,7 @@ else:
 
     # Get functions from backend
     ls = backend.ls
+    iter_ls = backend.iter_ls
     is_dir = backend.is_dir
     replicas = backend.replicas
     exists = backend.exists
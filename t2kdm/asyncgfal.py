@@ -0,0 +1,297 @@
+"""Asynchronous version of the GFAL backend.
+
+The GFAL command line tools are run as non-blocking subprocesses with `asyncio`,
+so many requests can be in flight at the same time from a single thread.
+
+This module requires Python 3.5 or newer.
+"""
+
+import asyncio
+import os
+from asyncio.subprocess import PIPE
+from six import print_
+from t2kdm import storage
+from t2kdm.backends import GFALBackend, BackendException, DoesNotExistException
+
+class AsyncGFALBackend(GFALBackend):
+    """Grid backend running the GFAL command line tools `gfal-*` with asyncio.
+
+    Provides `async_*` coroutine versions of the basic backend functions.
+    The regular functions are inherited from the `GFALBackend`, except for the
+    bulk queries, which run the coroutines concurrently.
+    """
+
+    # Maximum number of concurrent subprocesses in bulk queries
+    concurrency = 100
+
+    async def _run(self, *args):
+        """Run a command and return its exit code, stdout and stderr."""
+        process = await asyncio.create_subprocess_exec(*[str(a) for a in args], stdout=PIPE, stderr=PIPE)
+        out, err = await process.communicate()
+        return process.returncode, out.decode('utf-8', 'replace'), err.decode('utf-8', 'replace')
+
+    @staticmethod
+    def _raise_error(err):
+        """Translate the stderr of a failed command into a BackendException."""
+        if 'No such file' in err:
+            raise DoesNotExistException("No such file or directory.")
+        else:
+            raise BackendException(err)
+
+    async def gather(self, coroutines, limit=None):
+        """Run the coroutines concurrently and return a list of their results.
+
+        At most `limit` coroutines are run at the same time.
+        If `limit` is `None`, the `concurrency` of the backend is used.
+        Exceptions are returned like results, so one failure does not stop the others.
+        """
+
+        if limit is None:
+            limit = self.concurrency
+        semaphore = asyncio.BoundedSemaphore(limit)
+
+        async def bounded(coroutine):
+            async with semaphore:
+                return await coroutine
+
+        return await asyncio.gather(*[bounded(c) for c in coroutines], return_exceptions=True)
+
+    def _run_many(self, function, items, **kwargs):
+        """Run the coroutine `function` for all items and return a dictionary of results.
+
+        Items for which the function raises a `BackendException` are left out.
+        """
+
+        items = list(items)
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(self.gather(function(item, **kwargs) for item in items))
+        finally:
+            loop.close()
+
+        ret = {}
+        for item, result in zip(items, results):
+            if isinstance(result, BackendException):
+                continue
+            elif isinstance(result, Exception):
+                raise result
+            ret[item] = result
+        return ret
+
+    async def _async_ls(self, lurl, directory=False):
+        args = ['gfal-ls', '--color=never']
+        if directory:
+            args.append('-d')
+        args.append('-l')
+        args.append(lurl)
+        code, out, err = await self._run(*args)
+        if code != 0:
+            self._raise_error(err)
+        ret = []
+        for line in out.splitlines():
+            if len(line.strip()) > 0:
+                ret.append(self._parse_ls_line(line))
+        return ret
+
+    async def async_ls(self, remotepath, directory=False):
+        """List contents of a remote logical path.
+
+        See `ls`.
+        """
+        return await self._async_ls(self.get_lurl(remotepath), directory=directory)
+
+    async def _async_replicas(self, lurl):
+        code, out, err = await self._run('gfal-xattr', lurl, 'user.replicas')
+        if code != 0:
+            self._raise_error(err)
+        ret = []
+        for line in out.splitlines():
+            line = line.strip()
+            if len(line) > 0:
+                ret.append(line)
+        return ret
+
+    async def async_replicas(self, remotepath):
+        """Return a list of replica surls of a remote logical path."""
+        return await self._async_replicas(self.get_lurl(remotepath))
+
+    async def async_exists(self, surl):
+        """Check whether a surl actually exists."""
+        code, out, err = await self._run('gfal-xattr', surl, 'user.status')
+        if code != 0:
+            if 'No such file' in err:
+                return False
+            else:
+                raise BackendException(err)
+        return True
+
+    async def async_state(self, surl):
+        """Return the state of a replica, e.g. 'ONLINE'."""
+        code, out, err = await self._run('gfal-xattr', surl, 'user.status')
+        if code != 0:
+            return '?'
+        return out.strip()
+
+    async def async_checksum(self, surl):
+        """Return the checksum of a replica."""
+        code, out, err = await self._run('gfal-sum', surl, 'ADLER32')
+        if code != 0:
+            return '?'
+        try:
+            return out.split()[1]
+        except IndexError:
+            return '?'
+
+    async def async_bringonline(self, surl, timeout=60*60*6, verbose=False):
+        """Try to bring `surl` online within `timeout` seconds.
+
+        Returns `True` when file is online, `False` if not.
+        """
+        # gfal does not notice when files come online, it seems
+        # split task into many requests with short timeouts
+        time_left = timeout
+        while(True):
+            if time_left > 10:
+                timeout = 10
+            else:
+                timeout = time_left
+            time_left -= 10
+            code, out, err = await self._run('gfal-legacy-bringonline', '-t', timeout, surl)
+            if verbose:
+                print_(out, end='')
+            if code == 0:
+                return True
+            elif time_left <= 0:
+                return False
+
+    async def _async_replicate(self, source_surl, destination_surl, lurl, verbose=False):
+        code, out, err = await self._run('gfal-copy', '-p', '-T', '1800', '--checksum', 'ADLER32', source_surl, destination_surl)
+        if verbose:
+            print_(out, end='')
+        if code != 0:
+            if 'File exists' in err:
+                if verbose:
+                    print_("Replica already exists. Checking checksum...")
+                source_checksum, destination_checksum = await asyncio.gather(
+                    self.async_checksum(source_surl), self.async_checksum(destination_surl))
+                if source_checksum == destination_checksum:
+                    if verbose:
+                        print_("Checksums match. Registering replica.")
+                else:
+                    raise BackendException("File with different checksum already present.")
+            else:
+                self._raise_error(err)
+        code, out, err = await self._run('gfal-legacy-register', lurl, destination_surl)
+        if verbose:
+            print_(out, end='')
+        if code != 0:
+            self._raise_error(err)
+        return True
+
+    async def async_replicate(self, remotepath, destination, source=None, tape=False, verbose=False, bringonline_timeout=60*60*6):
+        """Replicate the file to the specified storage element.
+
+        See `replicate`. The number of concurrent transfers per SE is *not*
+        limited, use `gather` with a suitable `limit` instead.
+        """
+
+        lurl = self.get_lurl(remotepath)
+
+        # Get destination SE and check if file is already present
+        dst = storage.get_SE(destination)
+        if dst is None:
+            raise BackendException("Could not find storage element %s."%(destination,))
+
+        replicas = await self._async_replicas(lurl)
+        if any(dst.host in rep for rep in replicas):
+            # Replica already at destination, nothing to do here
+            if verbose:
+                print_("Replica of %s already present at destination storage element %s."%(remotepath, dst.name,))
+            return True
+
+        destination_path = dst.get_storage_path(remotepath)
+        failure = None
+        for source_path, src in self.iter_file_sources(remotepath, source, destination, tape, replicas=replicas):
+            if verbose:
+                print_("Copying %s to %s"%(source_path, destination_path))
+
+            try:
+                if src.type == 'tape':
+                    if verbose:
+                        print_("Bringing online %s"%(source_path,))
+                    ret = await self.async_bringonline(source_path, timeout=bringonline_timeout, verbose=verbose)
+                else:
+                    ret = True
+                if ret:
+                    ret = await self._async_replicate(source_path, destination_path, lurl, verbose=verbose)
+            except BackendException as e:
+                failure = e
+                ret = False
+            if ret:
+                self._forget(remotepath, destination_path)
+                return True
+
+        if failure is not None:
+            raise failure
+        else:
+            return False
+
+    async def _async_get(self, surl, localpath, verbose=False):
+        code, out, err = await self._run('gfal-copy', '-f', '--checksum', 'ADLER32', surl, localpath)
+        if verbose:
+            print_(out, end='')
+        if code != 0:
+            self._raise_error(err)
+        return os.path.isfile(localpath)
+
+    async def async_get(self, remotepath, localpath, source=None, tape=False, force=False, verbose=False, bringonline_timeout=60*60*6):
+        """Download a file from the grid.
+
+        See `get`.
+        """
+
+        # Append the basename to the localpath if it is a directory
+        if os.path.isdir(localpath):
+            localpath = os.path.join(localpath, os.path.basename(remotepath))
+
+        # Do not overwrite files unless explicitly told to
+        if os.path.isfile(localpath) and not force:
+            raise BackendException("File does already exist: %s."%(localpath,))
+
+        replicas = await self.async_replicas(remotepath)
+        failure = None
+        for replica, src in self.iter_file_sources(remotepath, source, tape=tape, replicas=replicas):
+            if verbose:
+                print_("Copying %s to %s"%(replica, localpath))
+
+            try:
+                if src.type == 'tape':
+                    if verbose:
+                        print_("Bringing online %s"%(replica,))
+                    ret = await self.async_bringonline(replica, timeout=bringonline_timeout, verbose=verbose)
+                else:
+                    ret = True
+                if ret:
+                    ret = await self._async_get(replica, localpath, verbose=verbose)
+            except BackendException as e:
+                failure = e
+                ret = False
+            if ret:
+                return True
+
+        if failure is not None:
+            raise failure
+        else:
+            return False
+
+    def _replicas_many(self, lurls, **kwargs):
+        return self._run_many(self._async_replicas, lurls)
+
+    def _exists_many(self, surls, **kwargs):
+        return self._run_many(self.async_exists, surls)
+
+    def _state_many(self, surls, **kwargs):
+        return self._run_many(self.async_state, surls)
+
+    def _checksum_many(self, surls, **kwargs):
+        return self._run_many(self.async_checksum, surls)
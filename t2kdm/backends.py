@@ -27,13 +27,52 @@ import sh
 import itertools
 import posixpath
 import os, sys
+import errno
+import stat
+import time
+import re
+import math
+import tempfile
+import subprocess
+import threading
+import json
+import random
+import shutil
+from array import array
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from t2kdm import storage
-from t2kdm.cache import Cache
+from t2kdm import checksums
+from t2kdm.cache import Cache, PersistentCache
+from t2kdm.stats import Stats
+from t2kdm.performance import StreamController
+from t2kdm.configuration import app_dirs
 from six import print_
+from six.moves import queue as Queue
 
 # Add the option to cache the output of functions for 60 seconds.
 # This is enabled by providing the `cached=True` argument.
-cache = Cache(60)
+# The least recently used entries of each function are dropped when there
+# are too many of them, so long running processes do not grow without limit.
+cache = Cache(60, max_entries=100000, max_size=64*1024**2)
+
+# Results of catalogue queries can be shared between processes in this file,
+# see the `shared_cache` configuration option.
+shared_cache_file = os.path.join(app_dirs.user_cache_dir, 'cache.sqlite')
+
+# Statistics of the backend operations.
+# Disabled by default, see `GridBackend.stats`.
+statistics = Stats()
+
+# Number of streams of downloads, remembered across calls
+stream_controller = StreamController(os.path.join(app_dirs.user_cache_dir, 'streams.json'))
+
+def _decode(output):
+    """Turn command output into a string."""
+    if isinstance(output, bytes) and not isinstance(output, str):
+        return output.decode('utf-8', 'replace')
+    return output
 
 class BackendException(Exception):
     """Exception that is thrown if something goes (horribly) wrong."""
@@ -43,9 +82,63 @@ class DoesNotExistException(BackendException):
     """Thrown when a file/directory does not exist."""
     pass
 
+class CancelledException(BackendException):
+    """Thrown when an operation was cancelled, e.g. the slower of two hedged downloads."""
+    pass
+
+def _run_cancellable(args, cancel=None, out=None, err_to_out=False):
+    """Run a command line tool that is terminated as soon as the event `cancel` is set.
+
+    The standard output of the tool is written to the file `out`, if given.
+    With `err_to_out`, so is its error output, once the tool has finished.
+    The tool is run without `sh`, so no background threads are involved.
+
+    Raises a `CancelledException` if the tool was terminated,
+    a `DoesNotExistException` if it reported a missing file
+    and a `BackendException` with the error output if it failed otherwise.
+    """
+    args = [str(a) for a in args]
+    with tempfile.TemporaryFile() as output:
+        with tempfile.TemporaryFile() as errors:
+            stdout = output
+            if out is not None:
+                try:
+                    out.flush()
+                    stdout = out.fileno()
+                except (AttributeError, ValueError, IOError, OSError):
+                    # E.g. a StringIO, copy the output when the tool is done
+                    pass
+            process = subprocess.Popen(args, stdout=stdout, stderr=errors)
+            try:
+                if cancel is None:
+                    process.wait()
+                else:
+                    while process.poll() is None:
+                        if cancel.wait(0.5):
+                            raise CancelledException("Cancelled.")
+            finally:
+                if process.poll() is None:
+                    process.terminate()
+                    process.wait()
+            output.seek(0)
+            errors.seek(0)
+            message = _decode(errors.read())
+            if out is not None:
+                if stdout is output:
+                    out.write(_decode(output.read()))
+                if err_to_out:
+                    out.write(message)
+    if process.returncode != 0:
+        if 'No such file' in message:
+            raise DoesNotExistException("No such file or directory.")
+        else:
+            raise BackendException(message)
+
 class DirEntry(object):
     """Class representing a directory entry."""
 
+    __slots__ = ('name', 'mode', 'links', 'uid', 'gid', 'size', 'modified')
+
     def __init__(self, name, mode='?', links=-1, uid=-1, gid=-1, size=-1, modified='?'):
         self.name = name
         self.mode = mode
@@ -55,12 +148,227 @@ class DirEntry(object):
         self.size = size
         self.modified = modified
 
+    def __getstate__(self):
+        return tuple(getattr(self, key) for key in self.__slots__)
+
+    def __setstate__(self, state):
+        for key, value in zip(self.__slots__, state):
+            setattr(self, key, value)
+
+try:
+    array('q')
+except ValueError:
+    # Python 2 does not know long longs
+    _size_type = 'l'
+else:
+    _size_type = 'q'
+
+class Listing(object):
+    """Compact, columnar representation of a directory listing.
+
+    The entries are stored as parallel arrays of names, sizes, modes,
+    modification times, etc. This needs a lot less memory than a list of
+    `DirEntry` objects, and makes aggregate queries cheap.
+
+    Behaves like a (read-only) list of `DirEntry` objects otherwise.
+    """
+
+    def __init__(self, entries=()):
+        self.names = []
+        # There are only a few different modes, so they are stored
+        # as indices into a table of the mode strings and their bits
+        self.modes = array('H')
+        self._modes = []
+        self._mode_bits = []
+        self._mode_index = {}
+        self.links = array('l')
+        self.sizes = array(_size_type)
+        self.mtimes = array('d')
+        # Owners are stored as indices into a table
+        self.uids = array('H')
+        self.gids = array('H')
+        self._owners = []
+        self._owner_index = {}
+        self.extend(entries)
+
+    def _mode(self, mode):
+        if mode not in self._mode_index:
+            self._mode_index[mode] = len(self._modes)
+            self._modes.append(mode)
+            self._mode_bits.append(_mode_bits(mode))
+        return self._mode_index[mode]
+
+    def _owner(self, owner):
+        if owner not in self._owner_index:
+            self._owner_index[owner] = len(self._owners)
+            self._owners.append(owner)
+        return self._owner_index[owner]
+
+    def append(self, entry):
+        """Add a `DirEntry` to the listing."""
+        self.names.append(entry.name)
+        self.modes.append(self._mode(entry.mode))
+        self.links.append(entry.links)
+        self.sizes.append(entry.size)
+        self.mtimes.append(_parse_modified(entry.modified))
+        self.uids.append(self._owner(entry.uid))
+        self.gids.append(self._owner(entry.gid))
+
+    def extend(self, entries):
+        for entry in entries:
+            self.append(entry)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return DirEntry(self.names[i],
+            mode = self._modes[self.modes[i]],
+            links = self.links[i],
+            uid = self._owners[self.uids[i]],
+            gid = self._owners[self.gids[i]],
+            size = self.sizes[i],
+            modified = _format_modified(self.mtimes[i]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def is_dir_mask(self):
+        """Return a list of booleans, telling whether the entries are directories."""
+        is_dir = [stat.S_ISDIR(bits) for bits in self._mode_bits]
+        return [is_dir[mode] for mode in self.modes]
+
+    def size_sum(self, mask=None):
+        """Return the total size of the entries.
+
+        If a `mask` is given, only the entries where it is `True` are summed up.
+        E.g. the total size of all files: `listing.size_sum([not d for d in listing.is_dir_mask()])`
+        """
+        if mask is None:
+            return sum(self.sizes)
+        return sum(size for size, m in zip(self.sizes, mask) if m)
+
+class TransferSlots(object):
+    """Limit the number of concurrent transfers per storage element."""
+
+    def __init__(self, limit=0):
+        """Allow at most `limit` concurrent transfers per SE.
+
+        A `limit` of 0 means there is no limit.
+        """
+        self.limit = limit
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks cannot be pickled,
+        # but the cache needs to do that to hash the function arguments.
+        return {'limit': self.limit}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def get_semaphore(self, SE):
+        """Return the semaphore guarding the given SE."""
+        with self.lock:
+            if SE.name not in self.semaphores:
+                self.semaphores[SE.name] = threading.BoundedSemaphore(self.limit)
+            return self.semaphores[SE.name]
+
+    @contextmanager
+    def __call__(self, *SEs):
+        """Block until a transfer slot is free on all given SEs and occupy it."""
+
+        if self.limit <= 0:
+            yield
+            return
+
+        # Always acquire the semaphores in the same order to avoid deadlocks
+        acquired = []
+        try:
+            for SE in sorted(SEs, key=lambda x: x.name):
+                semaphore = self.get_semaphore(SE)
+                semaphore.acquire()
+                acquired.append(semaphore)
+            yield
+        finally:
+            for semaphore in reversed(acquired):
+                semaphore.release()
+
+class BringOnlineRequest(object):
+    """Request many files to be brought online, one by one in background threads.
+
+    At most `workers` files are requested at the same time. Each request waits
+    at most `timeout` seconds for the file to come online. The SE keeps
+    working on the recall after that, but the thread moves on to the next file.
+    Errors are collected in `errors` instead of being raised in the threads.
+    """
+
+    def __init__(self, bringonline, surls, timeout, workers):
+        """Call `bringonline(surl, timeout, cancel=event)` for every surl."""
+        self.bringonline = bringonline
+        self.timeout = timeout
+        self.queue = Queue.Queue()
+        for surl in surls:
+            self.queue.put(surl)
+        self.cancel = threading.Event()
+        self.errors = {}
+        self.threads = []
+        for i in range(max(1, min(workers, self.queue.qsize()))):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while not self.cancel.is_set():
+            try:
+                surl = self.queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                self.bringonline(surl, self.timeout, cancel=self.cancel)
+            except Exception as e:
+                self.errors[surl] = e
+
+    def stop(self):
+        """Stop requesting and waiting for files and wait for the threads to finish."""
+        self.cancel.set()
+        for thread in self.threads:
+            thread.join()
+
 class GridBackend(object):
     """Class that handles the actual work on the grid.
 
     This is just a base class that other classes must inherit from.
     """
 
+    # Number of concurrent requests when bulk queries are split into single ones
+    fan_out = 10
+
+    # Shortest and longest time between polls when bringing files online in bulk
+    poll_interval = 10
+    max_poll_interval = 300
+
+    # Number of files that are requested to be brought online at the same time
+    # when they have to be requested one by one, and how long each request waits
+    stage_workers = 10
+    stage_submit_timeout = 10
+
+    # Number of retries of failed transfers and the base and maximum delay between them
+    retries = 2
+    retry_delay = 5
+    max_retry_delay = 60
+
+    # Errors of transfers that are worth retrying
+    transient_errors = re.compile(r'time(d)? ?out|connection|busy|temporar|unavailable|try again|SRM_INTERNAL_ERROR', re.IGNORECASE)
+
+    # Fraction of a file that must have arrived before the deadline of a hedged download
+    hedge_fraction = 0.5
+
     def __init__(self, **kwargs):
         """Initialise backend.
 
@@ -69,26 +377,116 @@ class GridBackend(object):
         basedir: String. Default: '/t2k.org'
             Sets the base directory of the backend.
             All paths are specified relative to that position.
+
+        max_se_transfers: Integer. Default: 0
+            Maximum number of concurrent transfers from or to a single storage element.
+            0 means no limit.
+
+        checksum_max_age: Float. Default: 0
+            Number of days the checksums of replicas are remembered in the `checksum_store`.
+            0 means they are not remembered.
         """
 
         # LFC paths alway put a '/grid' as highest level directory.
         # Let us not expose that to the user.
         self.baseurl = 'lfn:/grid' + kwargs.pop('basedir', '/t2k.org')
+        self.transfer_slots = TransferSlots(kwargs.pop('max_se_transfers', 0))
+        self.checksum_store = checksums.ChecksumStore(os.path.join(app_dirs.user_cache_dir, 'checksums.sqlite'),
+            max_age=kwargs.pop('checksum_max_age', 0) * 24*60*60)
         if len(kwargs) > 0:
             raise TypeError("Invalid keyword arguments: %s"%(list(kwargs.keys),))
 
+    def cache_identity(self):
+        """Return what distinguishes the entries of this backend in the persistent cache."""
+        return (type(self).__name__, self.baseurl)
+
     def get_lurl(self, remotepath):
         """Prepend the base dir to a path."""
         return posixpath.normpath(self.baseurl + remotepath)
 
+    def stats(self):
+        """Return the statistics of the backend operations as dictionary.
+
+        The number of calls, errors, handled files, transferred bytes and a
+        histogram of the durations are recorded per operation, in total and
+        per storage element. See `t2kdm.stats.Stats.as_dict`.
+
+        Nothing is recorded unless the statistics are enabled with
+        `t2kdm.backends.statistics.enable()`, or the `--stats` option of the commands.
+        """
+        return statistics.as_dict()
+
+    def _file_size(self, remotepath):
+        """Return the size of a remote file, or 0 if it cannot be determined."""
+        try:
+            return self.ls(remotepath, directory=True, cached=True)[0].size
+        except BackendException:
+            return 0
+
+    def _fan_out(self, function, items, **kwargs):
+        """Call `function` for all `items` concurrently.
+
+        Returns a dictionary of the return values keyed by the items.
+        Items for which the function raises a `BackendException` are left out.
+        """
+
+        def call(item):
+            try:
+                return item, function(item, **kwargs), True
+            except BackendException:
+                return item, None, False
+
+        ret = {}
+        if len(items) == 0:
+            return ret
+        pool = ThreadPool(min(self.fan_out, len(items)))
+        try:
+            results = pool.map(call, items)
+        finally:
+            pool.close()
+            pool.join()
+        for item, value, success in results:
+            if success:
+                ret[item] = value
+        return ret
+
+    def _query_many(self, operation, single, function, items, cached=False, **kwargs):
+        """Call the bulk query `function` and store the results in the cache of `single`.
+
+        `function` must take a list of items and return a dictionary of the results.
+        The results are stored in the cache as if the cached `single` method of the
+        backend had been called with the item as only argument.
+        If `cached` is `True`, items that are already in the cache are not queried again.
+        The query is recorded in the statistics as `operation`.
+        """
+        items = list(items)
+        ret = {}
+        if cached:
+            missing = []
+            for item in items:
+                entry = single.get_entry(self, item)
+                if entry is None:
+                    missing.append(item)
+                else:
+                    ret[item] = entry.value
+        else:
+            missing = items
+        with statistics.measure(operation) as measurement:
+            measurement.items = len(missing)
+            results = function(missing, **kwargs)
+        for item, value in results.items():
+            single.add_entry(value, self, item)
+        ret.update(results)
+        return ret
+
     def _ls(self, lurl, **kwargs):
         raise NotImplementedError()
 
-    @cache.cached
+    @cache.cached(max_entries=10000, persistent_time=600)
     def ls(self, remotepath, **kwargs):
         """List contents of a remote logical path.
 
-        Returns a list of directory entries.
+        Returns a `Listing` of directory entries.
 
         Supported keyword arguments:
 
@@ -97,16 +495,59 @@ class GridBackend(object):
         """
 
         lurl = self.get_lurl(remotepath)
-        return self._ls(lurl, **kwargs)
+        with statistics.measure('ls'):
+            return Listing(self._iter_ls(lurl, **kwargs))
+
+    def _iter_ls(self, lurl, **kwargs):
+        """Iterate over the directory entries of a lurl.
+
+        Backends that can read the listing incrementally should override this.
+        """
+        return iter(self._ls(lurl, **kwargs))
+
+    def iter_ls(self, remotepath, **kwargs):
+        """Iterate over the contents of a remote logical path.
+
+        Like `ls`, but the directory entries are yielded as soon as they are
+        available, without waiting for the full listing or keeping it in memory.
+        """
+
+        lurl = self.get_lurl(remotepath)
+        entries = self._iter_ls(lurl, **kwargs)
+        if statistics.enabled:
+            entries = self._measure_listing(entries)
+        return entries
+
+    @staticmethod
+    def _measure_listing(entries):
+        """Yield the entries and record the time spent waiting for them as a single 'ls'."""
+        duration = 0.
+        error = False
+        try:
+            while True:
+                start = time.time()
+                try:
+                    entry = next(entries)
+                except StopIteration:
+                    return
+                except Exception:
+                    error = True
+                    raise
+                finally:
+                    duration += time.time() - start
+                yield entry
+        finally:
+            statistics.record('ls', duration, error=error)
 
     def _is_dir(self, lurl):
         entry = self._ls(lurl, directory=True)[0]
         return entry.mode[0] == 'd'
 
-    @cache.cached
+    @cache.cached(persistent_time=3600)
     def is_dir(self, remotepath):
         """Is the remote path a directory?"""
-        return self._is_dir(self.get_lurl(remotepath))
+        with statistics.measure('is_dir'):
+            return self._is_dir(self.get_lurl(remotepath))
 
     def _exists(self, surl, **kwargs):
         raise NotImplementedError()
@@ -114,15 +555,37 @@ class GridBackend(object):
     @cache.cached
     def exists(self, surl, **kwargs):
         """Chcek whether a surl actually exists."""
-        return self._exists(surl, **kwargs)
+        with statistics.measure('exists', surl):
+            return self._exists(surl, **kwargs)
+
+    def _exists_many(self, surls, **kwargs):
+        return self._fan_out(self._exists, surls, **kwargs)
+
+    def exists_many(self, surls, cached=False, **kwargs):
+        """Check whether many surls actually exist.
+
+        Returns a dictionary keyed by the surls.
+        See `replicas_many` for details.
+        """
+        return self._query_many('exists_many', self.exists, self._exists_many, surls, cached=cached, **kwargs)
 
     def _unregister(self, surl, lurl, verbose=False, **kwargs):
         raise NotImplementedError()
 
+    def _forget(self, remotepath, surl=None):
+        """Remove cached information that is no longer valid after changing replicas."""
+        self.replicas.remove_entry(self, remotepath)
+        if surl is not None:
+            self.exists.remove_entry(self, surl)
+            self.checksum.remove_entry(self, surl)
+            self.checksum_store.remove(surl)
+
     def unregister(self, surl, remotepath, verbose=False, **kwargs):
         """Unregister a given surl from the file catalogue."""
         lurl = self.get_lurl(remotepath)
-        return self._unregister(surl, lurl, verbose=verbose, **kwargs)
+        self._forget(remotepath, surl)
+        with statistics.measure('unregister', surl):
+            return self._unregister(surl, lurl, verbose=verbose, **kwargs)
 
     def _state(self, surl, **kwargs):
         raise NotImplementedError()
@@ -130,25 +593,99 @@ class GridBackend(object):
     @cache.cached
     def state(self, surl, **kwargs):
         """Return the state of a replica, e.g. 'ONLINE'."""
-        return self._state(surl, **kwargs)
+        with statistics.measure('state', surl):
+            return self._state(surl, **kwargs)
+
+    def _state_many(self, surls, **kwargs):
+        return self._fan_out(self._state, surls, **kwargs)
+
+    def state_many(self, surls, cached=False, **kwargs):
+        """Return the states of many replicas.
+
+        Returns a dictionary keyed by the surls.
+        See `replicas_many` for details.
+        """
+        return self._query_many('state_many', self.state, self._state_many, surls, cached=cached, **kwargs)
 
     def _checksum(self, surl, **kwargs):
         raise NotImplementedError()
 
     @cache.cached
     def checksum(self, surl, **kwargs):
-        """Return the checksum of a replica."""
-        return self._checksum(surl)
+        """Return the checksum of a replica.
+
+        Checksums are remembered in the `checksum_store`, so they need not be
+        queried from the SE every time.
+        """
+        checksum = self.checksum_store.get(surl)
+        if checksum is None:
+            with statistics.measure('checksum', surl):
+                checksum = self._checksum(surl)
+            self.checksum_store.set(surl, checksum)
+        return checksum
+
+    def _checksum_many(self, surls, **kwargs):
+        return self._fan_out(self._checksum, surls, **kwargs)
+
+    def checksum_many(self, surls, cached=False, **kwargs):
+        """Return the checksums of many replicas.
+
+        Returns a dictionary keyed by the surls.
+        Only checksums that are not in the `checksum_store` are queried.
+        See `replicas_many` for details.
+        """
+        ret = {}
+        missing = []
+        for surl in surls:
+            checksum = self.checksum_store.get(surl)
+            if checksum is None:
+                missing.append(surl)
+            else:
+                ret[surl] = checksum
+                self.checksum.add_entry(checksum, self, surl)
+        results = self._query_many('checksum_many', self.checksum, self._checksum_many, missing, cached=cached, **kwargs)
+        for surl, checksum in results.items():
+            self.checksum_store.set(surl, checksum)
+        ret.update(results)
+        return ret
 
     def _replicas(self, lurl, **kwargs):
         raise NotImplementedError()
 
-    @cache.cached
+    @cache.cached(persistent_time=600)
     def replicas(self, remotepath, **kwargs):
         """Return a list of replica surls of a remote logical path."""
 
         lurl = self.get_lurl(remotepath)
-        return self._replicas(lurl, **kwargs)
+        with statistics.measure('replicas'):
+            return self._replicas(lurl, **kwargs)
+
+    def _replicas_many(self, lurls, **kwargs):
+        """Return a dictionary of replica lists keyed by the lurls.
+
+        Backends that can query many files at once should override this.
+        By default, the single queries are sent concurrently.
+        """
+        return self._fan_out(self._replicas, lurls, **kwargs)
+
+    def replicas_many(self, remotepaths, cached=False, **kwargs):
+        """Return the replicas of many remote logical paths.
+
+        Returns a dictionary of replica lists keyed by the remote paths.
+        Paths whose replicas could not be determined, e.g. because they do not
+        exist, are missing from the dictionary.
+
+        The results are stored in the cache, so subsequent calls of `replicas`
+        with `cached=True` do not need to contact the grid again.
+        If `cached` is `True`, paths that are already in the cache are not queried again.
+        """
+
+        def _replicas_many(paths, **kwargs):
+            by_lurl = dict((self.get_lurl(path), path) for path in paths)
+            results = self._replicas_many(list(by_lurl), **kwargs)
+            return dict((by_lurl[lurl], reps) for lurl, reps in results.items())
+
+        return self._query_many('replicas_many', self.replicas, _replicas_many, remotepaths, cached=cached, **kwargs)
 
     def _bringonline(self, surl, timeout, verbose=False, **kwargs):
         raise NotImplementedError()
@@ -158,66 +695,302 @@ class GridBackend(object):
 
         Returns `True` when file is online, `False` if not.
         """
-        return self._bringonline(surl, timeout, verbose=verbose, **kwargs)
+        with statistics.measure('bringonline', surl):
+            return self._bringonline(surl, timeout, verbose=verbose, **kwargs)
+
+    def _bringonline_submit(self, surls, timeout, verbose=False):
+        """Request the surls to be brought online, without waiting for it.
+
+        Returns a handle that is passed to `_bringonline_release` once the
+        files are no longer needed, or the request timed out.
+
+        By default, the blocking `_bringonline` of the files is run in a few
+        background threads, waiting at most `stage_submit_timeout` seconds for
+        each file. Backends that can submit many files in one request should
+        override this.
+        """
+        return BringOnlineRequest(self._bringonline, surls, min(timeout, self.stage_submit_timeout), self.stage_workers)
+
+    def _bringonline_release(self, handle):
+        """Clean up after a request of `_bringonline_submit`."""
+        if isinstance(handle, BringOnlineRequest):
+            handle.stop()
+
+    def bringonline_many(self, surls, timeout=60*60*6, verbose=False):
+        """Try to bring many surls online within `timeout` seconds.
+
+        A single request for all files is submitted and the states of the files
+        are polled together, with an increasing interval between the polls.
+        This lets the tape system optimise the order of the recalls.
+
+        This is a generator that yields lists of surls as soon as they are online,
+        so they can be used while the others are still being staged.
+        Surls that are not online within the `timeout` are never yielded.
+        """
+
+        pending = list(surls)
+        start = time.time()
+
+        def collect_online():
+            states = self.state_many(pending)
+            online = [surl for surl in pending if 'ONLINE' in states.get(surl, '?')]
+            for surl in online:
+                pending.remove(surl)
+            return online
+
+        # Some files might be online already
+        online = collect_online()
+        if len(online) > 0:
+            yield online
+        if len(pending) == 0:
+            return
+
+        if verbose:
+            print_("Bringing online %d files"%(len(pending),))
+        with statistics.measure('bringonline_submit') as measurement:
+            measurement.items = len(pending)
+            handle = self._bringonline_submit(pending, timeout, verbose=verbose)
+        try:
+            interval = self.poll_interval
+            while len(pending) > 0:
+                time_left = timeout - (time.time() - start)
+                if time_left <= 0:
+                    if verbose:
+                        print_("Timeout while bringing online %d files"%(len(pending),))
+                    return
+                time.sleep(min(interval, time_left))
+                online = collect_online()
+                if len(online) > 0:
+                    if verbose:
+                        print_("%d files are online, %d still pending"%(len(online), len(pending)))
+                    interval = self.poll_interval
+                    yield online
+                else:
+                    interval = min(2*interval, self.max_poll_interval)
+        finally:
+            self._bringonline_release(handle)
+
+    def _stage(self, remotepath, source=None, destination=None, tape=False, timeout=60*60*6, verbose=False, replicas=None):
+        """Request the closest source of a file to be brought online if it is on tape.
+
+        The `replicas` of the file are queried unless they are provided.
+        Returns the handle of the request or `None`.
+        """
+        try:
+            if replicas is None:
+                replicas = self.replicas(remotepath, cached=True)
+            replica, src = self.get_file_source(remotepath, source, destination, tape, replicas=replicas)
+        except BackendException:
+            # Let the actual transfer deal with the problem
+            return None
+        if src.type != 'tape':
+            return None
+        if verbose:
+            print_("Bringing online %s ahead of time"%(replica,))
+        return self._bringonline_submit([replica], timeout, verbose=verbose)
+
+    def stage_ahead(self, remotepaths, window, source=None, destination=None, tape=False, timeout=60*60*6, verbose=False):
+        """Iterate over remote paths, while bringing the following files online ahead of time.
+
+        When a path is yielded, the closest tape replicas (as chosen by
+        `iter_file_sources`) of the next `window` paths have already been
+        requested to be brought online. So the recall from tape can happen while
+        the current file is being transferred. The replicas of the files are
+        queried `window` paths at a time with `replicas_many`, so only the next
+        `2*window` paths are kept in memory.
+        """
+
+        def query(chunk):
+            if len(chunk) == 0:
+                return []
+            replicas = self.replicas_many(chunk, cached=True)
+            # Missing files are left to the transfer to deal with
+            return [(path, replicas.get(path, [])) for path in chunk]
+
+        def with_replicas():
+            chunk = []
+            for remotepath in remotepaths:
+                chunk.append(remotepath)
+                if len(chunk) >= max(window, 1):
+                    for item in query(chunk):
+                        yield item
+                    chunk = []
+            for item in query(chunk):
+                yield item
+
+        queue = deque()
+        try:
+            for remotepath, replicas in with_replicas():
+                queue.append((remotepath, self._stage(remotepath, source, destination, tape, timeout, verbose, replicas=replicas)))
+                if len(queue) > window:
+                    remotepath, handle = queue.popleft()
+                    if handle is not None:
+                        # The request is known to the SE now,
+                        # the transfer itself will wait for the file to be online.
+                        self._bringonline_release(handle)
+                    yield remotepath
+            while len(queue) > 0:
+                remotepath, handle = queue.popleft()
+                if handle is not None:
+                    self._bringonline_release(handle)
+                yield remotepath
+        finally:
+            for remotepath, handle in queue:
+                if handle is not None:
+                    self._bringonline_release(handle)
+
+    @classmethod
+    def _is_transient(cls, error):
+        """Is the error likely to go away when trying again?"""
+        return len(error.args) > 0 and cls.transient_errors.search(str(error.args[0])) is not None
+
+    @staticmethod
+    def _concerns_destination(error, dst):
+        """Is the error about the destination of a transfer?
+
+        `dst` is the destination SE, or `None` for downloads.
+        """
+        if len(error.args) == 0:
+            return False
+        message = str(error.args[0])
+        return 'DESTINATION' in message or (dst is not None and dst.host in message)
+
+    def _blame(self, src, dst, error):
+        """Record a failed transfer against the source SE if it is to blame.
+
+        Only transient errors that do not concern the destination are failures
+        of the source. They are recorded in its circuit breaker and the
+        `storage.transfer_model`.
+        """
+        if not self._is_transient(error) or self._concerns_destination(error, dst):
+            return
+        src.circuit.record_failure()
+        if dst is None:
+            storage.transfer_model.record(src.name, 'local', error=True)
+        else:
+            storage.transfer_model.record(src.name, dst.name, error=True)
+
+    def _with_retries(self, src, dst, function, *args, **kwargs):
+        """Transfer a file with `function`, retrying transient failures with a jittered exponential backoff.
+
+        `src` is the source SE of the transfer and `dst` the destination SE,
+        or `None` for downloads. If the circuit of `src` is open, no attempt
+        is made and a `BackendException` is raised right away.
+        Only errors that match `transient_errors` are retried. A file that
+        could not be transferred counts at most once against the source, see `_blame`.
+        Missing files and cancelled operations are neither retried nor blamed.
+        """
+
+        attempt = 0
+        while True:
+            if src.circuit.is_open():
+                raise BackendException("Storage element %s failed repeatedly. Skipping it for now."%(src.name,))
+            try:
+                ret = function(*args, **kwargs)
+            except (DoesNotExistException, CancelledException):
+                raise
+            except BackendException as e:
+                if attempt >= self.retries or not self._is_transient(e):
+                    self._blame(src, dst, e)
+                    raise
+                delay = min(self.retry_delay * 2**attempt, self.max_retry_delay)
+                attempt += 1
+                time.sleep(random.uniform(0, delay))
+            else:
+                src.circuit.record_success()
+                return ret
 
-    def get_file_source(self, remotepath, source=None, destination=None, tape=False):
+    def get_file_source(self, remotepath, source=None, destination=None, tape=False, replicas=None):
         """Return the closest replica and corresponding SE of the given file."""
-        return next(self.iter_file_sources(remotepath, source=source, destination=destination, tape=tape))
+        return next(self.iter_file_sources(remotepath, source=source, destination=destination, tape=tape, replicas=replicas))
 
-    def iter_file_sources(self, remotepath, source=None, destination=None, tape=False):
-        """Iterate over the closest replicas and corresponding SEs of the given file."""
+    def iter_file_sources(self, remotepath, source=None, destination=None, tape=False, replicas=None, preferred=None):
+        """Iterate over the closest replicas and corresponding SEs of the given file.
+
+        If a list of `replicas` is provided, it is used instead of querying the catalogue.
+        If no `source` is given, but the SE named `preferred` has a replica,
+        e.g. the one chosen in a plan, it is tried first.
+        """
+
+        def get_replica(SE):
+            if replicas is None:
+                return SE.get_replica(remotepath)
+            for rep in replicas:
+                if SE.host in rep:
+                    return rep.strip()
+            return None
 
         # Get source SE
         if source is None:
+            first = None
+            if preferred is not None:
+                first = storage.get_SE(preferred)
+                replica = None if first is None else get_replica(first)
+                if replica is None:
+                    first = None
+                else:
+                    yield replica, first
             if destination is None:
-                src = storage.get_closest_SE(remotepath, tape=tape)
+                src = storage.get_closest_SE(remotepath, tape=tape, replicas=replicas)
                 if src is None:
+                    if first is not None:
+                        return
                     raise BackendException("Could not find valid storage element with replica of %s."%(remotepath,))
-                yield src.get_replica(remotepath), src
+                if src != first:
+                    yield get_replica(src), src
                 return
             else:
                 dst = storage.get_SE(destination)
                 if dst is None:
                     raise BackendException("Could not find storage element %s."%(destination,))
-                srclst = dst.get_closest_SEs(remotepath, tape=tape)
-                if len(srclst) == 0:
+                srclst = dst.get_closest_SEs(remotepath, tape=tape, replicas=replicas)
+                if len(srclst) == 0 and first is None:
                     raise BackendException("Could not find valid storage element with replica of %s."%(remotepath,))
                 else:
                     for src in srclst:
-                        yield src.get_replica(remotepath), src
+                        if src != first:
+                            yield get_replica(src), src
                     return
         else:
             src = storage.get_SE(source)
             if src is None:
                 raise BackendException("Could not find storage element %s."%(source,))
 
-            if not src.has_replica(remotepath):
+            replica = get_replica(src)
+            if replica is None:
                 # Replica not present at source, throw error
                 raise BackendException("%s\nNo replica present at source storage element %s"%(remotepath, src.name,))
-            yield src.get_replica(remotepath), src
+            yield replica, src
             return
 
     def _replicate(self, source_surl, destination_surl, lurl, verbose=False, **kwargs):
         raise NotImplementedError()
 
-    def replicate(self, remotepath, destination, source=None, tape=False, verbose=False, bringonline_timeout=60*60*6, **kwargs):
+    def replicate(self, remotepath, destination, source=None, tape=False, verbose=False, bringonline_timeout=60*60*6, size=None, replicas=None, preferred=None, **kwargs):
         """Replicate the file to the specified storage element.
 
         If no source storage elment is provided, the closest replica is chosen.
         If `tape` is `True`, tape SEs are considered when choosing the closest one.
         If `verbose` is True, status messages will be printed to the screen.
+        The `size` of the file, e.g. from a listing, is used to keep track of
+        the throughput of the SEs. It is not queried if it is unknown.
+        If a list of `replicas` is provided, e.g. from a plan, it is used
+        instead of querying the catalogue. The SE named `preferred` is tried
+        first, see `iter_file_sources`.
 
         Returns `True` if the replication was succesful, `False` if not.
         """
 
-        lurl = self.get_lurl(remotepath)
-
         # Get destination SE and check if file is already present
         dst = storage.get_SE(destination)
         if dst is None:
             raise BackendException("Could not find storage element %s."%(destination,))
 
-        if dst.has_replica(remotepath):
+        if replicas is not None:
+            present = any(dst.host in rep for rep in replicas)
+        else:
+            present = dst.has_replica(remotepath)
+        if present:
             # Replica already at destination, nothing to do here
             if verbose:
                 print_("Replica of %s already present at destination storage element %s."%(remotepath, dst.name,))
@@ -225,25 +998,24 @@ class GridBackend(object):
 
         destination_path = dst.get_storage_path(remotepath)
         failure = None
-        for source_path, src in self.iter_file_sources(remotepath, source, destination, tape):
+        for source_path, src in self.iter_file_sources(remotepath, source, destination, tape, replicas=replicas, preferred=preferred):
             if verbose:
                 print_("Copying %s to %s"%(source_path, destination_path))
 
-            if src.type == 'tape':
-                if verbose:
-                    print_("Bringing online %s"%(source_path,))
-                try:
-                    ret = self.bringonline(source_path, timeout=bringonline_timeout, verbose=verbose) and self._replicate(source_path, destination_path, lurl, verbose=verbose)
-                except BackendException as e:
-                    failure = e
-                    ret = False
-            else:
-                try:
-                    ret = self._replicate(source_path, destination_path, lurl, verbose=verbose)
-                except BackendException as e:
-                    failure = e
-                    ret = False
+            try:
+                if src.type == 'tape':
+                    if verbose:
+                        print_("Bringing online %s"%(source_path,))
+                    ret = self.bringonline(source_path, timeout=bringonline_timeout, verbose=verbose)
+                else:
+                    ret = True
+                if ret:
+                    ret = self._with_retries(src, dst, self._replicate_from, remotepath, source_path, src, destination_path, dst, verbose=verbose, size=size)
+            except BackendException as e:
+                failure = e
+                ret = False
             if ret:
+                self._forget(remotepath, destination_path)
                 return True
 
         if failure is not None:
@@ -251,18 +1023,161 @@ class GridBackend(object):
         else:
             return False
 
-    def _get(self, surl, localpath, verbose=False, **kwargs):
-        raise NotImplementedError()
+    def _replicate_from(self, remotepath, source_path, src, destination_path, dst, verbose=False, size=None):
+        """Replicate a file from the given source, which must be online."""
+        lurl = self.get_lurl(remotepath)
+        with self.transfer_slots(src, dst):
+            with statistics.measure('replicate', src, dst) as measurement:
+                start = time.time()
+                ret = self._replicate(source_path, destination_path, lurl, verbose=verbose)
+                if ret:
+                    if size is None:
+                        # Only the success can be recorded
+                        storage.transfer_model.record(src.name, dst.name)
+                    else:
+                        storage.transfer_model.record(src.name, dst.name, size, time.time() - start)
+                        measurement.bytes = size
+                return ret
+
+    def _replicate_many(self, transfers, verbose=False, **kwargs):
+        """Replicate many files.
+
+        `transfers` is a list of `(source_surl, destination_surl, lurl)` tuples.
+        Returns a dictionary keyed by the lurls, with `True` for every successful
+        replication, or the `BackendException` that made it fail.
+
+        Backends that can copy many files at once should override this.
+        By default, the files are replicated one by one.
+        """
+        ret = {}
+        for source_surl, destination_surl, lurl in transfers:
+            try:
+                ret[lurl] = self._replicate(source_surl, destination_surl, lurl, verbose=verbose, **kwargs)
+            except BackendException as e:
+                ret[lurl] = e
+        return ret
 
-    def get(self, remotepath, localpath, source=None, tape=False, force=False, verbose=False, bringonline_timeout=60*60*6, **kwargs):
-        """Download a file from the grid.
+    def replicate_many(self, remotepaths, destination, source=None, tape=False, verbose=False, bringonline_timeout=60*60*6, sizes=None, **kwargs):
+        """Replicate many files to the specified storage element at once.
 
-        If no source storage elment is provided, the closest replica is chosen.
-        If `tape` is True, tape SEs are considered when choosing the closest one.
-        If `force` is `True`, local files will be overwritten.
-        If `verbose` is True, status messages will be printed to the screen.
+        Works like `replicate`, but the files are copied with a single bulk
+        operation if the backend supports it. Only the closest source of each
+        file is used in the bulk copy. Files that fail there are retried one by
+        one, so other sources are tried as well.
+
+        Files on tape are brought online with a single request and are copied
+        in bulk as soon as they come online.
+
+        `sizes` is a dictionary of the known sizes of the files, e.g. from a
+        listing. The sizes of other files are not queried.
+
+        Returns a dictionary keyed by the remote paths, with `True` for every
+        successful replication, `False` for failed ones, or the `BackendException`
+        that made it fail.
         """
 
+        remotepaths = list(remotepaths)
+        ret = {}
+        if sizes is None:
+            sizes = {}
+
+        # Get destination SE
+        dst = storage.get_SE(destination)
+        if dst is None:
+            raise BackendException("Could not find storage element %s."%(destination,))
+
+        # Collect the transfers
+        replicas = self.replicas_many(remotepaths)
+        transfers = []
+        staging = {}
+        paths = {}
+        for remotepath in remotepaths:
+            if remotepath not in replicas:
+                ret[remotepath] = DoesNotExistException("Could not get replicas of %s."%(remotepath,))
+                continue
+            reps = replicas[remotepath]
+            if any(dst.host in rep for rep in reps):
+                # Replica already at destination, nothing to do here
+                if verbose:
+                    print_("Replica of %s already present at destination storage element %s."%(remotepath, dst.name,))
+                ret[remotepath] = True
+                continue
+
+            try:
+                source_path, src = self.get_file_source(remotepath, source, destination, tape, replicas=reps)
+            except BackendException as e:
+                ret[remotepath] = e
+                continue
+
+            destination_path = dst.get_storage_path(remotepath)
+            lurl = self.get_lurl(remotepath)
+            transfer = (source_path, destination_path, lurl)
+            if src.type == 'tape':
+                staging[source_path] = transfer
+            else:
+                transfers.append(transfer)
+            paths[lurl] = (remotepath, destination_path)
+
+        def replicate_transfers(transfers):
+            if verbose:
+                for source_path, destination_path, lurl in transfers:
+                    print_("Copying %s to %s"%(source_path, destination_path))
+            with statistics.measure('replicate_many', dst) as measurement:
+                measurement.items = len(transfers)
+                results = self._replicate_many(transfers, verbose=verbose)
+                # Only the bytes of files of known size are counted
+                measurement.bytes = sum(max(sizes.get(paths[lurl][0], 0), 0) for lurl, result in results.items() if result is True)
+            for source_path, destination_path, lurl in transfers:
+                result = results.get(lurl, None)
+                src = storage.get_SE(source_path)
+                if src is None:
+                    continue
+                if result is True:
+                    src.circuit.record_success()
+                    # The duration of single files of a bulk copy is unknown
+                    storage.transfer_model.record(src.name, dst.name)
+                elif isinstance(result, BackendException) and not isinstance(result, DoesNotExistException):
+                    self._blame(src, dst, result)
+            return results
+
+        # Copy files on disk, then the tape files as they come online
+        results = replicate_transfers(transfers)
+        for online in self.bringonline_many(list(staging), timeout=bringonline_timeout, verbose=verbose):
+            results.update(replicate_transfers([staging[surl] for surl in online]))
+
+        for lurl, (remotepath, destination_path) in paths.items():
+            if lurl not in results:
+                # File did not come online in time
+                ret[remotepath] = False
+                continue
+            result = results[lurl]
+            if result is True:
+                self._forget(remotepath, destination_path)
+                ret[remotepath] = True
+            elif isinstance(result, DoesNotExistException):
+                ret[remotepath] = result
+            else:
+                # Try again with all sources
+                if verbose:
+                    print_("Bulk replication of %s failed. Trying again on its own."%(remotepath,))
+                try:
+                    ret[remotepath] = self.replicate(remotepath, destination, source=source, tape=tape, verbose=verbose, bringonline_timeout=bringonline_timeout, size=sizes.get(remotepath, None), **kwargs)
+                except BackendException as e:
+                    ret[remotepath] = e
+
+        return ret
+
+    def _get(self, surl, localpath, verbose=False, streams=1, cancel=None, **kwargs):
+        """Download the replica to the local path.
+
+        If the `threading.Event` `cancel` is set, the download should be
+        stopped and a `CancelledException` raised.
+        """
+        raise NotImplementedError()
+
+    def _get_localpath(self, remotepath, localpath, force=False):
+        """Return the actual local path a remote file is downloaded to."""
+
         # Append the basename to the localpath if it is a directory
         if os.path.isdir(localpath):
             localpath = os.path.join(localpath, posixpath.basename(remotepath))
@@ -271,33 +1186,327 @@ class GridBackend(object):
         if os.path.isfile(localpath) and not force:
             raise BackendException("File does already exist: %s."%(localpath,))
 
-        # Get the source replica
-        failure = None
-        for replica, src in self.iter_file_sources(remotepath, source, tape=tape):
+        return localpath
+
+    def _get_from(self, replica, src, localpath, verbose=False, nbstreams=0, size=None, **kwargs):
+        """Download the given replica, which must be online.
+
+        If `nbstreams` is 0, the number of streams is chosen by the
+        `stream_controller`, based on the `size` of the file and the observed
+        throughput of the SE.
+        Failures are retried, see `_with_retries`.
+        """
+        return self._with_retries(src, None, self._get_once, replica, src, localpath, verbose=verbose, nbstreams=nbstreams, size=size, **kwargs)
+
+    def _get_once(self, replica, src, localpath, verbose=False, nbstreams=0, size=None, **kwargs):
+        if nbstreams > 0:
+            streams = nbstreams
+        else:
+            streams = stream_controller.streams(src.name, size)
+        if verbose:
+            print_("Copying %s to %s"%(replica, localpath))
+            if streams > 1:
+                print_("Using %d streams"%(streams,))
+        with self.transfer_slots(src):
+            with statistics.measure('get', src) as measurement:
+                start = time.time()
+                ret = self._get(replica, localpath, verbose=verbose, streams=streams, **kwargs)
+                if ret:
+                    nbytes = os.path.getsize(localpath)
+                    duration = time.time() - start
+                    stream_controller.record(src.name, streams, nbytes, duration)
+                    storage.transfer_model.record(src.name, 'local', nbytes, duration)
+                    measurement.bytes = nbytes
+                return ret
+
+    def _get_resume(self, surl, localpath, offset, verbose=False):
+        """Append the contents of the replica from byte `offset` on to the local file.
+
+        Backends whose protocols allow reading from an offset should override this.
+        """
+        raise NotImplementedError()
+
+    def _is_identical(self, replica, localpath, size, verbose=False):
+        """Is the local file identical to the replica of `size` bytes?
+
+        Compares the sizes and ADLER32 checksums.
+        """
+        if size is None or not os.path.isfile(localpath) or os.path.getsize(localpath) != size:
+            return False
+        if checksums.equal(checksums.adler32(localpath), self.checksum(replica, cached=True)):
+            if verbose:
+                print_("%s is identical to %s"%(localpath, replica))
+            return True
+        return False
+
+    def _resume(self, replica, src, localpath, size, verbose=False):
+        """Try to complete a partially downloaded file.
+
+        Returns `True` if the file was completed and its checksum matches the replica.
+        """
+        if size is None or not os.path.isfile(localpath):
+            return False
+        offset = os.path.getsize(localpath)
+        if offset == 0 or offset >= size:
+            return False
+        if verbose:
+            print_("Resuming download of %s at byte %d"%(replica, offset))
+        try:
+            with self.transfer_slots(src):
+                with statistics.measure('get', src) as measurement:
+                    self._get_resume(replica, localpath, offset, verbose=verbose)
+                    measurement.bytes = size - offset
+        except NotImplementedError:
+            if verbose:
+                print_("Resuming not supported")
+            return False
+        except BackendException as e:
             if verbose:
-                print_("Copying %s to %s"%(replica, localpath))
+                print_("Resuming failed: %s"%(e,))
+            return False
+        return self._is_identical(replica, localpath, size, verbose=verbose)
 
-            if src.type == 'tape':
-                if verbose:
-                    print_("Bringing online %s"%(replica,))
-                try:
-                    ret = self.bringonline(replica, timeout=bringonline_timeout, verbose=verbose) and self._get(replica, localpath, verbose=verbose, **kwargs)
-                except BackendException as e:
-                    failure = e
-                    ret = False
+    def _hedge_sources(self, remotepath, tape=False, replicas=None, preferred=None):
+        """Return the replicas and SEs that can be used for a hedged download, closest first.
+
+        Only SEs that have the file on disk and are neither blacklisted nor
+        failing repeatedly are considered. The SE named `preferred` is put first.
+        """
+        if replicas is None:
+            replicas = self.replicas(remotepath, cached=True)
+        ret = []
+        for SE in storage.get_closest_SEs(remotepath, tape=tape, replicas=replicas):
+            if SE.type != 'disk' or SE.is_blacklisted() or SE.circuit.is_open():
+                # All following SEs are worse
+                break
+            for rep in replicas:
+                if SE.host in rep:
+                    ret.append((rep.strip(), SE))
+                    break
+        ret.sort(key=lambda source: source[1].name != preferred)
+        return ret
+
+    def _get_hedged(self, sources, localpath, deadline, size, verbose=False, nbstreams=0, **kwargs):
+        """Download a file from the first of the `sources`, hedging against slow transfers.
+
+        If the first transfer has not delivered `hedge_fraction` of the `size`
+        bytes after `deadline` seconds, a second one is started from the next
+        source. Whichever finishes first wins, the other one is cancelled and
+        its partial file removed. If a transfer fails, the next source is tried.
+        """
+
+        results = Queue.Queue()
+        running = {}
+        failure = None
+        winner = None
+
+        def transfer(i, replica, src, path, cancel):
+            try:
+                ret = self._get_from(replica, src, path, verbose=verbose, nbstreams=nbstreams, size=size, cancel=cancel, **kwargs)
+            except BackendException as e:
+                results.put((i, False, e))
             else:
+                results.put((i, ret, None))
+
+        def start(i):
+            replica, src = sources[i]
+            # Separate files, so the transfers do not overwrite each other
+            path = '%s.part%d'%(localpath, i)
+            cancel = threading.Event()
+            thread = threading.Thread(target=transfer, args=(i, replica, src, path, cancel))
+            thread.daemon = True
+            running[i] = (thread, cancel, path)
+            thread.start()
+            return path
+
+        def remove(path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+        first_path = start(0)
+        next_source = 1
+        hedge_time = time.time() + deadline
+        try:
+            while len(running) > 0:
                 try:
-                    ret = self._get(replica, localpath, verbose=verbose, **kwargs)
-                except BackendException as e:
+                    i, ret, e = results.get(timeout=1)
+                except Queue.Empty:
+                    if hedge_time is not None and time.time() > hedge_time:
+                        hedge_time = None
+                        try:
+                            delivered = os.path.getsize(first_path)
+                        except OSError:
+                            delivered = 0
+                        if 0 in running and next_source < len(sources) and delivered < self.hedge_fraction * size:
+                            if verbose:
+                                print_("Only %d of %d bytes arrived after %d s, also downloading from %s"%(delivered, size, deadline, sources[next_source][1].name))
+                            start(next_source)
+                            next_source += 1
+                    continue
+
+                thread, cancel, path = running.pop(i)
+                thread.join()
+                if ret:
+                    winner = path
+                    if verbose:
+                        print_("Download from %s finished first"%(sources[i][1].name,))
+                    break
+                remove(path)
+                if e is not None and not isinstance(e, CancelledException):
                     failure = e
-                    ret = False
+                if len(running) == 0 and next_source < len(sources):
+                    start(next_source)
+                    next_source += 1
+        finally:
+            # Cancel and clean up the losers
+            for thread, cancel, path in running.values():
+                cancel.set()
+            for thread, cancel, path in running.values():
+                thread.join()
+                remove(path)
+
+        if winner is not None:
+            os.rename(winner, localpath)
+            return True
+        if failure is not None:
+            raise failure
+        return False
+
+    def get(self, remotepath, localpath, source=None, tape=False, force=False, verbose=False, bringonline_timeout=60*60*6, nbstreams=0, sync=False, hedge=0, size=None, replicas=None, preferred=None, **kwargs):
+        """Download a file from the grid.
+
+        If no source storage elment is provided, the closest replica is chosen.
+        If `tape` is True, tape SEs are considered when choosing the closest one.
+        If `force` is `True`, local files will be overwritten.
+        If `verbose` is True, status messages will be printed to the screen.
+        `nbstreams` sets the number of parallel streams of the download.
+        If it is 0, the number is chosen automatically per SE, based on the
+        file size and the throughput of previous downloads.
+        If `sync` is `True`, local files that are identical to the replica (same
+        size and ADLER32 checksum) are not downloaded again, and partial files
+        are completed if the backend supports it. Other files are overwritten.
+        If `hedge` is larger than 0 and no `source` is given, a second download
+        from the next closest disk replica is started in parallel if the first
+        one has not delivered `hedge_fraction` of the file after `hedge` seconds.
+        The slower download is cancelled when the faster one finishes.
+        The `size` of the file, e.g. from a listing, helps choosing the number
+        of streams. It is only queried if it is unknown and needed for `sync`
+        or `hedge`.
+        If a list of `replicas` is provided, e.g. from a plan, it is used
+        instead of querying the catalogue. The SE named `preferred` is tried
+        first, see `iter_file_sources`.
+        """
+
+        localpath = self._get_localpath(remotepath, localpath, force=(force or sync))
+        if size is None and (sync or hedge > 0):
+            size = self._file_size(remotepath)
+
+        if hedge > 0 and source is None and size is not None and size > 0:
+            sources = self._hedge_sources(remotepath, tape=tape, replicas=replicas, preferred=preferred)
+            if len(sources) > 1:
+                replica, src = sources[0]
+                if sync and (self._is_identical(replica, localpath, size, verbose=verbose)
+                        or self._resume(replica, src, localpath, size, verbose=verbose)):
+                    return True
+                return self._get_hedged(sources, localpath, hedge, size, verbose=verbose, nbstreams=nbstreams, **kwargs)
+
+        # Get the source replica
+        failure = None
+        for replica, src in self.iter_file_sources(remotepath, source, tape=tape, replicas=replicas, preferred=preferred):
+            try:
+                if sync and self._is_identical(replica, localpath, size, verbose=verbose):
+                    return True
+                if src.type == 'tape':
+                    if verbose:
+                        print_("Bringing online %s"%(replica,))
+                    ret = self.bringonline(replica, timeout=bringonline_timeout, verbose=verbose)
+                else:
+                    ret = True
+                if ret and sync and self._resume(replica, src, localpath, size, verbose=verbose):
+                    return True
+                if ret:
+                    ret = self._get_from(replica, src, localpath, verbose=verbose, nbstreams=nbstreams, size=size, **kwargs)
+            except BackendException as e:
+                failure = e
+                ret = False
             if ret:
                 return True
 
-        if failure is not None:
-            raise failure
-        else:
-            return False
+        if failure is not None:
+            raise failure
+        else:
+            return False
+
+    def get_many(self, remotepaths, localpath, source=None, tape=False, force=False, verbose=False, bringonline_timeout=60*60*6, nbstreams=0, sync=False, sizes=None, **kwargs):
+        """Download many files from the grid into the local directory `localpath`.
+
+        Works like `get`, but files on tape are brought online with a single
+        request and are downloaded as soon as they come online.
+        With `sync`, files that are identical already are not brought online.
+        `sizes` is a dictionary of the known sizes of the files, e.g. from a
+        listing. The sizes of other files are only queried for `sync`.
+
+        Returns a dictionary keyed by the remote paths, with `True` for every
+        successful download, `False` for failed ones, or the `BackendException`
+        that made it fail.
+        """
+
+        remotepaths = list(remotepaths)
+        ret = {}
+        staging = {}
+        if sizes is None:
+            sizes = {}
+
+        def file_size(remotepath):
+            size = sizes.get(remotepath, None)
+            if size is None and sync:
+                size = sizes[remotepath] = self._file_size(remotepath)
+            return size
+
+        def get_from(remotepath, replica, src, localpath):
+            size = file_size(remotepath)
+            try:
+                if sync and self._resume(replica, src, localpath, size, verbose=verbose):
+                    ret[remotepath] = True
+                else:
+                    ret[remotepath] = self._get_from(replica, src, localpath, verbose=verbose, nbstreams=nbstreams, size=size, **kwargs)
+            except BackendException as e:
+                ret[remotepath] = e
+
+        # Download the files on disk right away
+        replicas = self.replicas_many(remotepaths)
+        for remotepath in remotepaths:
+            if remotepath not in replicas:
+                ret[remotepath] = DoesNotExistException("Could not get replicas of %s."%(remotepath,))
+                continue
+            try:
+                path = self._get_localpath(remotepath, localpath, force=(force or sync))
+                replica, src = self.get_file_source(remotepath, source, tape=tape, replicas=replicas[remotepath])
+                if sync and self._is_identical(replica, path, file_size(remotepath), verbose=verbose):
+                    ret[remotepath] = True
+                    continue
+            except BackendException as e:
+                ret[remotepath] = e
+                continue
+            if src.type == 'tape':
+                staging[replica] = (remotepath, src, path)
+            else:
+                get_from(remotepath, replica, src, path)
+
+        # Then the ones on tape as they come online
+        for online in self.bringonline_many(list(staging), timeout=bringonline_timeout, verbose=verbose):
+            for replica in online:
+                remotepath, src, path = staging[replica]
+                get_from(remotepath, replica, src, path)
+
+        for remotepath in remotepaths:
+            if remotepath not in ret:
+                # File did not come online in time
+                ret[remotepath] = False
+
+        return ret
 
     def _put(self, localpath, surl, remotepath, verbose=False, **kwargs):
         raise NotImplementedError()
@@ -332,7 +1541,12 @@ class GridBackend(object):
 
         # Upload and register the file
         lurl = self.get_lurl(remotepath)
-        return self._put(localpath, surl, lurl, verbose=verbose, **kwargs)
+        self._forget(remotepath, surl)
+        with statistics.measure('put', SE) as measurement:
+            ret = self._put(localpath, surl, lurl, verbose=verbose, **kwargs)
+            if ret and statistics.enabled:
+                measurement.bytes = os.path.getsize(localpath)
+            return ret
 
     def _remove(self, surl, lurl, last=False, verbose=False, **kwargs):
         """Remove the given replica and unregister it from the remotepath.
@@ -381,7 +1595,9 @@ class GridBackend(object):
         if unregister:
             return self.unregister(destination_path, remotepath)
         else:
-            return self._remove(destination_path, lurl, last=(nrep<=1), verbose=verbose, **kwargs)
+            self._forget(remotepath, destination_path)
+            with statistics.measure('remove', dst):
+                return self._remove(destination_path, lurl, last=(nrep<=1), verbose=verbose, **kwargs)
 
 class LCGBackend(GridBackend):
     """Grid backend using the LCG command line tools `lfc-*` and `lcg-*`."""
@@ -401,6 +1617,9 @@ class LCGBackend(GridBackend):
         self._del_cmd = sh.Command('lcg-del')
 
     def _ls(self, lurl, **kwargs):
+        return list(self._iter_ls(lurl, **kwargs))
+
+    def _iter_ls(self, lurl, **kwargs):
         # Translate keyword arguments
         d = kwargs.pop('directory', False)
         args = []
@@ -409,20 +1628,20 @@ class LCGBackend(GridBackend):
         args.append('-l')
         args.append(lurl[4:])
         try:
-            output = self._ls_cmd(*args, **kwargs)
+            # Parse the lines as they come in
+            for line in self._ls_cmd(*args, _iter=True, _bg_exc=False, **kwargs):
+                fields = line.split()
+                if len(fields) == 0:
+                    continue
+                mode, links, uid, gid, size = fields[:5]
+                name = fields[-1]
+                modified = ' '.join(fields[5:-1])
+                yield DirEntry(name, mode=mode, links=int(links), gid=gid, uid=uid, size=int(size), modified=modified)
         except sh.ErrorReturnCode as e:
-            if 'No such file' in e.stderr:
+            if 'No such file' in _decode(e.stderr):
                 raise DoesNotExistException("No such file or Directory.")
             else:
                 raise
-        ret = []
-        for line in output:
-            fields = line.split()
-            mode, links, uid, gid, size = fields[:5]
-            name = fields[-1]
-            modified = ' '.join(fields[5:-1])
-            ret.append(DirEntry(name, mode=mode, links=int(links), gid=gid, uid=uid, size=int(size), modified=modified))
-        return ret
 
     def _replicas(self, lurl, **kwargs):
         ret = []
@@ -462,12 +1681,18 @@ class LCGBackend(GridBackend):
             checksum = '?'
         return checksum
 
-    def _bringonline(self, surl, timeout, **kwargs):
-        kwargs['_err_to_out'] = True # Verbose output is on stderr
-        kwargs.pop('_err', None) # Cannot specify _err and _err_ro_out at same time
-
-        # Get original command output
-        return self._bringonline_cmd('-v', '--bdii-timeout', timeout, '--srm-timeout', timeout, '--sendreceive-timeout', timeout, '--connect-timeout', timeout, surl, **kwargs)
+    def _bringonline(self, surl, timeout, verbose=False, cancel=None, **kwargs):
+        if verbose:
+            out = sys.stdout
+        else:
+            out = None
+        timeout = int(math.ceil(timeout))
+        try:
+            # Verbose output is on stderr
+            _run_cancellable(['lcg-bringonline', '-v', '--bdii-timeout', timeout, '--srm-timeout', timeout, '--sendreceive-timeout', timeout, '--connect-timeout', timeout, surl], cancel=cancel, out=out, err_to_out=True)
+        except CancelledException:
+            return False
+        return True
 
     def _replicate(self, source_surl, destination_surl, lurl, verbose=False, **kwargs):
         if verbose:
@@ -483,18 +1708,12 @@ class LCGBackend(GridBackend):
                 raise BackendException(e.stderr)
         return True
 
-    def _get(self, surl, localpath, verbose=False, **kwargs):
+    def _get(self, surl, localpath, verbose=False, streams=1, cancel=None, **kwargs):
         if verbose:
             out = sys.stdout
         else:
             out = None
-        try:
-            self._cp_cmd('-v', '--sendreceive-timeout', 14400, '--checksum', surl, localpath, _out=out, _err_to_out=True, **kwargs)
-        except sh.ErrorReturnCode as e:
-            if 'No such file' in e.stderr:
-                raise DoesNotExistException("No such file or directory.")
-            else:
-                raise BackendException(e.stderr)
+        _run_cancellable(['lcg-cp', '-v', '--sendreceive-timeout', 14400, '--checksum', '-n', streams, surl, localpath], cancel=cancel, out=out, err_to_out=True)
         return os.path.isfile(localpath)
 
 
@@ -546,6 +1765,9 @@ class GFALBackend(GridBackend):
         self._del_cmd = sh.Command('gfal-rm')
 
     def _ls(self, lurl, **kwargs):
+        return list(self._iter_ls(lurl, **kwargs))
+
+    def _iter_ls(self, lurl, **kwargs):
         # Translate keyword arguments
         d = kwargs.pop('directory', False)
         args = []
@@ -554,20 +1776,24 @@ class GFALBackend(GridBackend):
         args.append('-l')
         args.append(lurl)
         try:
-            output = self._ls_cmd(*args, **kwargs)
+            # Parse the lines as they come in
+            for line in self._ls_cmd(*args, _iter=True, _bg_exc=False, **kwargs):
+                if len(line.strip()) > 0:
+                    yield self._parse_ls_line(line)
         except sh.ErrorReturnCode as e:
-            if 'No such file' in e.stderr:
+            if 'No such file' in _decode(e.stderr):
                 raise DoesNotExistException("No such file or Directory.")
             else:
-                raise BackendException(e.stderr)
-        ret = []
-        for line in output:
-            fields = line.split()
-            mode, links, gid, uid, size = fields[:5]
-            name = fields[-1]
-            modified = ' '.join(fields[5:-1])
-            ret.append(DirEntry(name, mode=mode, links=int(links), gid=gid, uid=uid, size=int(size), modified=modified))
-        return ret
+                raise BackendException(_decode(e.stderr))
+
+    @staticmethod
+    def _parse_ls_line(line):
+        """Turn a line of `gfal-ls -l` output into a DirEntry."""
+        fields = line.split()
+        mode, links, gid, uid, size = fields[:5]
+        name = fields[-1]
+        modified = ' '.join(fields[5:-1])
+        return DirEntry(name, mode=mode, links=int(links), gid=gid, uid=uid, size=int(size), modified=modified)
 
     def _replicas(self, lurl, **kwargs):
         ret = []
@@ -630,11 +1856,7 @@ class GFALBackend(GridBackend):
             checksum = '?'
         return checksum
 
-    def _bringonline(self, surl, timeout, verbose=False, **kwargs):
-        if verbose:
-            out = sys.stdout
-        else:
-            out = None
+    def _bringonline(self, surl, timeout, verbose=False, cancel=None, **kwargs):
         # gfal does not notice when files come online, it seems
         # split task into many requests with short timeouts
         if verbose:
@@ -649,8 +1871,10 @@ class GFALBackend(GridBackend):
                 timeout = time_left
             time_left -= 10
             try:
-                self._bringonline_cmd('-t', timeout, surl, _out=out, **kwargs)
-            except sh.ErrorReturnCode:
+                _run_cancellable(['gfal-legacy-bringonline', '-t', int(math.ceil(timeout)), surl], cancel=cancel, out=out)
+            except CancelledException:
+                return False
+            except BackendException:
                 # Not online yet.
                 if time_left > 0:
                     continue
@@ -683,18 +1907,94 @@ class GFALBackend(GridBackend):
         self._register_cmd(lurl, destination_surl, _out=out, **kwargs)
         return True
 
-    def _get(self, surl, localpath, verbose=False, **kwargs):
+    def _replicate_many(self, transfers, verbose=False, **kwargs):
+        # `gfal-copy --from-file` only reads the sources from the file and
+        # copies them all into the destination directory given on the command line.
+        # So transfers are grouped by destination directory and transfers
+        # that rename the file are done one by one.
+        ret = {}
+        directories = {}
+        single = []
+        for source_surl, destination_surl, lurl in transfers:
+            directory, name = posixpath.split(destination_surl)
+            if name == posixpath.basename(source_surl):
+                directories.setdefault(directory, []).append((source_surl, destination_surl, lurl))
+            else:
+                single.append((source_surl, destination_surl, lurl))
+        for directory in sorted(directories):
+            ret.update(self._replicate_into(directory, directories[directory], verbose=verbose, **kwargs))
+        ret.update(GridBackend._replicate_many(self, single, verbose=verbose, **kwargs))
+        return ret
+
+    def _replicate_into(self, directory, transfers, verbose=False, **kwargs):
+        """Replicate many files into the same destination directory with a single `gfal-copy`."""
+        ret = {}
+        with tempfile.NamedTemporaryFile('wt') as f:
+            for source_surl, destination_surl, lurl in transfers:
+                f.write("%s\n"%(source_surl,))
+            f.flush()
+            try:
+                output = self._cp_cmd('-p', '-T', '1800', '--checksum', 'ADLER32', '--from-file', f.name, directory, **kwargs)
+            except sh.ErrorReturnCode as e:
+                # Some transfers failed
+                stdout, stderr = _decode(e.stdout), _decode(e.stderr)
+            else:
+                stdout, stderr = _decode(output.stdout), _decode(output.stderr)
+        if verbose:
+            print_(stdout, end='')
+
+        # Parse the results, lines look like this:
+        # Copying srm://source/file   [DONE]  after 3s
+        status = {}
+        for line in stdout.splitlines():
+            match = re.match(r'\s*Copying\s+(\S+).*\[(\w+)\]', line)
+            if match is not None:
+                status[match.group(1)] = match.group(2)
+        errors = stderr.splitlines()
+
         if verbose:
             out = sys.stdout
         else:
             out = None
-        try:
-            self._cp_cmd('-f', '--checksum', 'ADLER32', surl, localpath, _out=out, **kwargs)
-        except sh.ErrorReturnCode as e:
-            if 'No such file' in e.stderr:
-                raise DoesNotExistException("No such file or directory.")
-            else:
-                raise BackendException(e.stderr)
+        for source_surl, destination_surl, lurl in transfers:
+            try:
+                state = status.get(source_surl, None)
+                if state != 'DONE':
+                    # Find error messages concerning this file
+                    message = '\n'.join(line for line in errors if source_surl in line or destination_surl in line)
+                    if state is None:
+                        raise BackendException("No result reported for %s.\n%s"%(source_surl, message))
+                    elif 'No such file' in message:
+                        raise DoesNotExistException("No such file or directory.")
+                    elif 'File exists' in message or state == 'SKIPPED':
+                        if verbose:
+                            print_("Replica already exists. Checking checksum...")
+                        if self.checksum(destination_surl) == self.checksum(source_surl):
+                            if verbose:
+                                print_("Checksums match. Registering replica.")
+                        else:
+                            raise BackendException("File with different checksum already present.")
+                    else:
+                        raise BackendException(message)
+                # gfal-legacy-register can only handle one file at a time
+                try:
+                    self._register_cmd(lurl, destination_surl, _out=out, **kwargs)
+                except sh.ErrorReturnCode as e:
+                    raise BackendException(e.stderr)
+                ret[lurl] = True
+            except BackendException as e:
+                ret[lurl] = e
+        return ret
+
+    def _get(self, surl, localpath, verbose=False, streams=1, cancel=None, **kwargs):
+        if verbose:
+            out = sys.stdout
+        else:
+            out = None
+        args = ['-f', '--checksum', 'ADLER32']
+        if streams > 1:
+            args.extend(['--nbstreams', streams])
+        _run_cancellable(['gfal-copy'] + args + [surl, localpath], cancel=cancel, out=out)
         return os.path.isfile(localpath)
 
     def _put(self, localpath, surl, lurl, verbose=False, **kwargs):
@@ -729,12 +2029,777 @@ class GFALBackend(GridBackend):
                 raise BackendException(e.stderr)
         return True
 
+def _mode_bits(mode):
+    """Turn a mode string like 'drwxr-xr-x' into a numerical file mode.
+
+    Trailing characters, like the '+' of files with ACLs, are ignored.
+    Of modes that are too short, only the file type is kept.
+    Unknown modes are turned into 0.
+    """
+    if len(mode) == 0 or mode == '?':
+        return 0
+    if mode[0] == 'd':
+        ret = stat.S_IFDIR
+    elif mode[0] == 'l':
+        ret = stat.S_IFLNK
+    else:
+        ret = stat.S_IFREG
+    if len(mode) < 10:
+        return ret
+    for i, who in enumerate(['USR', 'GRP', 'OTH']):
+        for j, what in enumerate(['R', 'W', 'X']):
+            if mode[1 + 3*i + j] not in '-ST':
+                ret |= getattr(stat, 'S_I' + what + who)
+    # The set-ID and sticky bits are shown in place of the executable bits
+    for i, special in enumerate([stat.S_ISUID, stat.S_ISGID, stat.S_ISVTX]):
+        if mode[3 + 3*i] in 'sStT':
+            ret |= special
+    return ret
+
+_month_names = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+_months = dict((month, i+1) for i, month in enumerate(_month_names))
+
+def _parse_modified(modified):
+    """Turn a modification time like 'Sep 12 12:00' or 'Sep 12  2015' into seconds since the epoch.
+
+    Times without year are assumed to be within the last year, like `ls` does it.
+    Unknown times are turned into NaN.
+    """
+    # Parsing by hand is a lot faster than `time.strptime`
+    fields = modified.split()
+    try:
+        month = _months[fields[0]]
+        day = int(fields[1])
+        if ':' in fields[2]:
+            hour, minute = [int(x) for x in fields[2].split(':')]
+            year = None
+        else:
+            hour, minute = 0, 0
+            year = int(fields[2])
+    except (KeyError, IndexError, ValueError):
+        return float('nan')
+    if year is not None:
+        return time.mktime((year, month, day, hour, minute, 0, 0, 0, -1))
+    now = time.time()
+    year = time.localtime(now).tm_year
+    ret = time.mktime((year, month, day, hour, minute, 0, 0, 0, -1))
+    if ret > now + 24*60*60:
+        ret = time.mktime((year - 1, month, day, hour, minute, 0, 0, 0, -1))
+    return ret
+
+def _format_modified(mtime):
+    """Turn seconds since the epoch into a modification time like 'ls' shows it, e.g. 'Sep  2 12:00'."""
+    if mtime != mtime:
+        # NaN
+        return '?'
+    t = time.localtime(mtime)
+    if abs(time.time() - mtime) < 180*24*60*60:
+        return '%s %2d %02d:%02d'%(_month_names[t.tm_mon - 1], t.tm_mday, t.tm_hour, t.tm_min)
+    else:
+        return '%s %2d  %d'%(_month_names[t.tm_mon - 1], t.tm_mday, t.tm_year)
+
+def _mode_string(st_mode):
+    """Turn a numerical file mode into a string like 'drwxr-xr-x'."""
+    if stat.S_ISDIR(st_mode):
+        ret = 'd'
+    elif stat.S_ISLNK(st_mode):
+        ret = 'l'
+    else:
+        ret = '-'
+    for who in ['USR', 'GRP', 'OTH']:
+        for what in ['R', 'W', 'X']:
+            if st_mode & getattr(stat, 'S_I' + what + who):
+                ret += what.lower()
+            else:
+                ret += '-'
+    return ret
+
+class Gfal2Backend(GridBackend):
+    """Grid backend using the gfal2 Python bindings.
+
+    Unlike the `GFALBackend`, this does not start a new process for every
+    operation. Instead it keeps one gfal2 context around for the whole lifetime
+    of the backend.
+    """
+
+    def __init__(self, **kwargs):
+        """Initialise backend.
+
+        Accepts the same keyword arguments as the `GridBackend`, plus:
+
+        gfal2: Module. Default: None
+            The gfal2 module to be used. If `None`, the actual `gfal2` Python
+            bindings are imported. Can be used to provide a fake
+            implementation for testing.
+        """
+
+        gfal2 = kwargs.pop('gfal2', None)
+        GridBackend.__init__(self, **kwargs)
+
+        if gfal2 is None:
+            try:
+                import gfal2
+            except ImportError:
+                raise BackendException("Could not import the gfal2 Python bindings.")
+        self.gfal2 = gfal2
+        self.ctx = gfal2.creat_context()
+
+    def __getstate__(self):
+        # The module and context cannot be pickled,
+        # but the cache needs to do that to hash the function arguments.
+        state = self.__dict__.copy()
+        del state['gfal2']
+        del state['ctx']
+        return state
+
+    def _raise_error(self, e):
+        """Translate a gfal2 error into a BackendException."""
+        if e.code == errno.ENOENT or 'No such file' in e.message:
+            raise DoesNotExistException("No such file or directory.")
+        else:
+            raise BackendException(e.message)
+
+    @staticmethod
+    def _dir_entry(name, st):
+        """Create a DirEntry from a name and stat object."""
+        return DirEntry(name,
+            mode = _mode_string(st.st_mode),
+            links = int(st.st_nlink),
+            uid = str(st.st_uid),
+            gid = str(st.st_gid),
+            size = int(st.st_size),
+            modified = _format_modified(st.st_mtime))
+
+    def _ls(self, lurl, **kwargs):
+        return list(self._iter_ls(lurl, **kwargs))
+
+    def _iter_ls(self, lurl, **kwargs):
+        d = kwargs.pop('directory', False)
+        try:
+            st = self.ctx.stat(lurl)
+            if d or not stat.S_ISDIR(st.st_mode):
+                # Listing a file just returns the file itself
+                yield self._dir_entry(lurl, st)
+                return
+            directory = self.ctx.opendir(lurl)
+            while True:
+                dirent, st = directory.readpp()
+                if dirent is None:
+                    break
+                yield self._dir_entry(dirent.d_name, st)
+        except self.gfal2.GError as e:
+            self._raise_error(e)
+
+    def _replicas(self, lurl, **kwargs):
+        ret = []
+        try:
+            output = self.ctx.getxattr(lurl, 'user.replicas')
+        except self.gfal2.GError as e:
+            self._raise_error(e)
+        for line in output.split('\n'):
+            line = line.strip()
+            if len(line) > 0:
+                ret.append(line)
+        return ret
+
+    def _exists(self, surl, **kwargs):
+        try:
+            self.ctx.getxattr(surl, 'user.status')
+        except self.gfal2.GError as e:
+            if e.code == errno.ENOENT or 'No such file' in e.message:
+                return False
+            else:
+                raise BackendException(e.message)
+        else:
+            return True
+
+    def _register(self, surl, lurl, verbose=False):
+        if verbose:
+            print_("Registering %s as replica of %s"%(surl, lurl))
+        self.ctx.setxattr(lurl, 'user.replicas', '+' + surl, 0)
+
+    def _unregister(self, surl, lurl, verbose=False, **kwargs):
+        if verbose:
+            print_("Unregistering %s as replica of %s"%(surl, lurl))
+        try:
+            self.ctx.setxattr(lurl, 'user.replicas', '-' + surl, 0)
+        except self.gfal2.GError as e:
+            self._raise_error(e)
+        else:
+            return True
+
+    def _state(self, surl, **kwargs):
+        try:
+            state = self.ctx.getxattr(surl, 'user.status').strip()
+        except self.gfal2.GError:
+            state = '?'
+        return state
+
+    def _checksum(self, surl, **kwargs):
+        try:
+            checksum = self.ctx.checksum(surl, 'ADLER32').strip()
+        except self.gfal2.GError:
+            checksum = '?'
+        if len(checksum) == 0:
+            checksum = '?'
+        return checksum
+
+    def _bringonline(self, surl, timeout, verbose=False, **kwargs):
+        if verbose:
+            print_("Requesting %s to be brought online"%(surl,))
+        start = time.time()
+        try:
+            # Asynchronous request, pin file for the full timeout
+            status, token = self.ctx.bring_online(surl, int(timeout), int(timeout), True)
+            while status == 0:
+                if time.time() - start > timeout:
+                    return False
+                time.sleep(10)
+                status = self.ctx.bring_online_poll(surl, token)
+        except self.gfal2.GError as e:
+            if verbose:
+                print_(e.message)
+            return False
+        return True
+
+    def _bringonline_submit(self, surls, timeout, verbose=False):
+        # gfal2 can request a list of files to be brought online asynchronously
+        try:
+            self.ctx.bring_online(list(surls), int(timeout), int(timeout), True)
+        except self.gfal2.GError as e:
+            if verbose:
+                print_(e.message)
+        return None
+
+    def _transfer_parameters(self, timeout=None, overwrite=False):
+        """Return the standard copy parameters."""
+        params = self.ctx.transfer_parameters()
+        params.overwrite = overwrite
+        params.create_parent = True
+        params.set_checksum(self.gfal2.checksum_mode.both, 'ADLER32', '')
+        if timeout is not None:
+            params.timeout = timeout
+        return params
+
+    def _register_copy(self, source_surl, destination_surl, lurl, error=None, verbose=False):
+        """Register a copied replica, or deal with the `error` that happened while copying."""
+        if error is not None:
+            if error.code == errno.EEXIST or 'File exists' in error.message:
+                if verbose:
+                    print_("Replica already exists. Checking checksum...")
+                if self.checksum(destination_surl) == self.checksum(source_surl):
+                    if verbose:
+                        print_("Checksums match. Registering replica.")
+                else:
+                    raise BackendException("File with different checksum already present.")
+            else:
+                self._raise_error(error)
+        try:
+            self._register(destination_surl, lurl, verbose=verbose)
+        except self.gfal2.GError as e:
+            self._raise_error(e)
+        return True
+
+    def _replicate(self, source_surl, destination_surl, lurl, verbose=False, **kwargs):
+        params = self._transfer_parameters(timeout=1800)
+        try:
+            self.ctx.filecopy(params, source_surl, destination_surl)
+        except self.gfal2.GError as e:
+            error = e
+        else:
+            error = None
+        return self._register_copy(source_surl, destination_surl, lurl, error=error, verbose=verbose)
+
+    def _replicate_many(self, transfers, verbose=False, **kwargs):
+        ret = {}
+        if len(transfers) == 0:
+            return ret
+
+        # gfal2 can copy lists of files in one go and returns a list of errors
+        params = self._transfer_parameters(timeout=1800)
+        sources = [t[0] for t in transfers]
+        destinations = [t[1] for t in transfers]
+        try:
+            errors = self.ctx.filecopy(params, sources, destinations)
+        except self.gfal2.GError as e:
+            errors = [e] * len(transfers)
+
+        for (source_surl, destination_surl, lurl), error in zip(transfers, errors):
+            try:
+                ret[lurl] = self._register_copy(source_surl, destination_surl, lurl, error=error, verbose=verbose)
+            except BackendException as e:
+                ret[lurl] = e
+        return ret
+
+    def _get(self, surl, localpath, verbose=False, streams=1, cancel=None, **kwargs):
+        params = self._transfer_parameters(overwrite=True)
+        params.nbstreams = streams
+        if cancel is None:
+            ctx = self.ctx
+        else:
+            # Cancelling affects all operations of a context
+            ctx = self.gfal2.creat_context()
+            done = threading.Event()
+            def watch():
+                while not done.is_set():
+                    if cancel.wait(0.5):
+                        ctx.cancel()
+                        return
+            watcher = threading.Thread(target=watch)
+            watcher.daemon = True
+            watcher.start()
+        try:
+            ctx.filecopy(params, surl, 'file://' + os.path.abspath(localpath))
+        except self.gfal2.GError as e:
+            if cancel is not None and cancel.is_set():
+                raise CancelledException("Cancelled.")
+            self._raise_error(e)
+        finally:
+            if cancel is not None:
+                done.set()
+        return os.path.isfile(localpath)
+
+    def _get_resume(self, surl, localpath, offset, verbose=False):
+        # Read the rest of the file via the POSIX-like interface,
+        # which works for protocols that support seeking, e.g. xroot and https
+        try:
+            remote = self.ctx.open(surl, 'r')
+            remote.lseek(offset, os.SEEK_SET)
+            with open(localpath, 'ab') as f:
+                while True:
+                    data = remote.read(4*1024*1024)
+                    if len(data) == 0:
+                        break
+                    f.write(data)
+        except self.gfal2.GError as e:
+            self._raise_error(e)
+
+    def _put(self, localpath, surl, lurl, verbose=False, **kwargs):
+        params = self._transfer_parameters()
+        try:
+            self.ctx.filecopy(params, 'file://' + os.path.abspath(localpath), surl)
+            # A copy from the replica to the logical file registers the replica,
+            # creating the catalogue entry if necessary
+            self.ctx.filecopy(self._transfer_parameters(), surl, lurl)
+        except self.gfal2.GError as e:
+            self._raise_error(e)
+        return True
+
+    def _remove(self, surl, lurl, last=False, verbose=False, **kwargs):
+        try:
+            self.ctx.unlink(surl)
+            self._unregister(surl, lurl, verbose=verbose)
+            if last:
+                # Delete lfn
+                self.ctx.unlink(lurl)
+        except self.gfal2.GError as e:
+            self._raise_error(e)
+        return True
+
+class LocalBackend(GridBackend):
+    """Backend emulating the grid on the local file system.
+
+    Useful for testing and benchmarking without access to the grid.
+    Everything is stored below a `root` directory:
+
+    root/catalogue/...
+        The file catalogue. Logical directories are actual directories,
+        logical files are JSON files containing the size and list of replicas.
+
+    root/storage/<host>/...
+        The contents of the storage elements, one subtree per host.
+
+    root/online/<host>/...
+        Tape replicas that were requested to be brought online. The files
+        contain the time when the replica will be online.
+
+    root/settings.json
+        Optional default values for the keyword arguments described in
+        `__init__`, e.g. `{"latency": {"default": 0.1, "ls": 0.5}, "nearline_delay": 60}`.
+    """
+
+    # Time between checks whether a file is online
+    online_poll_interval = 1
+
+    def __init__(self, **kwargs):
+        """Initialise backend.
+
+        Accepts the same keyword arguments as the `GridBackend`, plus:
+
+        root: String. Default: './t2kdm-local'
+            The directory containing the emulated catalogue and SEs.
+
+        latency: Float or dict. Default: 0
+            Time in seconds every operation takes. Can be a dictionary of
+            operation names (e.g. 'ls', 'replicas', 'replicate') to times, with
+            the optional key 'default' for all other operations.
+
+        failure_rate: Float or dict. Default: 0
+            Probability of an operation to fail with a `BackendException`.
+            Can be a dictionary like `latency`.
+
+        nearline_delay: Float. Default: 0
+            Time in seconds it takes to bring a tape replica online.
+            Replicas written to tape SEs are NEARLINE.
+
+        seed: Integer. Default: None
+            Seed of the random number generator deciding the failures.
+        """
+
+        root = kwargs.pop('root', './t2kdm-local')
+        settings = {}
+        settings_file = os.path.join(root, 'settings.json')
+        if os.path.isfile(settings_file):
+            with open(settings_file, 'rt') as f:
+                settings = json.load(f)
+        for key in ['latency', 'failure_rate', 'nearline_delay', 'seed']:
+            if key in kwargs:
+                settings[key] = kwargs.pop(key)
+        GridBackend.__init__(self, **kwargs)
+
+        self.root = os.path.abspath(root)
+        self.latency = settings.get('latency', 0)
+        self.failure_rate = settings.get('failure_rate', 0)
+        self.nearline_delay = settings.get('nearline_delay', 0)
+        self.seed = settings.get('seed', None)
+        self.random = random.Random(self.seed)
+        self.lock = threading.Lock()
+
+    def cache_identity(self):
+        """The emulated grid also depends on the root directory."""
+        return GridBackend.cache_identity(self) + (self.root,)
+
+    def __getstate__(self):
+        # The lock cannot be pickled and the state of the random generator
+        # must not change the hash of the function arguments in the cache.
+        state = self.__dict__.copy()
+        del state['random']
+        del state['lock']
+        return state
+
+    @staticmethod
+    def _setting(setting, operation):
+        """Return the value of a per-operation setting."""
+        if isinstance(setting, dict):
+            return setting.get(operation, setting.get('default', 0))
+        return setting
+
+    def _simulate(self, operation):
+        """Wait for the latency of an operation and fail randomly."""
+        latency = self._setting(self.latency, operation)
+        if latency > 0:
+            time.sleep(latency)
+        failure_rate = self._setting(self.failure_rate, operation)
+        if failure_rate > 0:
+            with self.lock:
+                failed = self.random.random() < failure_rate
+            if failed:
+                raise BackendException("Simulated failure of %s: Connection timed out."%(operation,))
+
+    def _catalogue_path(self, lurl):
+        """Translate a lurl into a path in the emulated catalogue."""
+        if not lurl.startswith('lfn:'):
+            raise BackendException("Not a logical url: %s"%(lurl,))
+        path = posixpath.normpath(lurl[4:])
+        return os.path.join(self.root, 'catalogue', *path.strip('/').split('/'))
+
+    def _storage_path(self, surl, tree='storage'):
+        """Translate a surl into a path in the emulated storage."""
+        match = re.match(r'^[a-z]+://([^/]+)(/[^?]*)(\?SFN=(.*))?$', surl)
+        if match is None:
+            raise BackendException("Not a storage url: %s"%(surl,))
+        host = match.group(1)
+        if match.group(4) is not None:
+            path = match.group(4)
+        else:
+            path = match.group(2)
+        path = posixpath.normpath(path)
+        return os.path.join(self.root, tree, host, *path.strip('/').split('/'))
+
+    @staticmethod
+    def _is_tape(surl):
+        SE = storage.get_SE_by_path(surl)
+        return SE is not None and SE.type == 'tape'
+
+    @staticmethod
+    def _write_atomically(path, data):
+        """Write a file so other readers never see it half-written."""
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Someone else might have been faster
+                if not os.path.isdir(directory):
+                    raise
+        fd, temp = tempfile.mkstemp(dir=directory, prefix='.')
+        with os.fdopen(fd, 'wt') as f:
+            f.write(data)
+        os.chmod(temp, 0o644)
+        os.rename(temp, path)
+
+    def _read_entry(self, lurl):
+        """Return the catalogue entry of a file."""
+        path = self._catalogue_path(lurl)
+        if not os.path.isfile(path):
+            raise DoesNotExistException("No such file or directory.")
+        with open(path, 'rt') as f:
+            return json.load(f)
+
+    def _write_entry(self, lurl, entry):
+        self._write_atomically(self._catalogue_path(lurl), json.dumps(entry))
+
+    def _ls(self, lurl, **kwargs):
+        return list(self._iter_ls(lurl, **kwargs))
+
+    def _iter_ls(self, lurl, **kwargs):
+        self._simulate('ls')
+        d = kwargs.pop('directory', False)
+        path = self._catalogue_path(lurl)
+        if not os.path.exists(path):
+            raise DoesNotExistException("No such file or directory.")
+        if d or not os.path.isdir(path):
+            yield self._dir_entry(lurl, path)
+            return
+        for name in sorted(os.listdir(path)):
+            if name.startswith('.'):
+                # Temporary files
+                continue
+            try:
+                yield self._dir_entry(name, os.path.join(path, name))
+            except (IOError, OSError):
+                # Removed in the meantime
+                continue
+
+    def _dir_entry(self, name, path):
+        """Create a DirEntry of a catalogue file or directory."""
+        st = os.stat(path)
+        if stat.S_ISDIR(st.st_mode):
+            size = st.st_size
+        else:
+            with open(path, 'rt') as f:
+                size = json.load(f)['size']
+        return DirEntry(name,
+            mode = _mode_string(st.st_mode),
+            links = int(st.st_nlink),
+            uid = str(st.st_uid),
+            gid = str(st.st_gid),
+            size = int(size),
+            modified = _format_modified(st.st_mtime))
+
+    def _replicas(self, lurl, **kwargs):
+        self._simulate('replicas')
+        return list(self._read_entry(lurl)['replicas'])
+
+    def _exists(self, surl, **kwargs):
+        self._simulate('exists')
+        return os.path.isfile(self._storage_path(surl))
+
+    def _register(self, surl, lurl, size=None, verbose=False):
+        if verbose:
+            print_("Registering %s as replica of %s"%(surl, lurl))
+        with self.lock:
+            try:
+                entry = self._read_entry(lurl)
+            except DoesNotExistException:
+                entry = {'size': size, 'replicas': []}
+            if surl not in entry['replicas']:
+                entry['replicas'].append(surl)
+            self._write_entry(lurl, entry)
+
+    def _unregister(self, surl, lurl, verbose=False, **kwargs):
+        self._simulate('unregister')
+        if verbose:
+            print_("Unregistering %s as replica of %s"%(surl, lurl))
+        with self.lock:
+            entry = self._read_entry(lurl)
+            if surl in entry['replicas']:
+                entry['replicas'].remove(surl)
+            self._write_entry(lurl, entry)
+        return True
+
+    def _online_time(self, surl):
+        """Return the time when a tape replica is online, or `None` if it was not requested."""
+        path = self._storage_path(surl, tree='online')
+        try:
+            with open(path, 'rt') as f:
+                return float(f.read())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _is_online(self, surl):
+        if not self._is_tape(surl):
+            return True
+        online = self._online_time(surl)
+        return online is not None and online <= time.time()
+
+    def _request_online(self, surl):
+        """Start bringing a tape replica online."""
+        if not os.path.isfile(self._storage_path(surl)):
+            raise DoesNotExistException("No such file or directory.")
+        if self._online_time(surl) is None:
+            self._write_atomically(self._storage_path(surl, tree='online'), repr(time.time() + self.nearline_delay))
+
+    def _state(self, surl, **kwargs):
+        try:
+            self._simulate('state')
+        except BackendException:
+            return '?'
+        if not os.path.isfile(self._storage_path(surl)):
+            return '?'
+        if not self._is_tape(surl):
+            return 'ONLINE'
+        if self._is_online(surl):
+            return 'ONLINE_AND_NEARLINE'
+        else:
+            return 'NEARLINE'
+
+    def _checksum(self, surl, **kwargs):
+        try:
+            self._simulate('checksum')
+        except BackendException:
+            return '?'
+        path = self._storage_path(surl)
+        if not os.path.isfile(path):
+            return '?'
+        return checksums.adler32(path)
+
+    def _bringonline(self, surl, timeout, verbose=False, cancel=None, **kwargs):
+        self._simulate('bringonline')
+        if verbose:
+            print_("Requesting %s to be brought online"%(surl,))
+        self._request_online(surl)
+        if cancel is None:
+            cancel = threading.Event()
+        start = time.time()
+        while not self._is_online(surl):
+            time_left = timeout - (time.time() - start)
+            if time_left <= 0:
+                return False
+            if cancel.wait(min(self.online_poll_interval, time_left)):
+                return False
+        return True
+
+    def _bringonline_submit(self, surls, timeout, verbose=False):
+        for surl in surls:
+            try:
+                self._request_online(surl)
+            except BackendException as e:
+                if verbose:
+                    print_(e.args[0])
+        return None
+
+    def _copy(self, source, destination, cancel=None):
+        """Copy a file, creating the necessary directories.
+
+        The copy stops with a `CancelledException` when `cancel` is set.
+        """
+        directory = os.path.dirname(destination)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        if cancel is None:
+            shutil.copyfile(source, destination)
+            return
+        with open(source, 'rb') as src:
+            with open(destination, 'wb') as dst:
+                while True:
+                    if cancel.is_set():
+                        raise CancelledException("Cancelled.")
+                    data = src.read(1024*1024)
+                    if len(data) == 0:
+                        break
+                    dst.write(data)
+
+    def _read_replica(self, surl):
+        """Return the local path of a replica that is ready to be read."""
+        path = self._storage_path(surl)
+        if not os.path.isfile(path):
+            raise DoesNotExistException("No such file or directory.")
+        if not self._is_online(surl):
+            raise BackendException("Replica is not online: %s"%(surl,))
+        return path
+
+    def _replicate(self, source_surl, destination_surl, lurl, verbose=False, **kwargs):
+        self._simulate('replicate')
+        source = self._read_replica(source_surl)
+        destination = self._storage_path(destination_surl)
+        if os.path.isfile(destination):
+            if verbose:
+                print_("Replica already exists. Checking checksum...")
+            if self._checksum(source_surl) == self._checksum(destination_surl):
+                if verbose:
+                    print_("Checksums match. Registering replica.")
+            else:
+                raise BackendException("File with different checksum already present.")
+        else:
+            self._copy(source, destination)
+        self._register(destination_surl, lurl, verbose=verbose)
+        return True
+
+    def _get(self, surl, localpath, verbose=False, streams=1, cancel=None, **kwargs):
+        # Every stream is equally fast here
+        self._simulate('get')
+        self._copy(self._read_replica(surl), localpath, cancel=cancel)
+        return os.path.isfile(localpath)
+
+    def _get_resume(self, surl, localpath, offset, verbose=False):
+        self._simulate('get')
+        with open(self._read_replica(surl), 'rb') as source:
+            source.seek(offset)
+            with open(localpath, 'ab') as destination:
+                shutil.copyfileobj(source, destination)
+
+    def _put(self, localpath, surl, lurl, verbose=False, **kwargs):
+        self._simulate('put')
+        destination = self._storage_path(surl)
+        if os.path.isfile(destination):
+            raise BackendException("File exists: %s"%(surl,))
+        self._copy(localpath, destination)
+        self._register(surl, lurl, size=os.path.getsize(localpath), verbose=verbose)
+        return True
+
+    def _remove(self, surl, lurl, last=False, verbose=False, **kwargs):
+        self._simulate('remove')
+        for tree in ['storage', 'online']:
+            path = self._storage_path(surl, tree=tree)
+            if os.path.isfile(path):
+                os.remove(path)
+        self._unregister(surl, lurl, verbose=verbose)
+        if last:
+            # Delete lfn
+            os.remove(self._catalogue_path(lurl))
+        return True
+
 def get_backend(config):
     """Return the backend according to the provided configuration."""
 
+    if config.shared_cache.lower() in ('yes', 'true', 'on', '1'):
+        cache.persistent = PersistentCache(shared_cache_file)
+    else:
+        cache.persistent = None
+
+    kwargs = {
+        'basedir': config.basedir,
+        'max_se_transfers': int(config.max_se_transfers),
+        'checksum_max_age': float(config.checksum_max_age),
+    }
+
     if config.backend == 'lcg':
-        return LCGBackend(basedir = config.basedir)
+        return LCGBackend(**kwargs)
     if config.backend == 'gfal':
-        return GFALBackend(basedir = config.basedir)
+        return GFALBackend(**kwargs)
+    if config.backend == 'gfal2':
+        return Gfal2Backend(**kwargs)
+    if config.backend == 'local':
+        return LocalBackend(root=config.local_root, **kwargs)
+    if config.backend == 'gfal-async':
+        if sys.version_info < (3, 5):
+            raise config.ConfigError('backend', "The gfal-async backend requires Python 3.5 or newer!")
+        from t2kdm.asyncgfal import AsyncGFALBackend
+        return AsyncGFALBackend(**kwargs)
     else:
         raise config.ConfigError('backend', "Unknown backend!")
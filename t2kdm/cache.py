@@ -1,74 +1,442 @@
-"""A cache for grid tool output to make CLI experience more snappy."""
+"""A cache for grid tool output to make CLI experience more snappy.
 
+Entries are kept in memory, and optionally in a `PersistentCache` on disk
+that is shared by all processes of the user.
+"""
+
+import os, sys
+import threading
+import hashlib
 from time import time
-from cPickle import dumps
+from collections import OrderedDict
+from six.moves.cPickle import dumps, loads
+
+# Python 2 lacks the fast way to mark an entry as recently used
+_move_to_end = getattr(OrderedDict, 'move_to_end', None)
+
+def _namespace(function):
+    """Return the qualified name of a function, e.g. `t2kdm.backends.Backend.ls`."""
+    return '%s.%s'%(function.__module__, getattr(function, '__qualname__', function.__name__))
+
+def _is_method(function):
+    """Return whether the first argument of the function is `self`."""
+    code = function.__code__
+    return code.co_argcount > 0 and code.co_varnames[0] == 'self'
+
+def _key(args, kwargs):
+    """Turn function arguments into a key of the in-memory cache.
+
+    The key is a tuple of the arguments, if they are all hashable.
+    Otherwise the arguments are pickled.
+    """
+    if not kwargs:
+        key = (args, ())
+    elif len(kwargs) == 1:
+        key = (args, tuple(kwargs.items()))
+    else:
+        key = (args, tuple(sorted(kwargs.items())))
+    try:
+        hash(key)
+    except TypeError:
+        # E.g. lists among the arguments
+        key = _pickle(args, kwargs)
+    return key
+
+def _pickle(args, kwargs):
+    return dumps( (args, sorted(kwargs.items())), 2 )
+
+def _sizeof(value, depth=3):
+    """Estimate the memory used by a value in bytes.
+
+    Containers and object attributes are followed up to `depth` levels deep.
+    Deeper levels are estimated from the first item only.
+    """
+    size = sys.getsizeof(value)
+    if depth <= 0:
+        return size
+    if isinstance(value, dict):
+        items = list(value.keys()) + list(value.values())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        items = list(value)
+    elif hasattr(value, '__dict__'):
+        return size + _sizeof(value.__dict__, depth - 1)
+    else:
+        return size
+    if len(items) > 100:
+        # Assume all items are alike, so huge listings are cheap to estimate
+        return size + len(items) * _sizeof(items[0], depth - 1)
+    return size + sum(_sizeof(item, depth - 1) for item in items)
 
 class CacheEntry(object):
     """An entry in the cache."""
 
-    def __init__(self, value, creation_time=None, cache_time=60):
+    def __init__(self, value, creation_time=None, cache_time=60, size=0):
         self.value = value
         if creation_time is None:
-            self.creation_time = time()
+            creation_time = time()
+        self.creation_time = creation_time
         self.cache_time = cache_time
+        self.expiry_time = creation_time + cache_time
+        self.size = size
 
     def is_valid(self):
-        return (self.creation_time + self.cache_time) > time()
+        return self.expiry_time > time()
+
+class CacheSegment(object):
+    """The entries of a single cached function, with their own limits.
+
+    The entries are kept in order of their last use, so the least recently
+    used ones can be evicted when there are more than `max_entries`, or they
+    use more than `max_size` bytes. A limit of 0 means no limit.
+    """
+
+    # Minimum number of additions between sweeps of expired entries
+    sweep_every = 100
+
+    def __init__(self, cache_time=60, max_entries=0, max_size=0, persistent_time=0, namespace=None, method=False):
+        # Name of the segment in the persistent cache
+        self.namespace = namespace
+        # Whether the first argument is the instance, which is replaced by its identity in persistent keys
+        self.method = method
+        self.cache_time = cache_time
+        self.max_entries = max_entries
+        self.max_size = max_size
+        # How long entries are kept in the persistent cache, 0 means not at all
+        self.persistent_time = persistent_time
+        self.entries = OrderedDict()
+        self.size = 0
+        self.additions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def get(self, key):
+        """Return the valid entry of the key, or `None`."""
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                return None
+            if entry.expiry_time <= time():
+                self._remove(key)
+                return None
+            # Move to the most recently used end
+            if _move_to_end is None:
+                self.entries[key] = self.entries.pop(key)
+            else:
+                _move_to_end(self.entries, key)
+            return entry
+
+    def add(self, key, value):
+        """Add an entry, evicting others if necessary."""
+        if self.max_size > 0:
+            size = _sizeof(value)
+        else:
+            size = 0
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = CacheEntry(value, cache_time=self.cache_time, size=size)
+            self.size += size
+            self.additions += 1
+            if self.additions >= max(self.sweep_every, len(self.entries) // 2):
+                # Sweeping at most every `len/2` additions costs O(1) per addition
+                self._sweep()
+            while len(self.entries) > 1 and (
+                    (self.max_entries > 0 and len(self.entries) > self.max_entries) or
+                    (self.max_size > 0 and self.size > self.max_size)):
+                self._remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def _sweep(self):
+        for key in [key for key, entry in self.entries.items() if not entry.is_valid()]:
+            self._remove(key)
+        self.additions = 0
+
+    def clean(self):
+        """Remove expired entries."""
+        with self.lock:
+            self._sweep()
+
+    def flush(self):
+        """Remove all entries."""
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.additions = 0
+
+class PersistentCache(object):
+    """Cache tier in an sqlite database that is shared by many processes.
+
+    The database uses write-ahead logging, so readers and writers in
+    different processes do not block each other. Values are pickled and
+    stored by namespace (the function name) and key, with their expiry time.
+    Expired entries are ignored and removed with `clean`.
+
+    Any problem with the database is treated like a cache miss.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def _connect(self):
+        import sqlite3
+        directory = os.path.dirname(self.filename)
+        if directory != '' and not os.path.isdir(directory):
+            os.makedirs(directory)
+        new = not os.path.exists(self.filename)
+        connection = sqlite3.connect(self.filename, timeout=60, check_same_thread=False)
+        if new:
+            # Pickles must only be loaded from trusted files
+            os.chmod(self.filename, 0o600)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS entries ("
+            "namespace TEXT, key TEXT, value BLOB, created REAL, expires REAL, "
+            "PRIMARY KEY (namespace, key))")
+        return connection
+
+    def _execute(self, statement, parameters=()):
+        """Execute an SQL statement and return all resulting rows.
+
+        Returns `None` if the database cannot be used.
+        """
+        import sqlite3 # Not needed unless the cache is used
+        with self.lock:
+            try:
+                if self.connection is None:
+                    self.connection = self._connect()
+                with self.connection:
+                    return self.connection.execute(statement, parameters).fetchall()
+            except (sqlite3.Error, IOError, OSError):
+                return None
+
+    def get(self, namespace, key):
+        """Return the valid `CacheEntry` of the key, or `None`."""
+        now = time()
+        rows = self._execute("SELECT value, created, expires FROM entries WHERE namespace = ? AND key = ? AND expires > ?",
+            (namespace, key, now))
+        if not rows:
+            return None
+        value, created, expires = rows[0]
+        try:
+            value = loads(bytes(value))
+        except Exception:
+            # E.g. written by an incompatible version
+            return None
+        return CacheEntry(value, creation_time=created, cache_time=expires-created)
+
+    def set(self, namespace, key, value, cache_time):
+        """Store a value for `cache_time` seconds."""
+        import sqlite3
+        try:
+            data = sqlite3.Binary(dumps(value, 2))
+        except Exception:
+            # Not every value can be pickled
+            return
+        now = time()
+        self._execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+            (namespace, key, data, now, now + cache_time))
+
+    def remove(self, namespace, key):
+        self._execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def clean(self):
+        """Remove expired entries."""
+        self._execute("DELETE FROM entries WHERE expires <= ?", (time(),))
+
+    def flush(self, namespace=None):
+        """Remove all entries, or only those of the namespace."""
+        if namespace is None:
+            self._execute("DELETE FROM entries")
+        else:
+            self._execute("DELETE FROM entries WHERE namespace = ?", (namespace,))
+
+    def summary(self):
+        """Return a dictionary of the number of entries, expired entries and bytes per namespace."""
+        rows = self._execute("SELECT namespace, COUNT(*), SUM(expires <= ?), SUM(LENGTH(value)) "
+            "FROM entries GROUP BY namespace", (time(),))
+        if rows is None:
+            return {}
+        return dict((str(namespace), {'entries': entries, 'expired': int(expired or 0), 'bytes': int(size or 0)})
+            for namespace, entries, expired, size in rows)
 
 class Cache(object):
-    """A simple cache for function calls."""
+    """A cache for function calls.
+
+    Every decorated function has its own segment of the cache, which can be
+    configured with its own `cache_time`, `max_entries` and `max_size` (in
+    bytes, estimated). By default, the values given to the cache are used.
+    Expired entries are removed when they are accessed and regularly swept,
+    so long running processes do not accumulate them.
+
+    Entries are looked up by the tuple of the function arguments, so the
+    arguments should be hashable. Unhashable ones are pickled, which is slower.
+
+    If a `PersistentCache` is set as `persistent`, the entries of functions
+    with a `persistent_time` larger than 0 are also stored there for that many
+    seconds, and looked up there if they are not in memory. There the
+    qualified name of the function is used as namespace.
+    """
 
-    def __init__(self, cache_time=60):
-        """`cache_time` determines how long an entry will be cached."""
+    def __init__(self, cache_time=60, max_entries=0, max_size=0, persistent=None):
+        """`cache_time` determines how long an entry will be cached.
+
+        `max_entries` and `max_size` limit the size of each function's
+        segment of the cache. A limit of 0 means no limit.
+        """
         self.cache_time = cache_time
-        self.cache = {}
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.persistent = persistent
+        self.segments = {}
+        self.lock = threading.Lock()
+
+    def segment(self, function):
+        """Return the cache segment of the function."""
+        with self.lock:
+            if function not in self.segments:
+                self.segments[function] = CacheSegment(self.cache_time, self.max_entries, self.max_size,
+                    namespace=_namespace(function), method=_is_method(function))
+            return self.segments[function]
+
+    def configure(self, function, cache_time=None, max_entries=None, max_size=None, persistent_time=None):
+        """Set the cache times and limits of the function's segment."""
+        segment = self.segment(function)
+        if cache_time is not None:
+            segment.cache_time = cache_time
+        if max_entries is not None:
+            segment.max_entries = max_entries
+        if max_size is not None:
+            segment.max_size = max_size
+        if persistent_time is not None:
+            segment.persistent_time = persistent_time
 
     def clean(self):
         """Remove old entries from the cache."""
-        for key in self.cache.keys():
-            if not self.cache[key].is_valid():
-                del self.cache[key]
+        for segment in list(self.segments.values()):
+            segment.clean()
 
     def flush(self):
-        """Remove all entries from the cache."""
-        for key in self.cache.keys():
-            del self.cache[key]
+        """Remove all entries from the cache, including the persistent ones."""
+        for segment in list(self.segments.values()):
+            segment.flush()
+        if self.persistent is not None:
+            self.persistent.flush()
 
-    def hash(self, function, *args, **kwargs):
-        """Turn function parameters into a hash."""
-        return hash(dumps( (function.func_name, args, kwargs) ))
+    def key(self, function, *args, **kwargs):
+        """Turn function parameters into a key of the function's segment."""
+        return _key(args, kwargs)
 
-    def get_entry(self, function, *args, **kwargs):
-        """Get a valid entry from the cache or `None`."""
-        key = self.hash(function, *args, **kwargs)
-        if key in self.cache:
-            entry = self.cache[key]
-            if entry.is_valid():
-                return entry
-            else:
+    def _persistent_key(self, segment, args, kwargs):
+        """Return the key of the entry in the persistent cache, or `None`.
+
+        The key must be the same in all processes, so it is a digest of the
+        namespace and the pickled parameters rather than their tuple. The
+        instance of methods, e.g. the backend, is only identified by its
+        address, so it is replaced by what its `cache_identity()` method
+        returns. Methods of instances without one are not stored.
+        """
+        if self.persistent is None or segment.persistent_time <= 0:
+            return None
+        if segment.method:
+            identity = getattr(args[0], 'cache_identity', None)
+            if identity is None:
                 return None
-        else:
+            args = (identity(),) + tuple(args[1:])
+        digest = hashlib.sha1(segment.namespace.encode('utf-8'))
+        digest.update(_pickle(args, kwargs))
+        return digest.hexdigest()
+
+    def _get_persistent_entry(self, segment, key, args, kwargs):
+        """Get a valid entry from the persistent cache and keep it in memory, or `None`."""
+        persistent_key = self._persistent_key(segment, args, kwargs)
+        if persistent_key is None:
             return None
+        entry = self.persistent.get(segment.namespace, persistent_key)
+        if entry is not None:
+            segment.add(key, entry.value)
+        return entry
+
+    def _add_entry(self, segment, key, value, args, kwargs):
+        segment.add(key, value)
+        persistent_key = self._persistent_key(segment, args, kwargs)
+        if persistent_key is not None:
+            self.persistent.set(segment.namespace, persistent_key, value, segment.persistent_time)
+
+    def get_entry(self, function, *args, **kwargs):
+        """Get a valid entry from the cache or `None`."""
+        segment = self.segment(function)
+        key = _key(args, kwargs)
+        entry = segment.get(key)
+        if entry is None:
+            entry = self._get_persistent_entry(segment, key, args, kwargs)
+        return entry
 
     def add_entry(self, value, function, *args, **kwargs):
         """Add an entry to the cache."""
-        key = self.hash(function, *args, **kwargs)
-        self.cache[key] = CacheEntry(value, cache_time=self.cache_time)
+        self._add_entry(self.segment(function), _key(args, kwargs), value, args, kwargs)
+
+    def add_memory_entry(self, value, function, *args, **kwargs):
+        """Add an entry to the in-memory cache only.
+
+        For many small entries that are cheap to find out again, where a
+        write to the persistent cache each would cost more than it saves.
+        """
+        self.segment(function).add(_key(args, kwargs), value)
+
+    def remove_entry(self, function, *args, **kwargs):
+        """Remove an entry from the cache, if it is present."""
+        segment = self.segment(function)
+        segment.remove(_key(args, kwargs))
+        persistent_key = self._persistent_key(segment, args, kwargs)
+        if persistent_key is not None:
+            self.persistent.remove(segment.namespace, persistent_key)
 
-    def cached(self, function):
-        """Decorator to turn a regular function into a cached one."""
+    def cached(self, function=None, **settings):
+        """Decorator to turn a regular function into a cached one.
+
+        Can be used with the `cache_time`, `max_entries`, `max_size` and
+        `persistent_time` of the function as arguments:
+
+            @cache.cached(cache_time=600, max_entries=1000)
+            def function(...):
+        """
+
+        if function is None:
+            return lambda function: self.cached(function, **settings)
+        self.configure(function, **settings)
+        segment = self.segment(function)
 
         def cached_function(*args, **kwargs):
-            cached = kwargs.pop('cached', False)
-            if cached:
-                entry = self.get_entry(function, *args, **kwargs)
+            if kwargs.pop('cached', False):
+                key = _key(args, kwargs)
+                entry = segment.get(key)
+                if entry is None:
+                    entry = self._get_persistent_entry(segment, key, args, kwargs)
                 if entry is not None:
                     return entry.value
                 else:
                     value = function(*args, **kwargs)
-                    self.add_entry(value, function, *args, **kwargs)
+                    self._add_entry(segment, key, value, args, kwargs)
                     return value
             else:
                 return function(*args, **kwargs)
 
+        # Allow direct access to the entries of this function,
+        # e.g. to fill the cache with the results of bulk queries.
+        cached_function.get_entry = lambda *args, **kwargs: self.get_entry(function, *args, **kwargs)
+        cached_function.add_entry = lambda value, *args, **kwargs: self.add_entry(value, function, *args, **kwargs)
+        cached_function.add_memory_entry = lambda value, *args, **kwargs: self.add_memory_entry(value, function, *args, **kwargs)
+        cached_function.remove_entry = lambda *args, **kwargs: self.remove_entry(function, *args, **kwargs)
+        cached_function.segment = segment
+
         return cached_function
@@ -0,0 +1,187 @@
+"""Fast computation of checksums of local files and storage of replica checksums.
+
+The grid uses ADLER32 checksums. They are computed with `zlib.adler32`
+over large blocks of memory-mapped files, so no time is spent copying the
+data around. `zlib` releases the GIL while it works on large blocks, so
+many files can be checksummed concurrently by threads, e.g. by the parallel
+jobs of `t2kdm-verify`.
+
+Checksums of replicas are expensive to query, so they are remembered in a
+`ChecksumStore`.
+"""
+
+import os
+import mmap
+import zlib
+import threading
+from time import time, localtime
+
+# Size of the blocks passed to `zlib.adler32`
+blocksize = 16 * 1024**2
+
+try:
+    # Python 2: `zlib` does not accept memoryviews, but buffers
+    _buffer = buffer
+except NameError:
+    _buffer = None
+
+def _adler32_mapped(f, size):
+    """Checksum the memory-mapped file."""
+    value = 1
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if _buffer is not None:
+            for offset in range(0, size, blocksize):
+                value = zlib.adler32(_buffer(data, offset, blocksize), value)
+        else:
+            view = memoryview(data)
+            try:
+                for offset in range(0, size, blocksize):
+                    value = zlib.adler32(view[offset:offset+blocksize], value)
+            finally:
+                view.release()
+    finally:
+        data.close()
+    return value
+
+def _adler32_read(f):
+    """Checksum the file by reading it in large blocks."""
+    value = 1
+    while True:
+        data = f.read(blocksize)
+        if len(data) == 0:
+            break
+        value = zlib.adler32(data, value)
+    return value
+
+def adler32(filename):
+    """Return the ADLER32 checksum of a local file as hexadecimal string."""
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            value = 1
+        else:
+            try:
+                value = _adler32_mapped(f, size)
+            except (mmap.error, ValueError, OverflowError):
+                # Not mappable, e.g. a pipe or too large for the address space
+                f.seek(0)
+                value = _adler32_read(f)
+    return '%08x'%(value & 0xffffffff,)
+
+def equal(a, b):
+    """Compare two hexadecimal checksums, ignoring leading zeros and case.
+
+    Unknown checksums, like '?', are never equal.
+    """
+    try:
+        return int(a, 16) == int(b, 16)
+    except ValueError:
+        return False
+
+class ChecksumStore(object):
+    """Persistent store of replica checksums, keyed by surl.
+
+    The checksums are kept in an sqlite database, so they survive between
+    calls and can be shared by concurrent processes. Along with each checksum,
+    the size and modification day of the file in the catalogue can be stored.
+    Checksums older than `max_age` seconds are not returned, so they are
+    queried from the SE again eventually.
+
+    If no `filename` is provided, or `max_age` is 0, nothing is stored.
+    """
+
+    def __init__(self, filename=None, max_age=0):
+        self.filename = filename
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def __getstate__(self):
+        # The lock and connection cannot be pickled,
+        # but the cache needs to do that to hash the function arguments.
+        return {'filename': self.filename, 'max_age': self.max_age}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @property
+    def enabled(self):
+        return self.filename is not None and self.max_age > 0
+
+    def _execute(self, statement, parameters=()):
+        """Execute an SQL statement and return all resulting rows.
+
+        Returns `None` if the database cannot be used.
+        """
+        import sqlite3 # Not needed unless the store is used
+        with self.lock:
+            try:
+                if self.connection is None:
+                    directory = os.path.dirname(self.filename)
+                    if directory != '' and not os.path.isdir(directory):
+                        os.makedirs(directory)
+                    self.connection = sqlite3.connect(self.filename, timeout=60, check_same_thread=False)
+                    self.connection.execute("CREATE TABLE IF NOT EXISTS checksums ("
+                        "surl TEXT PRIMARY KEY, checksum TEXT, size INTEGER, modified INTEGER, checked REAL)")
+                with self.connection:
+                    return self.connection.execute(statement, parameters).fetchall()
+            except (sqlite3.Error, IOError, OSError):
+                # Not being able to remember is no reason to fail
+                return None
+
+    @staticmethod
+    def _day(modified):
+        """Turn a modification time into a day number, or `None` if it is unknown.
+
+        The catalogue only lists minutes of recent files and days of old ones.
+        """
+        if modified is None or modified != modified: # NaN
+            return None
+        # Catalogue times are local times
+        day = localtime(modified)
+        return day.tm_year * 1000 + day.tm_yday
+
+    def get(self, surl):
+        """Return the stored checksum of a replica, or `None`."""
+        if not self.enabled:
+            return None
+        rows = self._execute("SELECT checksum FROM checksums WHERE surl = ? AND checked > ?",
+            (surl, time() - self.max_age))
+        if not rows:
+            return None
+        return str(rows[0][0])
+
+    def set(self, surl, checksum, size=None, modified=None):
+        """Store the checksum of a replica.
+
+        Unknown checksums, like '?', are not stored.
+        """
+        if not self.enabled or '?' in checksum:
+            return
+        self._execute("INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?)",
+            (surl, checksum, size, self._day(modified), time()))
+
+    def validate(self, surl, size, modified):
+        """Forget the checksum if it was stored for a different version of the file.
+
+        `size` and `modified` describe the file in the catalogue as it is now.
+        If the stored checksum has no such information yet, it is assumed to
+        belong to the current version.
+        """
+        if not self.enabled:
+            return
+        day = self._day(modified)
+        rows = self._execute("SELECT size, modified FROM checksums WHERE surl = ?", (surl,))
+        if not rows:
+            return
+        stored_size, stored_day = rows[0]
+        if stored_size is None and stored_day is None:
+            self._execute("UPDATE checksums SET size = ?, modified = ? WHERE surl = ?", (size, day, surl))
+        elif stored_size != size or stored_day != day:
+            self.remove(surl)
+
+    def remove(self, surl):
+        """Forget the checksum of a replica."""
+        if self.enabled:
+            self._execute("DELETE FROM checksums WHERE surl = ?", (surl,))
@@ -6,6 +6,7 @@ import shlex
 import argparse
 import t2kdm
 import t2kdm.interactive
+from t2kdm import scheduling
 import sys
 from os import path
 import posixpath
@@ -42,6 +43,9 @@ class Command(object):
             self.parser = argparse.ArgumentParser(description=description)
         self.positional_arguments = []
         self.keyword_arguments = []
+        # Not passed on to the function
+        self.parser.add_argument('--stats', metavar='FILE', default=None,
+            help="record statistics of the grid operations and write them as JSON to FILE at exit")
 
     def add_argument(self, *args, **kwargs):
         """Add an argument to the parser and memorize how to pass parsed object to the original function.
@@ -64,16 +68,16 @@ class Command(object):
         # Add the arguments to the parser
         self.parser.add_argument(*args, **kwargs)
 
-    def run_from_console(self, **kwargs):
+    def run_from_console(self, arglist=None, **kwargs):
         """Entry point for console scripts.
 
-        Parses command line arguments from sys.argv.
+        Parses command line arguments from sys.argv, or `arglist` if provided.
         Prints output on screen.
         Returns error code (0 if successful).
         """
 
         try:
-            ret = self.run(self.parser.parse_args(), **kwargs)
+            ret = self.run(self.parser.parse_args(arglist), **kwargs)
         except t2kdm.backends.BackendException as e:
             print_(e, file=sys.stderr)
             return 1
@@ -131,6 +135,10 @@ class Command(object):
     def _condition_argument(name, value, localdir=None, remotedir=None):
         """Apply some processing to the arguments when needed."""
 
+        if value is None:
+            # Optional argument that was not given
+            return value
+
         # Make local paths absolute
         if localdir is not None and 'localpath' in name and not path.isabs(value):
             value = path.normpath(path.join(localdir, value))
@@ -159,6 +167,9 @@ class Command(object):
         localdir = kwargs.pop('localdir', None)
         remotedir = kwargs.pop('remotedir', None)
 
+        if getattr(parsed_args, 'stats', None) is not None:
+            t2kdm.backends.statistics.dump_at_exit(parsed_args.stats)
+
         pos_args = []
         for arg in self.positional_arguments:
             value = self._condition_argument(arg, getattr(parsed_args, arg), localdir=localdir, remotedir=remotedir)
@@ -213,6 +224,23 @@ check.add_argument('-s', '--se', action='append', default=[],
     help="report replication status to the given storage element, can be used multiple times")
 all_commands.append(check)
 
+verify = Command('verify', t2kdm.interactive.verify, "Compare local copies of files with the checksums in the catalogue.")
+verify.add_argument('remotepath', type=str,
+    help="the remote logical path, e.g. '/nd280'")
+verify.add_argument('localpath', type=str, nargs='?', default='./',
+    help="the local file or the directory the files were downloaded to, default: './'")
+verify.add_argument('-r', '--recursive', nargs='?', metavar="REGEX", default=False, const=True,
+    help="recursively verify all files and subdirectories [that match REGEX] of a directory")
+verify.add_argument('-q', '--quiet', action='store_true',
+    help="do not print problematic files to screen")
+verify.add_argument('-v', '--verbose', action='store_true',
+    help="print status messages to the screen")
+verify.add_argument('-l', '--list', metavar='FILENAME',
+    help="save a list of failed files to FILENAME")
+verify.add_argument('-j', '--jobs', type=int, default=1,
+    help="number of files to verify in parallel when working recursively, default: 1")
+all_commands.append(verify)
+
 replicate = Command('replicate', t2kdm.interactive.replicate, "Replicate file to a storage element.")
 replicate.add_argument('remotepath', type=str,
     help="the remote logical path, e.g. '/nd280/file.txt'")
@@ -230,6 +258,20 @@ replicate.add_argument('-v', '--verbose', action='store_true',
     help="print status messages to the screen")
 replicate.add_argument('-x', '--bringonline', action='store_true',
     help="do not wait for tape replicas to come online (EXPERT OPTION)")
+replicate.add_argument('-b', '--batch', type=int, default=0, metavar='N',
+    help="when working recursively, copy files in batches of N with a single bulk transfer each, tape replicas are brought online with a single request, overrides `--jobs`")
+replicate.add_argument('-a', '--ahead', type=int, default=0, metavar='N',
+    help="when working recursively, request the tape replicas of the next N files to be brought online while the current one is transferred")
+replicate.add_argument('-p', '--progress', type=float, default=0, metavar='SECONDS',
+    help="when working recursively, print the progress, throughput per storage element and ETA every SECONDS seconds, requires listing all files first")
+replicate.add_argument('-P', '--progressfile', metavar='FILENAME', default=None,
+    help="when working recursively, append the progress reports as lines of JSON to FILENAME, every 60 seconds unless specified with `--progress`")
+replicate.add_argument('-S', '--schedule', choices=scheduling.policies, default=None,
+    help="when working recursively, list all files first and copy them in the given order, planned so that all parallel jobs finish as early as possible, and print the predicted and actual duration; 'largest' first is usually fastest")
+replicate.add_argument('-d', '--plan', metavar='FILENAME', default=None,
+    help="do not change anything, but write the plan of what would be done to FILENAME as JSON and print its summary, e.g. the number of files and bytes per source and the estimated duration, the plan can be executed with `execute`")
+replicate.add_argument('-j', '--jobs', type=int, default=1,
+    help="number of files to transfer in parallel when working recursively, the number of concurrent transfers per storage element is limited by the `max_se_transfers` configuration")
 all_commands.append(replicate)
 
 get = Command('get', t2kdm.interactive.get, "Download file from grid.")
@@ -251,6 +293,26 @@ get.add_argument('-v', '--verbose', action='store_true',
     help="print status messages to the screen")
 get.add_argument('-x', '--bringonline', action='store_true',
     help="do not wait for tape replicas to come online (EXPERT OPTION)")
+get.add_argument('-y', '--sync', action='store_true',
+    help="skip local files that are identical to the remote ones (same size and ADLER32 checksum) and complete partially downloaded files where possible, overwrite the others")
+get.add_argument('-n', '--nbstreams', type=int, default=0, metavar='N',
+    help="number of parallel streams per download, 0 (default) chooses it automatically per storage element from the file size and the throughput of previous downloads")
+get.add_argument('-H', '--hedge', type=float, default=0, metavar='SECONDS',
+    help="if a download has not delivered half of the file after SECONDS, start a second one from the next closest disk replica and keep whichever finishes first, not used with `--batch` or `--source`")
+get.add_argument('-b', '--batch', type=int, default=0, metavar='N',
+    help="when working recursively, process files in batches of N: tape replicas are brought online with a single request and downloaded as soon as they are online, overrides `--jobs`")
+get.add_argument('-a', '--ahead', type=int, default=0, metavar='N',
+    help="when working recursively, request the tape replicas of the next N files to be brought online while the current one is transferred")
+get.add_argument('-p', '--progress', type=float, default=0, metavar='SECONDS',
+    help="when working recursively, print the progress, throughput per storage element and ETA every SECONDS seconds, requires listing all files first")
+get.add_argument('-P', '--progressfile', metavar='FILENAME', default=None,
+    help="when working recursively, append the progress reports as lines of JSON to FILENAME, every 60 seconds unless specified with `--progress`")
+get.add_argument('-S', '--schedule', choices=scheduling.policies, default=None,
+    help="when working recursively, list all files first and download them in the given order, planned so that all parallel jobs finish as early as possible, and print the predicted and actual duration; 'largest' first is usually fastest")
+get.add_argument('-d', '--plan', metavar='FILENAME', default=None,
+    help="do not change anything, but write the plan of what would be done to FILENAME as JSON and print its summary, e.g. the number of files and bytes per source and the estimated duration, the plan can be executed with `execute`")
+get.add_argument('-j', '--jobs', type=int, default=1,
+    help="number of files to transfer in parallel when working recursively, the number of concurrent transfers per storage element is limited by the `max_se_transfers` configuration")
 all_commands.append(get)
 
 put = Command('put', t2kdm.interactive.put, "Upload file to the grid.")
@@ -280,10 +342,34 @@ remove.add_argument('-l', '--list', metavar='FILENAME',
     help="save a list of failed files to FILENAME")
 remove.add_argument('-v', '--verbose', action='store_true',
     help="print status messages to the screen")
+remove.add_argument('-d', '--plan', metavar='FILENAME', default=None,
+    help="do not change anything, but write the plan of what would be done to FILENAME as JSON and print its summary, e.g. the number of files and bytes per source and the estimated duration, the plan can be executed with `execute`")
 remove.add_argument('-x', '--unregister',
     help="unregister only, do NOT try to delete the actual replica (EXPERT OPTION)")
 all_commands.append(remove)
 
+execute = Command('execute', t2kdm.interactive.execute, "Carry out a plan made with the `--plan` option of replicate, get or remove.")
+execute.add_argument('planfile', type=str,
+    help="the plan file")
+execute.add_argument('-j', '--jobs', type=int, default=1,
+    help="number of files to process in parallel, default: 1")
+execute.add_argument('-v', '--verbose', action='store_true',
+    help="print status messages to the screen")
+execute.add_argument('-l', '--list', metavar='FILENAME',
+    help="save a list of failed files to FILENAME")
+all_commands.append(execute)
+
+cache = Command('cache', t2kdm.interactive.cache, "Inspect, warm or flush the cache of catalogue queries that is shared between commands.")
+cache.add_argument('action', type=str, choices=['inspect', 'warm', 'flush'],
+    help="'inspect' the number and size of the cached entries, 'warm' the cache with the listing and replicas of a path, or 'flush' it")
+cache.add_argument('remotepath', type=str, nargs='?', default=None,
+    help="the remote logical path to warm the cache with, e.g. '/nd280/file.txt'")
+cache.add_argument('-r', '--recursive', nargs='?', metavar="REGEX", default=False, const=True,
+    help="recursively warm the cache with all files and subdirectories [that match REGEX] of a directory")
+cache.add_argument('-v', '--verbose', action='store_true',
+    help="print status messages to the screen")
+all_commands.append(cache)
+
 fix = Command('fix', t2kdm.interactive.fix, "Try to fix some common issues with a file.")
 fix.add_argument('remotepath', type=str,
     help="the remote logical path, e.g. '/nd280/file.txt'")
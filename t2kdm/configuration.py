@@ -2,8 +2,8 @@
 
 from six.moves import configparser, input
 from six import print_
-from appdirs import AppDirs
-app_dirs = AppDirs('t2kdm', 't2k.org')
+# Also needed by the console commands before `t2kdm` is loaded
+from t2kdm_client import app_dirs, find_config_file
 import os
 from os import path
 
@@ -13,11 +13,16 @@ default_values = {
     'location':     '/',
     'maid_config':  path.join(app_dirs.user_config_dir, 'maid.conf'),
     'blacklist':    '-',
+    'max_se_transfers': '4',
+    'local_root':   path.join(app_dirs.user_data_dir, 'local'),
+    'checksum_max_age': '30',
+    'shared_cache': 'no',
 }
 
 descriptions = {
     'backend':      "Which backend should be used?\n"\
-                    "Supported backends: gfal, lcg",
+                    "Supported backends: gfal, gfal2, gfal-async, lcg, local\n"\
+                    "The local backend emulates the grid on the local file system for testing.",
     'basedir':      "What base directory should be assumed for all files on the grid?",
     'location':     "What is your location?\n"\
                     "This is used to determine the closest storage element when downloading files.\n"\
@@ -32,6 +37,20 @@ descriptions = {
                     "They can still be specified explicitly.\n"\
                     "Provide the list as whitespace-separated list of SE names.\n"\
                     "Example: UKI-LT2-QMUL2-disk UKI-NORTHGRID-SHEF-HEP-disk",
+    'max_se_transfers': "How many transfers may run concurrently from or to a single storage element?\n"\
+                    "This only matters when transferring files in parallel, e.g. with `t2kdm-replicate -j`.\n"\
+                    "0 means no limit.",
+    'local_root':   "Where the local backend stores its emulated file catalogue and storage elements.\n"\
+                    "Only used with the local backend. Latencies, failure rates and tape delays\n"\
+                    "can be set in the file 'settings.json' in that directory.",
+    'checksum_max_age': "For how many days should the checksums of replicas be remembered?\n"\
+                    "Stored checksums are not queried from the storage elements again,\n"\
+                    "unless the file in the catalogue changed its size or modification day.\n"\
+                    "0 means checksums are always queried.",
+    'shared_cache': "Should the results of catalogue queries be shared between commands (yes/no)?\n"\
+                    "They are kept in a cache on disk for up to an hour, so many short commands\n"\
+                    "do not repeat the same queries. Changes made by others may show up late.\n"\
+                    "The cache can be inspected and flushed with `t2kdm-cache`.",
 }
 
 class Configuration(object):
@@ -87,17 +106,9 @@ class ConfigurationError(Exception):
 def load_config():
     """Load the standard configuration."""
 
-    # Try different paths to find the configuration file
-    for testpath in [
-            path.join(os.getcwd(), '.t2kdm.conf'), # 1. ./.t2kdm.conf
-            path.join(app_dirs.user_config_dir, 't2kdm.conf'), # 2. user_config_dir, on linux: ~/.config/t2kdm/t2kdm.conf
-            path.join(app_dirs.site_config_dir, 't2kdm.conf'), # 2. site_config_dir, on linux: /etc/t2kdm/t2kdm.conf
-            ]:
-        if path.isfile(testpath):
-            return Configuration(testpath, defaults=default_values)
-
-    # Did not find any file, return default configuration
-    return Configuration(defaults=default_values)
+    filename = find_config_file()
+    # Without a file, this is the default configuration
+    return Configuration(filename, defaults=default_values)
 
 def run_configuration_wizard():
     """Run a configuration wizard to create a valid configuration file."""
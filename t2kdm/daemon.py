@@ -0,0 +1,197 @@
+"""A daemon serving the commands from a warm backend and cache.
+
+Every call of a `t2kdm-*` command has to start Python, load the
+configuration and backend, and starts with an empty cache. The
+`t2kdm-daemon` keeps all of that in memory and runs the commands it
+receives on a Unix domain socket. The console commands forward their
+arguments to the daemon if it is running, and print its output. The client
+side is in the `t2kdm_client` module, which does not load `t2kdm` itself.
+
+Only short, read-only commands are forwarded, see `forwarded_commands`.
+The daemon runs one command at a time in the working directory of the
+calling process. If it is busy, the caller runs the command itself.
+Commands are only forwarded if the caller would use the same configuration
+file as the daemon. If the caller goes away, e.g. because it is interrupted,
+the command is stopped when it writes its next output.
+
+Messages are lines of JSON. The client sends the request:
+
+    {"command": "ls", "args": ["-l", "/"], "cwd": "/home/user", "config": "/home/user/.config/t2kdm/t2kdm.conf", "prog": "t2kdm-ls"}
+
+The daemon replies with any number of output messages, followed by the exit code:
+
+    {"out": "..."}
+    {"err": "..."}
+    {"exit": 0}
+
+If it does not want to run the command, it replies `{"refused": "reason"}`.
+"""
+
+import os, sys
+import errno
+import socket
+import threading
+import json
+import argparse
+from six import print_
+from six.moves import socketserver
+from t2kdm_client import default_socket, forwarded_commands, find_config_file, _text, is_running, _request, forward, stop
+
+class _Disconnected(IOError):
+    """The client went away. Looks like a broken pipe to the commands."""
+    pass
+
+class _SocketOutput(object):
+    """File-like object sending everything written to it as JSON messages."""
+
+    def __init__(self, wfile, key):
+        self.wfile = wfile
+        self.key = key
+
+    def write(self, data):
+        data = _text(data)
+        if len(data) > 0:
+            try:
+                self.wfile.write((json.dumps({self.key: data}) + '\n').encode('utf-8'))
+                self.wfile.flush()
+            except socket.error:
+                # The client is gone, stop the command like a broken pipe would
+                raise _Disconnected(errno.EPIPE, "Client disconnected.")
+
+    def flush(self):
+        try:
+            self.wfile.flush()
+        except socket.error:
+            raise _Disconnected(errno.EPIPE, "Client disconnected.")
+
+    def isatty(self):
+        return False
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Handle a single request to the daemon."""
+
+    def send(self, **message):
+        self.wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+    def handle(self):
+        try:
+            request = json.loads(_text(self.rfile.readline()))
+        except ValueError:
+            return
+        if request.get('stop', False):
+            self.send(exit=0)
+            threading.Thread(target=self.server.shutdown).start()
+            return
+        message = self.server.run(request, self.wfile)
+        try:
+            self.send(**message)
+        except socket.error:
+            # Nobody is listening anymore
+            pass
+
+class Daemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serve the commands on the Unix socket `path`."""
+
+    daemon_threads = True
+
+    def __init__(self, path=default_socket):
+        directory = os.path.dirname(path)
+        if directory != '' and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.exists(path):
+            if is_running(path):
+                raise RuntimeError("Daemon is already running on %s."%(path,))
+            # Left over from a daemon that did not shut down cleanly
+            os.remove(path)
+        socketserver.UnixStreamServer.__init__(self, path, _RequestHandler)
+        # Only the user may talk to the daemon
+        os.chmod(path, 0o600)
+        self.path = path
+        self.config_file = find_config_file()
+        self.lock = threading.Lock()
+
+    def run(self, request, wfile):
+        """Run the requested command, sending its output to `wfile`.
+
+        Returns the final message.
+        """
+        # Import here, so clients do not need to load the commands
+        import t2kdm.commands
+
+        commands = dict((command.name, command) for command in t2kdm.commands.all_commands)
+        command = commands.get(request.get('command', None), None)
+        if command is None or command.name not in forwarded_commands:
+            return {'refused': "Unknown command."}
+        if request.get('config', None) != self.config_file:
+            return {'refused': "Different configuration file."}
+        if not self.lock.acquire(False):
+            return {'refused': "Busy."}
+
+        stdout = sys.stdout
+        stderr = sys.stderr
+        cwd = os.getcwd()
+        prog = command.parser.prog
+        try:
+            # Help and error messages should show the name of the calling command
+            command.parser.prog = request.get('prog', prog)
+            sys.stdout = _SocketOutput(wfile, 'out')
+            sys.stderr = _SocketOutput(wfile, 'err')
+            os.chdir(request['cwd'])
+            try:
+                ret = command.run_from_console(arglist=request['args'])
+            except SystemExit as e:
+                # E.g. argparse errors or help messages
+                ret = e.code
+            except Exception as e:
+                print_("%s: %s"%(type(e).__name__, e), file=sys.stderr)
+                ret = 1
+            sys.stdout.flush()
+        except _Disconnected:
+            ret = 1
+        finally:
+            sys.stdout = stdout
+            sys.stderr = stderr
+            os.chdir(cwd)
+            command.parser.prog = prog
+            self.lock.release()
+        return {'exit': ret}
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+def run_daemon():
+    """Entry point of the `t2kdm-daemon` command."""
+
+    parser = argparse.ArgumentParser(description="Serve the t2kdm commands from a persistent process. "\
+        "While it is running, the console commands forward their arguments to the daemon.")
+    parser.add_argument('-s', '--socket', default=default_socket,
+        help="the Unix socket to listen on, default: %s"%(default_socket,))
+    parser.add_argument('-x', '--stop', action='store_true',
+        help="stop the running daemon")
+    args = parser.parse_args()
+
+    if args.stop:
+        if stop(args.socket):
+            return 0
+        print_("No daemon running on %s."%(args.socket,), file=sys.stderr)
+        return 1
+
+    try:
+        daemon = Daemon(args.socket)
+    except RuntimeError as e:
+        print_(e, file=sys.stderr)
+        return 1
+    # Load everything before the first request
+    import t2kdm.commands
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+    return 0
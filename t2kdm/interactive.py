@@ -4,28 +4,131 @@ See 'commands' module for descriptions of the parameters.
 """
 
 from six import print_
+from six.moves import map
 import re
+import os
+import posixpath
+from time import time
+from multiprocessing.pool import ThreadPool
+from threading import Semaphore
 import t2kdm
 from t2kdm import storage
 from t2kdm import utils
 from t2kdm import backends
+from t2kdm import checksums
+from t2kdm import scheduling
+from t2kdm import planning
+from t2kdm.progress import Progress, format_duration, format_bytes
 
 class InteractiveException(Exception):
     """Exception to be raised for interactive errors, e.g. an illegal user argument."""
     pass
 
 class _recursive(object):
-    """Decorator to make a function work recursively."""
-
-    def __init__(self, iterating="Iterating over", iterated="Succesfully iterated over"):
+    """Decorator to make a function work recursively.
+
+    The files are processed in chunks of `chunk_size`. If a `prefetch` function
+    is provided, it is called with the list of remote paths of each chunk (and
+    all other arguments of the original function) before the chunk is processed.
+    This can be used to query information of many files at once.
+
+    If the `jobs` keyword argument is larger than 1, the files are processed
+    concurrently by that many threads.
+
+    If a `batch` function is provided and the `batch` keyword argument is
+    larger than 0, the files are processed in chunks of that size by the batch
+    function instead of the original one. It is called with the list of remote
+    paths (and all other arguments) and must return an iterable of
+    `(remotepath, return_value, exception)` tuples.
+
+    If a `lookahead` function is provided and the `ahead` keyword argument is
+    larger than 0, it is called with the iterator of remote paths, the value
+    of `ahead` and all other arguments. It must return an iterator over the
+    same paths, and can use the knowledge of the upcoming files, e.g. to bring
+    them online ahead of time.
+
+    If the `progress` keyword argument is larger than 0, the progress is
+    reported every that many seconds, see `t2kdm.progress.Progress`. If a
+    `progressfile` is given, the reports are also written to that file,
+    every 60 seconds unless specified otherwise. Reporting the progress
+    requires listing all files before they are processed.
+
+    If the `schedule` keyword argument is one of the `scheduling.policies`,
+    all files are listed first and processed in the order planned by
+    `scheduling.schedule`, e.g. largest first. As in the schedule, each of
+    the `jobs` threads starts the next file as soon as it is free, instead of
+    waiting for the end of a chunk. The predicted and actual duration are
+    printed. If a `sources` function is provided, it is called
+    with the list of remote paths and all other arguments, and must return a
+    dictionary of the source SE names of the paths and the name of the
+    destination, so the schedule can take the throughput of the sources
+    into account.
+
+    If the `plan` keyword argument is a filename, nothing is changed. Instead,
+    the plan of what would be done to the files is written to that file and
+    its summary is printed, see `t2kdm.planning`. This requires the name of
+    the `operation` known by the planning module.
+
+    If `sized` is `True`, the size of each file as known from the listing is
+    passed to the function as `size` keyword argument when working
+    recursively, so it does not need to be queried again. The batch function
+    gets a dictionary of the sizes of its files as `sizes` keyword argument.
+    """
+
+    chunk_size = 100
+    progress_interval = 60
+
+    def __init__(self, iterating="Iterating over", iterated="Succesfully iterated over", prefetch=None, batch=None, lookahead=None, sources=None, operation=None, sized=False):
         self.iterating = iterating
         self.iterated = iterated
+        self.prefetch = prefetch
+        self.batch = batch
+        self.lookahead = lookahead
+        self.sources = sources
+        self.operation = operation
+        self.sized = sized
         self.function = None
 
+    def write_plan(self, filename, remotepath, recursive, regex, workers, *args, **kwargs):
+        """Write the plan of the operation to the file and print its summary."""
+        if recursive is True:
+            files = [(path, max(entry.size, 0)) for path, entry in utils.remote_iter_recursively(remotepath, regex, entries=True)]
+        else:
+            files = [(remotepath, t2kdm.backend._file_size(remotepath))]
+        plan = planning.make_plan(self.operation, files, args, kwargs, workers=workers)
+        try:
+            planning.save(plan, filename)
+        except (IOError, OSError) as e:
+            raise InteractiveException("Could not write plan: %s"%(e,))
+        planning.print_summary(plan)
+        return 0
+
+    def plan(self, paths, sizes, policy, workers, *args, **kwargs):
+        """Order the paths according to the scheduling policy and print the prediction.
+
+        Returns the ordered paths and the predicted duration.
+        """
+        if self.sources is not None:
+            sources, destination = self.sources(paths, *args, **kwargs)
+        else:
+            sources, destination = {}, 'local'
+        paths, duration = scheduling.schedule(paths, sizes, sources, destination,
+            workers=workers, per_source=t2kdm.backend.transfer_slots.limit, policy=policy)
+        print_("Scheduled %d files (%s) on %d workers, %s first. Predicted duration: %s"%(
+            len(paths), format_bytes(sum(sizes.values())), workers, policy, format_duration(duration)))
+        return paths, duration
+
     def recursive_function(self, remotepath, *args, **kwargs):
         """The recursive wrapper around the original function."""
         recursive = kwargs.pop('recursive', False)
         list_file = kwargs.pop('list', None)
+        jobs = kwargs.pop('jobs', 1)
+        batch = kwargs.pop('batch', 0)
+        ahead = kwargs.pop('ahead', 0)
+        progress_interval = kwargs.pop('progress', 0)
+        progress_file = kwargs.pop('progressfile', None)
+        policy = kwargs.pop('schedule', None)
+        plan_file = kwargs.pop('plan', None)
         if 'verbose' in kwargs:
             verbose = kwargs['verbose']
         else:
@@ -37,29 +140,147 @@ class _recursive(object):
         else:
             regex = None
 
+        if plan_file is not None:
+            if batch > 0 and self.batch is not None:
+                workers = 1
+            else:
+                workers = max(jobs, 1)
+            return self.write_plan(plan_file, remotepath, recursive, regex, workers, *args, **kwargs)
+
         if list_file is not None:
             list_file = open(list_file, 'wt')
 
+        # Sizes of the listed files that are not done yet
+        sizes = {}
+
+        def call(path):
+            """Call the function and return the path, return value and exception."""
+            if verbose:
+                print_(self.iterating + " " + path)
+            call_kwargs = kwargs
+            if self.sized and sizes.get(path, 0) > 0:
+                call_kwargs = dict(kwargs)
+                call_kwargs['size'] = sizes[path]
+            try:
+                return path, self.function(path, *args, **call_kwargs), None
+            except Exception as e:
+                return path, None, e
+
+        def listed():
+            """Iterate over the paths and remember their sizes."""
+            for path, entry in utils.remote_iter_recursively(remotepath, regex, entries=True):
+                sizes[path] = max(entry.size, 0)
+                yield path
+
+        # Free workers, so the lookahead does not get further ahead than requested
+        slots = Semaphore(max(jobs, 1))
+        stopped = []
+
+        def bounded(paths):
+            """Iterate over the paths, but only as fast as the workers take them."""
+            for path in paths:
+                slots.acquire()
+                if len(stopped) > 0:
+                    return
+                yield path
+
         good = 0
         bad = 0
         if recursive is True:
-            for path in utils.remote_iter_recursively(remotepath, regex):
-                if verbose:
-                    print_(self.iterating + " " + path)
-                try:
-                    ret = self.function(path, *args, **kwargs)
-                except Exception as e:
-                    print_(e)
-                    bad += 1
-                    if list_file is not None:
-                        list_file.write(path + '\n')
+            lookahead = (ahead > 0 and self.lookahead is not None)
+            workers = 1
+            if batch > 0 and self.batch is not None:
+                pool = None
+                chunk_size = batch
+            elif jobs > 1:
+                pool = ThreadPool(jobs)
+                workers = jobs
+                if lookahead:
+                    # Do not get further ahead than requested
+                    chunk_size = jobs
+                else:
+                    chunk_size = max(self.chunk_size, 4*jobs)
+            else:
+                pool = None
+                if lookahead:
+                    chunk_size = 1
                 else:
-                    if ret == 0:
-                        good += 1
+                    chunk_size = self.chunk_size
+            progress = None
+            predicted = None
+            try:
+                if progress_interval > 0 or progress_file is not None or policy is not None:
+                    # The ETA and the schedule need the sizes, so list everything first
+                    paths = list(listed())
+                    if policy is not None:
+                        paths, predicted = self.plan(paths, sizes, policy, workers, *args, **kwargs)
+                    start_time = time()
+                    if progress_interval > 0 or progress_file is not None:
+                        if progress_interval <= 0:
+                            progress_interval = self.progress_interval
+                        progress = Progress(len(paths), sum(sizes.values()), interval=progress_interval,
+                            filename=progress_file, stats=backends.statistics)
+                        progress.start()
+                else:
+                    paths = listed()
+                # The schedule assumes that the workers start the next file as soon
+                # as they are free, so the files are not processed in chunks then
+                continuous = (policy is not None and pool is not None)
+                if continuous and self.prefetch is not None:
+                    self.prefetch(paths, *args, **kwargs)
+                if lookahead:
+                    paths = self.lookahead(paths, ahead, *args, **kwargs)
+                if continuous:
+                    if lookahead:
+                        paths = bounded(paths)
+                    chunks = [paths]
+                else:
+                    chunks = utils.iter_chunks(paths, chunk_size)
+                for chunk in chunks:
+                    if self.prefetch is not None and not continuous:
+                        self.prefetch(chunk, *args, **kwargs)
+                    if batch > 0 and self.batch is not None:
+                        if verbose:
+                            for path in chunk:
+                                print_(self.iterating + " " + path)
+                        batch_kwargs = kwargs
+                        if self.sized:
+                            batch_kwargs = dict(kwargs)
+                            batch_kwargs['sizes'] = dict((path, sizes[path]) for path in chunk if sizes.get(path, 0) > 0)
+                        results = self.batch(chunk, *args, **batch_kwargs)
+                    elif pool is None:
+                        results = map(call, chunk)
                     else:
-                        bad += 1
-                        if list_file is not None:
-                            list_file.write(path + '\n')
+                        results = pool.imap_unordered(call, chunk)
+                    # Results are counted in this thread only, so no locking is needed
+                    for path, ret, error in results:
+                        if error is not None:
+                            print_(error)
+                            bad += 1
+                            if list_file is not None:
+                                list_file.write(path + '\n')
+                        elif ret == 0:
+                            good += 1
+                        else:
+                            bad += 1
+                            if list_file is not None:
+                                list_file.write(path + '\n')
+                        if progress is not None:
+                            progress.done(sizes[path], failed=(error is not None or ret != 0))
+                        sizes.pop(path, None)
+                        slots.release()
+            finally:
+                # Let a blocked `bounded` iterator finish, so the pool can be terminated
+                stopped.append(True)
+                for i in range(workers):
+                    slots.release()
+                if pool is not None:
+                    pool.terminate()
+                    pool.join()
+                if progress is not None:
+                    progress.stop()
+            if predicted is not None:
+                print_("Finished after %s. Predicted duration: %s"%(format_duration(time() - start_time), format_duration(predicted)))
             if verbose:
                 print_("%s %d files. %d files failed."%(self.iterated, good, bad))
             if list_file is not None:
@@ -80,11 +301,28 @@ class _recursive(object):
         self.function = function
         return self.recursive_function
 
+def _iter_ls_cached(*args, **kwargs):
+    """Iterate over the listing and add it to the cache once it is complete.
+
+    So e.g. the `t2kdm-daemon` can serve it from memory next time.
+    """
+    listing = backends.Listing()
+    for entry in t2kdm.iter_ls(*args, **kwargs):
+        listing.append(entry)
+        yield entry
+    t2kdm.backend.ls.add_entry(listing, t2kdm.backend, *args, **kwargs)
+
 def ls(*args, **kwargs):
     """Print the contents of a directory on screen."""
 
     long = kwargs.pop('long', False)
-    entries = t2kdm.ls(*args, **kwargs)
+    # Use the cached listing if there is one, e.g. from `t2kdm-cache warm`
+    entry = t2kdm.backend.ls.get_entry(t2kdm.backend, *args, **kwargs)
+    if entry is not None:
+        entries = entry.value
+    else:
+        # Print entries as they come in, even for huge directories
+        entries = _iter_ls_cached(*args, **kwargs)
     if long:
         # Detailed listing
         for e in entries:
@@ -108,7 +346,7 @@ def replicas(*args, **kwargs):
     checksum = kwargs.pop('checksum', False)
     state = kwargs.pop('state', False)
     name = kwargs.pop('name', False)
-    reps = t2kdm.replicas(*args, **kwargs)
+    reps = t2kdm.replicas(*args, cached=True, **kwargs)
     for r in reps:
         if checksum:
             print_(t2kdm.checksum(r), end=' ')
@@ -123,7 +361,65 @@ def replicas(*args, **kwargs):
         print_(r)
     return 0
 
-@_recursive("Replicating", "Replicated")
+def _replicate_batch(remotepaths, *args, **kwargs):
+    """Replicate many files at once."""
+
+    bringonline = kwargs.pop('bringonline', False)
+    verbose = kwargs.pop('verbose', False)
+    kwargs['verbose'] = verbose
+
+    if bringonline:
+        timeout = 2
+    else:
+        timeout = 60*60*6
+
+    results = t2kdm.backend.replicate_many(remotepaths, *args, bringonline_timeout=timeout, **kwargs)
+    for path in remotepaths:
+        ret = results[path]
+        if isinstance(ret, Exception):
+            yield path, None, ret
+        elif ret is False:
+            yield path, 1, None
+        else:
+            yield path, 0, None
+
+def _replicate_lookahead(remotepaths, ahead, destination, *args, **kwargs):
+    """Bring the next files online while replicating the current one."""
+
+    if kwargs.get('bringonline', False):
+        timeout = 2
+    else:
+        timeout = 60*60*6
+
+    return t2kdm.backend.stage_ahead(remotepaths, ahead,
+        source=kwargs.get('source', None),
+        destination=destination,
+        tape=kwargs.get('tape', False),
+        timeout=timeout,
+        verbose=kwargs.get('verbose', False))
+
+def _replicate_sources(remotepaths, destination, *args, **kwargs):
+    """Return the source SEs of the files and the destination SE name."""
+    dst = storage.get_SE(destination)
+    if dst is None:
+        raise InteractiveException("Could not find storage element %s."%(destination,))
+    return _file_sources(remotepaths, kwargs.get('source', None), dst.name, kwargs.get('tape', False)), dst.name
+
+def _file_sources(remotepaths, source, destination, tape):
+    """Return a dictionary of the names of the SEs the files will be copied from.
+
+    The `destination` SE is `None` for downloads.
+    """
+    ret = {}
+    replicas = t2kdm.backend.replicas_many(remotepaths, cached=True)
+    for path, reps in replicas.items():
+        try:
+            ret[path] = t2kdm.backend.get_file_source(path, source, destination, tape=tape, replicas=reps)[1].name
+        except backends.BackendException:
+            pass
+    return ret
+
+@_recursive("Replicating", "Replicated", batch=_replicate_batch, lookahead=_replicate_lookahead, sources=_replicate_sources, operation='replicate', sized=True)
 def replicate(remotepath, *args, **kwargs):
     """Replicate files to a storage element."""
 
@@ -142,7 +438,49 @@ def replicate(remotepath, *args, **kwargs):
     else:
         return 0
 
-@_recursive("Getting", "Downloaded")
+def _get_batch(remotepaths, *args, **kwargs):
+    """Download many files at once."""
+
+    bringonline = kwargs.pop('bringonline', False)
+    verbose = kwargs.pop('verbose', False)
+    kwargs['verbose'] = verbose
+    # Only single downloads are hedged
+    kwargs.pop('hedge', None)
+
+    if bringonline:
+        timeout = 2
+    else:
+        timeout = 60*60*6
+
+    results = t2kdm.backend.get_many(remotepaths, *args, bringonline_timeout=timeout, **kwargs)
+    for path in remotepaths:
+        ret = results[path]
+        if isinstance(ret, Exception):
+            yield path, None, ret
+        elif ret is False:
+            yield path, 1, None
+        else:
+            yield path, 0, None
+
+def _get_lookahead(remotepaths, ahead, *args, **kwargs):
+    """Bring the next files online while downloading the current one."""
+
+    if kwargs.get('bringonline', False):
+        timeout = 2
+    else:
+        timeout = 60*60*6
+
+    return t2kdm.backend.stage_ahead(remotepaths, ahead,
+        source=kwargs.get('source', None),
+        tape=kwargs.get('tape', False),
+        timeout=timeout,
+        verbose=kwargs.get('verbose', False))
+
+def _get_sources(remotepaths, *args, **kwargs):
+    """Return the source SEs of the files and the destination 'local'."""
+    return _file_sources(remotepaths, kwargs.get('source', None), None, kwargs.get('tape', False)), 'local'
+
+@_recursive("Getting", "Downloaded", batch=_get_batch, lookahead=_get_lookahead, sources=_get_sources, operation='get', sized=True)
 def get(remotepath, *args, **kwargs):
     """Download files."""
 
@@ -169,7 +507,7 @@ def put(*args, **kwargs):
     else:
         return 1
 
-@_recursive("Removing", "Removed")
+@_recursive("Removing", "Removed", operation='remove')
 def remove(remotepath, *args, **kwargs):
     """Remove a file from a given SE."""
     verbose = kwargs.pop('verbose', False)
@@ -181,7 +519,78 @@ def remove(remotepath, *args, **kwargs):
     else:
         return 1
 
-@_recursive("Checking", "No problems detected for")
+def execute(planfile, jobs=1, verbose=False, list=None):
+    """Carry out a plan made with the `plan` option of replicate, get or remove."""
+
+    try:
+        plan = planning.load(planfile)
+    except (IOError, OSError, ValueError) as e:
+        raise InteractiveException("Could not load plan: %s"%(e,))
+    function = {'replicate': replicate, 'get': get, 'remove': remove}[plan['operation']]
+    entries = [e for e in plan['files'] if e['action'] not in ('skip', 'fail')]
+    if verbose:
+        print_("Skipping %d files that needed no action and %d files that were planned to fail."%(
+            plan['summary']['skipped_files'], plan['summary']['failing_files']))
+
+    def call(entry):
+        args = plan['args']
+        kwargs = dict(plan['kwargs'])
+        kwargs['verbose'] = verbose or kwargs.get('verbose', False)
+        if plan['operation'] != 'remove':
+            # The source was chosen and the size and replicas known when planning.
+            # Other sources are still tried if the chosen one fails.
+            kwargs['preferred'] = entry['source']
+            kwargs['size'] = entry['size']
+            if 'replicas' in entry:
+                kwargs['replicas'] = entry['replicas']
+        if 'localpath' in entry:
+            args = [entry['localpath']]
+        if verbose:
+            print_("Executing %s of %s"%(plan['operation'], entry['path']))
+        try:
+            return entry['path'], function(entry['path'], *args, **kwargs), None
+        except Exception as e:
+            return entry['path'], None, e
+
+    if list is not None:
+        list = open(list, 'wt')
+    good = 0
+    bad = 0
+    pool = ThreadPool(max(jobs, 1))
+    try:
+        for path, ret, error in pool.imap_unordered(call, entries):
+            if error is not None:
+                print_(error)
+            if error is None and ret == 0:
+                good += 1
+            else:
+                bad += 1
+                if list is not None:
+                    list.write(path + '\n')
+    finally:
+        pool.terminate()
+        pool.join()
+        if list is not None:
+            list.close()
+    if verbose:
+        print_("Executed %s of %d files. %d files failed."%(plan['operation'], good, bad))
+    if bad == 0:
+        return 0
+    else:
+        return 1
+
+def _prefetch_check(remotepaths, *args, **kwargs):
+    """Query the replicas and checksums of many files at once."""
+
+    replicas = t2kdm.backend.replicas_many(remotepaths, cached=True)
+    if kwargs.get('checksum', False):
+        surls = []
+        for path, reps in replicas.items():
+            utils.validate_stored_checksums(path, reps, cached=True)
+            surls.extend(reps)
+        t2kdm.backend.checksum_many(surls, cached=True)
+
+@_recursive("Checking", "No problems detected for", prefetch=_prefetch_check)
 def check(remotepath, *args, **kwargs):
     """Check if everything is alright with the files."""
 
@@ -193,7 +602,7 @@ def check(remotepath, *args, **kwargs):
     if checksum == False and len(ses) == 0:
         raise InteractiveException("No check specified.")
 
-    if t2kdm.is_dir(remotepath):
+    if t2kdm.is_dir(remotepath, cached=True):
         raise InteractiveException("%s is a directory. Maybe you want to use the `--recursive` option?"%(remotepath,))
 
     if verbose and len(ses) > 0:
@@ -215,7 +624,55 @@ def check(remotepath, *args, **kwargs):
     else:
         return 1
 
-@_recursive("Fixing", "Fixed")
+def _prefetch_verify(remotepaths, *args, **kwargs):
+    """Query the replicas and their checksums of many files at once."""
+    _prefetch_check(remotepaths, checksum=True)
+
+@_recursive("Verifying", "Verified", prefetch=_prefetch_verify)
+def verify(remotepath, localpath, *args, **kwargs):
+    """Compare the checksum of a local copy with the checksums in the catalogue."""
+
+    verbose = kwargs.pop('verbose', False)
+    quiet = kwargs.pop('quiet', False)
+
+    # Find the file like `get` would put it
+    if os.path.isdir(localpath):
+        localpath = os.path.join(localpath, posixpath.basename(remotepath))
+    if not os.path.isfile(localpath):
+        if not quiet:
+            print_("%s is missing!"%(localpath,))
+        return 1
+
+    remote = []
+    for replica in t2kdm.backend.replicas(remotepath, cached=True):
+        chk = t2kdm.backend.checksum(replica, cached=True)
+        if '?' not in chk:
+            remote.append(chk)
+    if len(remote) == 0:
+        if not quiet:
+            print_("%s has no known checksum!"%(remotepath,))
+        return 1
+
+    local = checksums.adler32(localpath)
+    if verbose:
+        print_("%s: %s"%(localpath, local))
+    if not all(checksums.equal(local, chk) for chk in remote):
+        if not quiet:
+            print_("%s does not match %s!"%(localpath, remotepath))
+        return 1
+
+    return 0
+
+def _prefetch_fix(remotepaths, *args, **kwargs):
+    """Query the replicas of many files at once and check whether they exist."""
+
+    replicas = t2kdm.backend.replicas_many(remotepaths, cached=True)
+    surls = []
+    for reps in replicas.values():
+        surls.extend(reps)
+    t2kdm.backend.exists_many(surls, cached=True)
+
+@_recursive("Fixing", "Fixed", prefetch=_prefetch_fix)
 def fix(remotepath, **kwargs):
     ret = utils.fix_all(remotepath, **kwargs)
     if ret:
@@ -223,6 +680,54 @@ def fix(remotepath, **kwargs):
     else:
         return 1
 
+def cache(action, remotepath=None, recursive=False, verbose=False):
+    """Inspect, warm or flush the shared cache of catalogue queries."""
+
+    persistent = backends.cache.persistent
+    if action == 'flush':
+        backends.cache.flush()
+        if persistent is None:
+            # Also flush the file if the cache is disabled in this configuration
+            backends.PersistentCache(backends.shared_cache_file).flush()
+        if verbose:
+            print_("Flushed the cache.")
+        return 0
+
+    if persistent is None:
+        raise InteractiveException("The shared cache is disabled. Enable it with the `shared_cache` option in `t2kdm-config`.")
+
+    if action == 'inspect':
+        persistent.clean()
+        summary = persistent.summary()
+        print_("Shared cache: %s"%(persistent.filename,))
+        for namespace in sorted(summary):
+            print_("{name:<40} {entries:8d} entries {size:>10}".format(name=namespace,
+                entries=summary[namespace]['entries'], size=format_bytes(summary[namespace]['bytes'])))
+        return 0
+
+    if action == 'warm':
+        if remotepath is None:
+            raise InteractiveException("Need a remote path to warm the cache with.")
+        if recursive:
+            if isinstance(recursive, str):
+                regex = recursive
+            else:
+                regex = None
+            paths = utils.remote_iter_recursively(remotepath, regex)
+        else:
+            paths = [remotepath]
+        t2kdm.is_dir(remotepath, cached=True)
+        t2kdm.ls(remotepath, cached=True)
+        n = 0
+        for chunk in utils.iter_chunks(paths, 100):
+            t2kdm.backend.replicas_many(chunk, cached=True)
+            n += len(chunk)
+            if verbose:
+                print_("Cached %d files."%(n,))
+        return 0
+
+    raise InteractiveException("Unknown action: %s"%(action,))
+
 def print_storage_elements():
     """Print all available storage elments on screen."""
 
@@ -633,8 +633,13 @@ def run_maid():
                         help="do a task, even if it is not due yet")
     parser.add_argument('-r', '--report', metavar='FOLDER', default=None,
                         help="generate an html report in the given folder")
+    parser.add_argument('--stats', metavar='FILE', default=None,
+                        help="record statistics of the grid operations and write them as JSON to FILE at exit")
     args = parser.parse_args()
 
+    if args.stats is not None:
+        t2kdm.backends.statistics.dump_at_exit(args.stats)
+
     maid = Maid(t2kdm.config.maid_config, report=args.report)
     maid.do_something(eager=args.eager)
 
@@ -0,0 +1,247 @@
+"""Adaptive tuning of transfers based on their observed performance."""
+
+import json
+import os
+import math
+import atexit
+import fcntl
+import tempfile
+import threading
+from time import time
+
+class _PersistentState(object):
+    """Base class of objects that keep their state in a JSON file.
+
+    Observations are applied to the state in memory right away. They are
+    saved at most every `save_interval` seconds and at exit, by applying
+    them again to the current state in the file, under a lock. So concurrent
+    processes add to each other's observations instead of overwriting them.
+    Subclasses record observations with `_observe`, which calls `_apply`.
+    """
+
+    save_interval = 60
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.state = None
+        # Observations that are not saved yet
+        self.pending = []
+        self.last_save = 0.
+        if filename is not None:
+            atexit.register(self.save)
+
+    def _read(self):
+        """Return the state stored in the file."""
+        if self.filename is not None and os.path.isfile(self.filename):
+            try:
+                with open(self.filename, 'rt') as f:
+                    return json.load(f)
+            except (IOError, OSError, ValueError):
+                # Just start from scratch
+                pass
+        return {}
+
+    def _load(self):
+        """Load the state from the file, if not done yet."""
+        if self.state is None:
+            self.state = self._read()
+
+    def _apply(self, state, *observation):
+        raise NotImplementedError()
+
+    def _observe(self, *observation):
+        """Apply an observation to the state and save it eventually.
+
+        Must be called with the lock held.
+        """
+        self._load()
+        self._apply(self.state, *observation)
+        if self.filename is None:
+            return
+        self.pending.append(observation)
+        if time() - self.last_save >= self.save_interval:
+            self._save()
+
+    def save(self):
+        """Save the observations that are not saved yet."""
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        if self.filename is None or len(self.pending) == 0:
+            return
+        self.last_save = time()
+        directory = os.path.dirname(self.filename)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.filename + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                # Add to what other processes saved in the meantime
+                state = self._read()
+                for observation in self.pending:
+                    self._apply(state, *observation)
+                fd, temp = tempfile.mkstemp(dir=directory, prefix='.')
+                with os.fdopen(fd, 'wt') as f:
+                    json.dump(state, f)
+                os.rename(temp, self.filename)
+        except (IOError, OSError):
+            # Not being able to remember is no reason to fail
+            return
+        self.state = state
+        self.pending = []
+
+class StreamController(_PersistentState):
+    """Choose the number of parallel streams of downloads per storage element.
+
+    The throughput of downloads is recorded per SE and number of streams.
+    The controller starts with a single stream and doubles the number as long
+    as that improves the throughput, always using the best known number.
+    Small files are always downloaded with a single stream.
+
+    If a `filename` is provided, the observations are stored in that file, so
+    they are remembered across calls.
+    """
+
+    # Files smaller than this (in bytes) do not profit from multiple streams
+    min_size = 100 * 1024**2
+    max_streams = 16
+    # Weight of new observations in the moving average of the throughput
+    alpha = 0.3
+
+    def _SE_state(self, SE, state=None):
+        if state is None:
+            state = self.state
+        if SE not in state:
+            state[SE] = {'streams': 1, 'throughput': {}}
+        return state[SE]
+
+    def streams(self, SE, size=None):
+        """Return the number of streams to be used for a file of `size` bytes from the SE."""
+        if size is not None and 0 <= size < self.min_size:
+            return 1
+        with self.lock:
+            self._load()
+            state = self._SE_state(SE)
+            streams = state['streams']
+            more = min(2*streams, self.max_streams)
+            if str(streams) in state['throughput'] and str(more) not in state['throughput']:
+                # Try whether more streams are faster
+                return more
+            return streams
+
+    def record(self, SE, streams, size, duration):
+        """Record the duration of a download of `size` bytes with the given number of streams."""
+        if size < self.min_size or duration <= 0:
+            return
+        with self.lock:
+            self._observe(SE, streams, size / float(duration))
+
+    def _apply(self, state, SE, streams, throughput):
+        key = str(streams)
+        state = self._SE_state(SE, state)
+        observed = state['throughput']
+        if key in observed:
+            observed[key] = (1. - self.alpha) * observed[key] + self.alpha * throughput
+        else:
+            observed[key] = throughput
+        state['streams'] = int(max(observed, key=lambda k: observed[k]))
+
+class TransferModel(_PersistentState):
+    """Model of the measured performance of transfers between storage elements.
+
+    The throughput and error rate of transfers are recorded per source SE and
+    destination. The destination is the name of an SE, or 'local' for
+    downloads. Older observations lose their weight with a half life of
+    `half_life` seconds, so the model follows changes of the network and the
+    SEs, and has no preference at all when there is no recent data.
+
+    If a `filename` is provided, the observations are stored in that file, so
+    they are remembered across calls.
+    """
+
+    half_life = 7 * 24 * 60 * 60
+    # Transfers of smaller files (in bytes) are dominated by latency,
+    # so their throughput is not recorded
+    min_size = 1024**2
+    # Largest penalty of slow sources, and penalty of sources that always fail,
+    # in units of the location distance of `StorageElement.get_distance`
+    max_throughput_penalty = 2.
+    error_penalty = 4.
+
+    def _decay(self, since, now):
+        """Return the factor by which the weight of old observations is reduced."""
+        return 0.5 ** (max(0., now - since) / self.half_life)
+
+    def record(self, source, destination, size=0, duration=0, error=False):
+        """Record a transfer of `size` bytes from the source to the destination.
+
+        Failed transfers are recorded with `error=True`.
+        """
+        with self.lock:
+            self._observe('%s>%s'%(source, destination), time(), size, duration, error)
+
+    def _apply(self, state, key, now, size, duration, error):
+        entry = state.get(key, None)
+        if entry is None:
+            entry = {'time': now, 'transfers': 0., 'errors': 0., 'weight': 0., 'throughput': 0.}
+            state[key] = entry
+        decay = self._decay(entry['time'], now)
+        entry['time'] = max(entry['time'], now)
+        entry['transfers'] = entry['transfers'] * decay + 1.
+        entry['errors'] = entry['errors'] * decay + float(error)
+        entry['weight'] *= decay
+        if not error and size >= self.min_size and duration > 0:
+            # Weighted average of the throughput of all recorded transfers
+            throughput = size / float(duration)
+            entry['throughput'] = (entry['throughput'] * entry['weight'] + throughput) / (entry['weight'] + 1.)
+            entry['weight'] += 1.
+
+    def throughput(self, source, destination):
+        """Return the average throughput of transfers from the source to the destination.
+
+        Returns `None` if there are no measurements.
+        """
+        with self.lock:
+            self._load()
+            entry = self.state.get('%s>%s'%(source, destination), None)
+            if entry is None or entry['weight'] <= 0:
+                return None
+            return entry['throughput']
+
+    def penalties(self, sources, destination):
+        """Return a dictionary of penalties of the source SE names for transfers to the destination.
+
+        The penalty grows with the error rate and with the throughput relative
+        to the best of the sources, up to `max_throughput_penalty`.
+        It is scaled by how much recent data there is of the source, so
+        sources without data have no penalty.
+        """
+        now = time()
+        with self.lock:
+            self._load()
+            entries = {}
+            for source in sources:
+                entry = self.state.get('%s>%s'%(source, destination), None)
+                if entry is not None:
+                    decay = self._decay(entry['time'], now)
+                    entries[source] = (entry['transfers'] * decay, entry['errors'] * decay, entry['weight'] * decay, entry['throughput'])
+
+        best = max([e[3] for e in entries.values() if e[2] > 0] + [0.])
+        ret = {}
+        for source in sources:
+            if source not in entries:
+                ret[source] = 0.
+                continue
+            transfers, errors, weight, throughput = entries[source]
+            if transfers <= 0:
+                ret[source] = 0.
+                continue
+            # Few or old transfers say little
+            penalty = (transfers / (transfers + 1.)) * self.error_penalty * errors / transfers
+            if weight > 0 and best > 0:
+                slowness = math.log(best / max(throughput, best * 2**-self.max_throughput_penalty), 2)
+                penalty += (weight / (weight + 1.)) * slowness
+            ret[source] = penalty
+        return ret
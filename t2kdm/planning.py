@@ -0,0 +1,215 @@
+"""Plans of what replicate, get and remove would do, made without changing anything.
+
+A plan resolves the replicas and sources of all files once. It is a JSON
+document that can be inspected and executed later with `t2kdm-execute`:
+
+    {
+        "version": 1,
+        "operation": "replicate",
+        "created": 1500000000.0,
+        "args": ["UKI-SOUTHGRID-OX-HEP-disk"],
+        "kwargs": {"tape": false, ...},
+        "destination": "UKI-SOUTHGRID-OX-HEP-disk",
+        "files": [
+            {"path": "/nd280/file.txt", "size": 1024, "action": "transfer",
+                "source": "RAL-LCG22-tape", "tape": true, "replicas": ["srm://...", ...]},
+            {"path": "/nd280/other.txt", "size": 2048, "action": "skip",
+                "reason": "Replica already present at destination."},
+            ...
+        ],
+        "summary": {...}
+    }
+
+The action of each file is "transfer" (or "remove"), "skip" if nothing
+needs to be done, or "fail" if the operation would fail, with the reason.
+Transfers keep the replicas of the file, so they need not be queried again
+when the plan is executed.
+"""
+
+import os, sys
+import json
+from time import time
+from six import print_
+import t2kdm
+from t2kdm import storage
+from t2kdm import scheduling
+from t2kdm.backends import BackendException
+from t2kdm.progress import format_bytes, format_duration
+
+version = 1
+
+# Number of files whose replicas are queried at once
+chunk_size = 100
+
+def _iter_replicas(files):
+    """Iterate over the paths, sizes and replicas of the files.
+
+    The replicas are `None` if they could not be found.
+    """
+    files = list(files)
+    for i in range(0, len(files), chunk_size):
+        chunk = files[i:i+chunk_size]
+        replicas = t2kdm.backend.replicas_many([path for path, size in chunk], cached=True)
+        for path, size in chunk:
+            yield path, size, replicas.get(path, None)
+
+def _source_entry(path, size, replicas, source, destination, tape):
+    """Return the plan entry of a file that is copied from its closest source."""
+    entry = {'path': path, 'size': size}
+    if replicas is None:
+        entry.update(action='fail', reason="Could not get replicas of %s."%(path,))
+        return entry
+    try:
+        replica, src = t2kdm.backend.get_file_source(path, source, destination, tape=tape, replicas=replicas)
+    except BackendException as e:
+        entry.update(action='fail', reason=str(e))
+        return entry
+    entry.update(action='transfer', source=src.name, tape=(src.type == 'tape'), replicas=list(replicas))
+    return entry
+
+def plan_replicate(files, destination, source=None, tape=False, **kwargs):
+    """Return the plan entries of replicating the `(path, size)` files and the destination name."""
+    dst = storage.get_SE(destination)
+    if dst is None:
+        raise BackendException("Could not find storage element %s."%(destination,))
+    entries = []
+    for path, size, replicas in _iter_replicas(files):
+        if replicas is not None and any(dst.host in rep for rep in replicas):
+            entries.append({'path': path, 'size': size, 'action': 'skip',
+                'reason': "Replica already present at destination."})
+        else:
+            entries.append(_source_entry(path, size, replicas, source, destination, tape))
+    return entries, dst.name
+
+def plan_get(files, localpath, source=None, tape=False, force=False, sync=False, **kwargs):
+    """Return the plan entries of downloading the `(path, size)` files and the destination 'local'."""
+    entries = []
+    for path, size, replicas in _iter_replicas(files):
+        filename = os.path.abspath(t2kdm.backend._get_localpath(path, localpath, force=True))
+        if os.path.isfile(filename) and not (force or sync):
+            entries.append({'path': path, 'size': size, 'action': 'fail',
+                'reason': "File does already exist: %s."%(filename,)})
+            continue
+        entry = _source_entry(path, size, replicas, source, None, tape)
+        entry['localpath'] = filename
+        entries.append(entry)
+    return entries, 'local'
+
+def plan_remove(files, destination, final=False, **kwargs):
+    """Return the plan entries of removing the replicas of the `(path, size)` files and the SE name."""
+    dst = storage.get_SE(destination)
+    if dst is None:
+        raise BackendException("Could not find storage element %s."%(destination,))
+    entries = []
+    for path, size, replicas in _iter_replicas(files):
+        entry = {'path': path, 'size': size}
+        if replicas is None:
+            entry.update(action='fail', reason="Could not get replicas of %s."%(path,))
+        elif not any(dst.host in rep for rep in replicas):
+            entry.update(action='skip', reason="Replica not present at destination.")
+        else:
+            # Only count non-blacklisted replicas, like `remove` does
+            SEs = [storage.get_SE(rep) for rep in replicas]
+            nrep = len([SE for SE in SEs if SE is not None and not SE.is_blacklisted()])
+            if not final and nrep <= 1:
+                entry.update(action='fail', reason="Only one replica of file left!")
+            else:
+                entry.update(action='remove', source=dst.name, tape=(dst.type == 'tape'))
+        entries.append(entry)
+    return entries, dst.name
+
+planners = {
+    'replicate': plan_replicate,
+    'get': plan_get,
+    'remove': plan_remove,
+}
+
+def make_plan(operation, files, args=(), kwargs={}, workers=1):
+    """Plan the operation on the `(path, size)` files.
+
+    `args` and `kwargs` are the arguments of the interactive function,
+    which are used again when the plan is executed.
+    The duration is estimated for `workers` parallel jobs, see `scheduling.schedule`.
+    """
+    entries, destination = planners[operation](files, *args, **kwargs)
+    plan = {
+        'version': version,
+        'operation': operation,
+        'created': time(),
+        'args': list(args),
+        'kwargs': dict(kwargs),
+        'destination': destination,
+        'files': entries,
+    }
+    plan['summary'] = summarise(plan, workers=workers)
+    return plan
+
+def summarise(plan, workers=1):
+    """Return the summary of a plan, with totals per source and the estimated duration."""
+    active = [e for e in plan['files'] if e['action'] not in ('skip', 'fail')]
+    summary = {
+        'files': len(plan['files']),
+        'bytes': sum(e['size'] for e in plan['files']),
+        'active_files': len(active),
+        'active_bytes': sum(e['size'] for e in active),
+        'skipped_files': len([e for e in plan['files'] if e['action'] == 'skip']),
+        'failing_files': len([e for e in plan['files'] if e['action'] == 'fail']),
+        'tape_files': len([e for e in active if e.get('tape', False)]),
+        'tape_bytes': sum(e['size'] for e in active if e.get('tape', False)),
+        'sources': {},
+    }
+    for e in active:
+        source = summary['sources'].setdefault(e['source'], {'files': 0, 'bytes': 0})
+        source['files'] += 1
+        source['bytes'] += e['size']
+    if summary['active_bytes'] > 0:
+        summary['tape_fraction'] = summary['tape_bytes'] / float(summary['active_bytes'])
+    else:
+        summary['tape_fraction'] = 0.
+    if plan['operation'] == 'remove':
+        # Nothing is moved
+        sizes = dict((e['path'], 0) for e in active)
+    else:
+        sizes = dict((e['path'], e['size']) for e in active)
+    sources = dict((e['path'], e['source']) for e in active)
+    paths, duration = scheduling.schedule([e['path'] for e in active], sizes, sources, plan['destination'],
+        workers=workers, per_source=t2kdm.backend.transfer_slots.limit)
+    summary['workers'] = workers
+    summary['duration'] = duration
+    return summary
+
+def print_summary(plan, output=None):
+    """Print the summary of a plan in human readable form."""
+    if output is None:
+        output = sys.stdout
+    summary = plan['summary']
+    if plan['operation'] == 'remove':
+        direction = "from"
+    else:
+        direction = "to"
+    print_("Plan to %s %d of %d files (%s of %s) %s %s"%(plan['operation'],
+        summary['active_files'], summary['files'],
+        format_bytes(summary['active_bytes']), format_bytes(summary['bytes']),
+        direction, plan['destination']), file=output)
+    for name in sorted(summary['sources']):
+        if plan['operation'] == 'remove':
+            break
+        source = summary['sources'][name]
+        print_("    from %s: %d files, %s"%(name, source['files'], format_bytes(source['bytes'])), file=output)
+    print_("%d files on tape (%.1f%% of the bytes), %d files skipped, %d files would fail."%(
+        summary['tape_files'], 100. * summary['tape_fraction'],
+        summary['skipped_files'], summary['failing_files']), file=output)
+    print_("Estimated duration with %d jobs: %s"%(summary['workers'], format_duration(summary['duration'])), file=output)
+
+def save(plan, filename):
+    """Write a plan to a file."""
+    with open(filename, 'wt') as f:
+        json.dump(plan, f, indent=1, sort_keys=True)
+
+def load(filename):
+    """Load a plan from a file."""
+    with open(filename, 'rt') as f:
+        plan = json.load(f)
+    if plan.get('version', None) != version or plan.get('operation', None) not in planners:
+        raise ValueError("Not a valid plan: %s"%(filename,))
+    return plan
@@ -0,0 +1,193 @@
+"""Progress reports of long running recursive operations."""
+
+from six import print_
+from time import time
+import threading
+import json
+import sys
+
+# Operations that move data, see `t2kdm.stats`
+transfer_operations = ['get', 'put', 'replicate', 'replicate_many']
+
+def format_bytes(nbytes):
+    """Turn a number of bytes into a human readable string."""
+    for unit in ['B', 'kB', 'MB', 'GB', 'TB']:
+        if abs(nbytes) < 1000.:
+            break
+        nbytes /= 1000.
+    else:
+        unit = 'PB'
+    return "%.1f %s"%(nbytes, unit)
+
+def format_duration(seconds):
+    """Turn a number of seconds into a string like '1d 02:03:04'."""
+    if seconds is None:
+        return "?"
+    seconds = int(seconds)
+    days, seconds = divmod(seconds, 24*60*60)
+    hours, seconds = divmod(seconds, 60*60)
+    minutes, seconds = divmod(seconds, 60)
+    ret = "%02d:%02d:%02d"%(hours, minutes, seconds)
+    if days > 0:
+        ret = "%dd %s"%(days, ret)
+    return ret
+
+class Progress(object):
+    """Keep track of the files and bytes done and report the progress regularly.
+
+    The progress is printed every `interval` seconds, and appended as a line
+    of JSON to the file `filename`, if one is provided. The throughput per
+    storage element is taken from the transferred bytes recorded by `stats`,
+    a `t2kdm.stats.Stats` object, which is enabled for that purpose.
+
+    The throughput of the successfully transferred bytes is reported as "now",
+    i.e. during the last interval, and as average since the start. The bytes
+    of failed files are counted separately. They only count towards the ETA,
+    which is based on the average rate at which bytes are processed.
+    """
+
+    def __init__(self, total_files, total_bytes, interval=60, filename=None, stats=None, output=None):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.filename = filename
+        self.stats = stats
+        self.output = output
+        self.files = 0
+        self.failed = 0
+        self.bytes = 0
+        self.failed_bytes = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _SE_bytes(self):
+        """Return the total transferred bytes per SE as recorded by the statistics."""
+        ret = {}
+        if self.stats is None:
+            return ret
+        operations = self.stats.as_dict()['operations']
+        for operation in transfer_operations:
+            for SE, stats in operations.get(operation, {}).get('SEs', {}).items():
+                ret[SE] = ret.get(SE, 0) + stats['bytes']
+        return ret
+
+    def start(self):
+        """Start the clock and the regular reports."""
+        if self.stats is not None:
+            self.stats.enable()
+        self.start_time = time()
+        self.last_time = self.start_time
+        self.last_bytes = 0
+        self.start_SE_bytes = self._SE_bytes()
+        self.last_SE_bytes = self.start_SE_bytes
+        if self.interval > 0:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        """Stop the regular reports and report the final state."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.report()
+
+    def done(self, size, failed=False):
+        """Mark a file of `size` bytes as done."""
+        with self.lock:
+            self.files += 1
+            if failed:
+                self.failed += 1
+                if size > 0:
+                    self.failed_bytes += size
+            elif size > 0:
+                self.bytes += size
+
+    def state(self):
+        """Return the current progress as dictionary and start a new interval."""
+        now = time()
+        SE_bytes = self._SE_bytes()
+        with self.lock:
+            elapsed = now - self.start_time
+            interval = now - self.last_time
+            files = self.files
+            failed = self.failed
+            nbytes = self.bytes
+            failed_bytes = self.failed_bytes
+            last_bytes = self.last_bytes
+            last_SE_bytes = self.last_SE_bytes
+            self.last_time = now
+            self.last_bytes = nbytes
+            self.last_SE_bytes = SE_bytes
+
+        def rate(amount, duration):
+            if duration <= 0:
+                return 0.
+            return amount / float(duration)
+
+        processed = nbytes + failed_bytes
+        if files >= self.total_files:
+            eta = 0.
+        elif self.total_bytes > 0 and processed > 0:
+            eta = (self.total_bytes - processed) / rate(processed, elapsed)
+        elif files > 0:
+            # No sizes known, go by the number of files
+            eta = (self.total_files - files) * elapsed / files
+        else:
+            eta = None
+
+        SEs = {}
+        for SE, total in SE_bytes.items():
+            total -= self.start_SE_bytes.get(SE, 0)
+            if total <= 0:
+                continue
+            SEs[SE] = {
+                'bytes': total,
+                'throughput': rate(total - (last_SE_bytes.get(SE, 0) - self.start_SE_bytes.get(SE, 0)), interval),
+                'average_throughput': rate(total, elapsed),
+            }
+
+        return {
+            'time': now,
+            'elapsed': elapsed,
+            'files': files,
+            'failed': failed,
+            'total_files': self.total_files,
+            'bytes': nbytes,
+            'failed_bytes': failed_bytes,
+            'total_bytes': self.total_bytes,
+            'throughput': rate(nbytes - last_bytes, interval),
+            'average_throughput': rate(nbytes, elapsed),
+            'eta': eta,
+            'SEs': SEs,
+        }
+
+    def report(self):
+        """Print the progress and write it to the file."""
+        state = self.state()
+        output = self.output or sys.stdout
+        if self.total_bytes > 0:
+            percent = 100. * (state['bytes'] + state['failed_bytes']) / self.total_bytes
+        elif self.total_files > 0:
+            percent = 100. * state['files'] / self.total_files
+        else:
+            percent = 100.
+        print_("Progress: %d/%d files (%d failed), %s/%s (%s failed, %.1f%% done), %s/s now, %s/s average, ETA %s"%(
+            state['files'], state['total_files'], state['failed'],
+            format_bytes(state['bytes']), format_bytes(state['total_bytes']), format_bytes(state['failed_bytes']), percent,
+            format_bytes(state['throughput']), format_bytes(state['average_throughput']),
+            format_duration(state['eta'])), file=output)
+        for SE in sorted(state['SEs']):
+            SE_state = state['SEs'][SE]
+            print_("    %s: %s, %s/s now, %s/s average"%(SE,
+                format_bytes(SE_state['bytes']), format_bytes(SE_state['throughput']),
+                format_bytes(SE_state['average_throughput'])), file=output)
+        output.flush()
+        if self.filename is not None:
+            with open(self.filename, 'at') as f:
+                f.write(json.dumps(state, sort_keys=True) + '\n')
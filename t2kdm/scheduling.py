@@ -0,0 +1,108 @@
+"""Scheduling of many transfers to finish them as early as possible.
+
+When files of very different sizes are transferred by parallel workers in
+listing order, a few large files at the end can keep a single worker busy
+for hours while the others are idle. Starting the largest files first
+(the "longest processing time first" rule) avoids that.
+
+The schedule simulates the workers, using the throughput of each source
+as measured by the `storage.transfer_model`, to predict the total duration.
+The simulation also respects the limit of concurrent transfers per source,
+so the transfers of busy sources are deferred in favour of others.
+"""
+
+import heapq
+from t2kdm import storage
+
+# Orders in which the files are started
+policies = ['largest', 'smallest', 'listing']
+
+# Throughput in bytes per second assumed when nothing has been measured yet
+default_throughput = 10. * 1000**2
+# Time per file in seconds that is not spent moving data, e.g. for catalogue queries
+overhead = 5.
+
+def order(paths, sizes, policy='largest'):
+    """Return the paths in the order given by the policy."""
+    if policy == 'largest':
+        return sorted(paths, key=lambda path: -sizes.get(path, 0))
+    elif policy == 'smallest':
+        return sorted(paths, key=lambda path: sizes.get(path, 0))
+    elif policy == 'listing':
+        return list(paths)
+    else:
+        raise ValueError("Unknown scheduling policy: %s"%(policy,))
+
+def schedule(paths, sizes, sources=None, destination='local', workers=1, per_source=0, policy='largest', model=None):
+    """Plan the transfers of the files on `workers` parallel workers.
+
+    `sizes` and `sources` are dictionaries of the sizes in bytes and the source
+    SE names of the files. Files without known source are treated as if they
+    all came from the same one. At most `per_source` transfers (0 meaning no
+    limit) run concurrently per source. The throughput is taken from the
+    `TransferModel` `model`, by default `storage.transfer_model`.
+
+    Returns the paths in the order they should be started and the predicted
+    total duration in seconds.
+    """
+
+    if sources is None:
+        sources = {}
+    if model is None:
+        model = storage.transfer_model
+    paths = order(paths, sizes, policy)
+
+    # Queue of files per source, so the next file of each is found quickly
+    queues = {}
+    for index, path in enumerate(paths):
+        queues.setdefault(sources.get(path, None), []).append((index, path))
+    for queue in queues.values():
+        queue.reverse()
+
+    throughputs = {}
+    for source in queues:
+        throughputs[source] = model.throughput(source, destination)
+    known = [x for x in throughputs.values() if x is not None and x > 0]
+    if len(known) > 0:
+        # Assume unknown sources are as fast as the known ones on average
+        fallback = sum(known) / len(known)
+    else:
+        fallback = default_throughput
+    for source in throughputs:
+        if throughputs[source] is None or throughputs[source] <= 0:
+            throughputs[source] = fallback
+
+    free = [0.] * max(1, workers) # Times when the workers are free
+    running = dict((source, []) for source in queues) # End times of transfers per source
+    ordered = []
+    end = 0.
+    while len(ordered) < len(paths):
+        now = heapq.heappop(free)
+        # Choose the next file of the policy among the sources with free slots
+        best = None # The source is `None` for unknown ones, so store the queue as well
+        earliest = None
+        for source, queue in queues.items():
+            if len(queue) == 0:
+                continue
+            ends = running[source]
+            while len(ends) > 0 and ends[0] <= now:
+                heapq.heappop(ends)
+            if per_source > 0 and len(ends) >= per_source:
+                if earliest is None or ends[0] < earliest:
+                    earliest = ends[0]
+                continue
+            if best is None or queue[-1][0] < best[1][-1][0]:
+                best = (source, queue)
+        if best is None:
+            # Wait until a transfer of a busy source finishes
+            heapq.heappush(free, earliest)
+            continue
+        source, queue = best
+        index, path = queue.pop()
+        finish = now + overhead + max(sizes.get(path, 0), 0) / throughputs[source]
+        heapq.heappush(free, finish)
+        heapq.heappush(running[source], finish)
+        ordered.append(path)
+        end = max(end, finish)
+
+    return ordered, end
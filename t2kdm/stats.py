@@ -0,0 +1,177 @@
+"""Statistics of the time spent in grid operations."""
+
+from time import time
+import threading
+import json
+import atexit
+
+class OperationStats(object):
+    """Counters and a latency histogram of one kind of operation."""
+
+    # Upper edges of the latency histogram bins in seconds
+    bins = [0.01, 0.1, 1., 10., 100., 1000., 10000.]
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.items = 0
+        self.bytes = 0
+        self.time = 0.
+        self.min_time = None
+        self.max_time = None
+        self.histogram = [0] * (len(self.bins) + 1)
+
+    def add(self, duration, error=False, items=1, nbytes=0):
+        self.count += 1
+        if error:
+            self.errors += 1
+        self.items += items
+        self.bytes += nbytes
+        self.time += duration
+        if self.min_time is None or duration < self.min_time:
+            self.min_time = duration
+        if self.max_time is None or duration > self.max_time:
+            self.max_time = duration
+        i = 0
+        while i < len(self.bins) and duration > self.bins[i]:
+            i += 1
+        self.histogram[i] += 1
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'items': self.items,
+            'bytes': self.bytes,
+            'time': self.time,
+            'min_time': self.min_time,
+            'max_time': self.max_time,
+            'histogram': dict(zip([str(b) for b in self.bins] + ['inf'], self.histogram)),
+        }
+
+class Measurement(object):
+    """Context manager measuring the duration of an operation.
+
+    Set `bytes` and `items` on the object within the context
+    to record the transferred volume and the number of handled files.
+    """
+
+    def __init__(self, stats, operation, SEs):
+        self.stats = stats
+        self.operation = operation
+        self.SEs = SEs
+        self.items = 1
+        self.bytes = 0
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.record(self.operation, time() - self.start, SEs=self.SEs,
+            error=(exc_type is not None), items=self.items, nbytes=self.bytes)
+        return False
+
+class NullMeasurement(object):
+    """Context manager doing nothing, used when the statistics are disabled."""
+
+    items = 1
+    bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+class Stats(object):
+    """Collect statistics of operations, in total and per storage element.
+
+    Nothing is recorded until `enable` is called.
+    """
+
+    _null = NullMeasurement()
+
+    def __init__(self):
+        self.enabled = False
+        self.start_time = None
+        self.operations = {}
+        self.lock = threading.Lock()
+        self.dump_files = set()
+
+    def enable(self):
+        if not self.enabled:
+            self.enabled = True
+            self.start_time = time()
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+            if self.enabled:
+                self.start_time = time()
+
+    def measure(self, operation, *SEs):
+        """Return a context manager that records the duration of an operation.
+
+        The `SEs` can be `StorageElement`s, their names or surls.
+        They are only resolved if the statistics are enabled.
+        """
+        if not self.enabled:
+            return self._null
+        return Measurement(self, operation, SEs)
+
+    def record(self, operation, duration, SEs=(), error=False, items=1, nbytes=0):
+        """Record a single operation."""
+        from t2kdm import storage # Avoid circular import
+        names = []
+        for SE in SEs:
+            if SE is None:
+                continue
+            SE = storage.get_SE(SE)
+            if SE is not None and SE.name not in names:
+                names.append(SE.name)
+        with self.lock:
+            if operation not in self.operations:
+                self.operations[operation] = (OperationStats(), {})
+            total, per_SE = self.operations[operation]
+            total.add(duration, error=error, items=items, nbytes=nbytes)
+            for name in names:
+                if name not in per_SE:
+                    per_SE[name] = OperationStats()
+                per_SE[name].add(duration, error=error, items=items, nbytes=nbytes)
+
+    def as_dict(self):
+        """Return the statistics as dictionary.
+
+        The operations are keyed by name and contain the totals as well as
+        the statistics per storage element.
+        """
+        with self.lock:
+            operations = {}
+            for name, (total, per_SE) in self.operations.items():
+                ret = total.as_dict()
+                ret['SEs'] = dict((SE, stats.as_dict()) for SE, stats in per_SE.items())
+                operations[name] = ret
+        if self.start_time is None:
+            wall_time = 0.
+        else:
+            wall_time = time() - self.start_time
+        return {
+            'wall_time': wall_time,
+            'operations': operations,
+        }
+
+    def dump(self, filename):
+        """Write the statistics to a JSON file."""
+        with open(filename, 'wt') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+
+    def dump_at_exit(self, filename):
+        """Enable the statistics and write them to a JSON file when the process exits."""
+        self.enable()
+        if filename not in self.dump_files:
+            self.dump_files.add(filename)
+            atexit.register(self.dump, filename)
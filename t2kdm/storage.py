@@ -1,9 +1,50 @@
 """Module to organise storage elements."""
 
+import os
 import posixpath
+import threading
+from time import time
 import t2kdm
+from t2kdm.performance import TransferModel
+from t2kdm.configuration import app_dirs
 from six import print_
 
+# Measured performance of past transfers, used to rank the sources of new ones
+transfer_model = TransferModel(os.path.join(app_dirs.user_cache_dir, 'transfers.json'))
+
+class CircuitBreaker(object):
+    """Keep track of consecutive failures of a storage element.
+
+    After `threshold` consecutive failures, the circuit is "open" and the SE
+    should not be used for `timeout` seconds. After that it is tried again,
+    but a single further failure opens the circuit again.
+    """
+
+    threshold = 3
+    timeout = 600
+
+    def __init__(self):
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def is_open(self):
+        """Should the SE be avoided right now?"""
+        return self.opened is not None and (time() - self.opened) < self.timeout
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = time()
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+
+    reset = record_success
+
 class StorageElement(object):
     """Representation of a grid storage element"""
 
@@ -24,6 +65,7 @@ class StorageElement(object):
         self.location = location
         self.type = type
         self.broken = broken
+        self.circuit = CircuitBreaker()
 
     def is_blacklisted(self):
         """Is the SE blacklisted?"""
@@ -60,45 +102,58 @@ class StorageElement(object):
         """Check whether the remote path is replicated on this SE."""
         return any(self.host in replica for replica in t2kdm.replicas(remotepath, cached=cached))
 
-    def get_closest_SE(self, remotepath=None, tape=False, cached=False):
+    def get_closest_SE(self, remotepath=None, tape=False, cached=False, replicas=None):
         """Get the storage element with the closest replica.
 
         If `tape` is False (default), prefer disk SEs over tape SEs.
         If no `rempotepath` is provided, just return the closest SE over all.
+        If a list of `replicas` is provided, it is used instead of querying the catalogue.
         """
-        SEs = self.get_closest_SEs(remotepath=remotepath, tape=tape, cached=cached)
+        SEs = self.get_closest_SEs(remotepath=remotepath, tape=tape, cached=cached, replicas=replicas)
         if len(SEs) >= 1:
             return SEs[0]
         else:
             return None
 
-    def get_closest_SEs(self, remotepath=None, tape=False, cached=False):
+    def get_closest_SEs(self, remotepath=None, tape=False, cached=False, replicas=None):
         """Get a list of the storage element with the closest replicas.
 
         If `tape` is False (default), prefer disk SEs over tape SEs.
+        The distance by location is adjusted by the measured throughput and error
+        rate of recent transfers from the SEs to this one, see `TransferModel`.
+        SEs that failed repeatedly recently (i.e. with an open circuit) are put last,
+        followed only by blacklisted ones.
         If no `rempotepath` is provided, just return the closest SE over all.
+        If a list of `replicas` is provided, it is used instead of querying the catalogue.
         """
         closest_SE = None
         closest_distance = None
 
-        if remotepath is None:
+        if remotepath is None and replicas is None:
             candidates = SEs
         else:
+            if replicas is None:
+                replicas = t2kdm.replicas(remotepath, cached=cached)
             candidates = []
-            for rep in t2kdm.replicas(remotepath, cached=cached):
+            for rep in replicas:
                 cand = get_SE_by_path(rep)
                 if cand is not None:
                     candidates.append(cand)
 
+        penalties = transfer_model.penalties([SE.name for SE in candidates], self.name)
+
         def sorter(SE):
             if SE is None:
                 return 1000
-            distance = self.get_distance(SE)
+            distance = self.get_distance(SE) + penalties[SE.name]
             if SE.type == 'tape':
                 if tape:
                     distance += 0.5
                 else:
                     distance += 10
+            if SE.circuit.is_open():
+                # Failed repeatedly recently
+                distance += 50
             if SE.is_blacklisted():
                 distance += 100
             return distance
@@ -245,11 +300,24 @@ def get_SE(SE):
         return SE_by_host[SE]
     return get_SE_by_path(SE)
 
-def get_closest_SE(remotepath=None, location=None, tape=False, cached=False):
+def get_closest_SE(remotepath=None, location=None, tape=False, cached=False, replicas=None):
     """Get the closest storage element with a replica of the given file.
 
     If `tape` is False (default), prefer disk SEs over tape SEs.
     If no `rempotepath` is provided, just return the closest SE over all.
+    If a list of `replicas` is provided, it is used instead of querying the catalogue.
+    """
+
+    SEs = get_closest_SEs(remotepath, location=location, tape=tape, cached=cached, replicas=replicas)
+    if len(SEs) >= 1:
+        return SEs[0]
+    else:
+        return None
+
+def get_closest_SEs(remotepath=None, location=None, tape=False, cached=False, replicas=None):
+    """Get a list of the storage elements with replicas of the given file, closest first.
+
+    See `get_closest_SE`.
     """
 
     if location is None:
@@ -264,4 +332,4 @@ def get_closest_SE(remotepath=None, location=None, tape=False, cached=False):
         location = location,
         basepath = '/')
 
-    return SE.get_closest_SE(remotepath, tape=tape, cached=cached)
+    return SE.get_closest_SEs(remotepath, tape=tape, cached=cached, replicas=replicas)
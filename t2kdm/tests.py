@@ -6,6 +6,14 @@ import t2kdm.cli as cli
 from  t2kdm import backends
 from  t2kdm import storage
 from  t2kdm import utils
+from  t2kdm import performance
+from  t2kdm import scheduling
+from  t2kdm import planning
+from  t2kdm import checksums
+from  t2kdm import progress
+from  t2kdm import daemon
+from  t2kdm.stats import Stats
+from  t2kdm.cache import Cache, PersistentCache
 
 import argparse
 from six import print_
@@ -13,6 +21,14 @@ from contextlib import contextmanager
 import sys, os, sh
 import tempfile
 import posixpath
+import errno
+import stat
+import time
+import json
+import threading
+import timeit
+from six import StringIO
+from six.moves.cPickle import dumps
 
 testdir = '/test/t2kdm'
 testfiles = ['test1.txt', 'test2.txt']
@@ -49,6 +65,1053 @@ def temp_dir():
     finally:
         sh.rm('-r', tempdir)
 
+_fake_tool = """#!%s
+import sys, os, json
+log = %r
+args = sys.argv[1:]
+with open(log, 'a') as f:
+    f.write(json.dumps([os.path.basename(sys.argv[0])] + args) + '\\n')
+%s
+"""
+
+@contextmanager
+def fake_tools(tempdir, scripts=None):
+    """Put fake GFAL command line tools in front of the PATH.
+
+    `scripts` maps tool names to Python code run by the tool, with the
+    command line arguments in `args`. Other tools fail like for missing files.
+    The tool name and arguments of every call are logged as JSON lines in `log`,
+    i.e. `tempdir/calls.log`.
+    """
+    if scripts is None:
+        scripts = {}
+    bindir = os.path.join(tempdir, 'bin')
+    os.mkdir(bindir)
+    log = os.path.join(tempdir, 'calls.log')
+    for tool in ['gfal-ls', 'gfal-xattr', 'gfal-sum', 'gfal-legacy-bringonline', 'gfal-copy',
+            'gfal-legacy-register', 'gfal-legacy-unregister', 'gfal-rm']:
+        code = scripts.get(tool, 'sys.stderr.write("No such file or directory\\n"); sys.exit(2)')
+        filename = os.path.join(bindir, tool)
+        with open(filename, 'wt') as f:
+            f.write(_fake_tool%(sys.executable, log, code))
+        os.chmod(filename, 0o755)
+    path = os.environ.get('PATH', '')
+    os.environ['PATH'] = bindir + os.pathsep + path
+    try:
+        yield log
+    finally:
+        os.environ['PATH'] = path
+
+# Fake `gfal-copy`, reporting the results of bulk copies like the real one
+fake_gfal_copy = """
+if '--from-file' in args:
+    with open(args[args.index('--from-file') + 1]) as f:
+        sources = [line.strip() for line in f if len(line.strip()) > 0]
+    with open(log, 'a') as f:
+        f.write(json.dumps(['sources'] + sources) + '\\n')
+    failed = False
+    for source in sources:
+        if 'missing' in source:
+            print("Copying %s   [FAILED]  after 0s"%(source,))
+            sys.stderr.write("gfal-copy error: 2 (No such file or directory) - %s\\n"%(source,))
+            failed = True
+        else:
+            print("Copying %s   [DONE]  after 0s"%(source,))
+    if failed:
+        sys.exit(1)
+elif '-f' in args:
+    source, destination = args[-2:]
+    if 'missing' in source:
+        sys.stderr.write("gfal-copy error: 2 (No such file or directory)\\n")
+        sys.exit(2)
+    if 'slow' in source:
+        import time
+        time.sleep(10)
+    with open(destination, 'wt') as f:
+        f.write(source)
+"""
+
+class FakeRun(object):
+    """Fake `AsyncGFALBackend._run`, returning the results by the first argument of the tool.
+
+    Results that are exceptions are raised.
+    Keeps track of the peak number of concurrently running calls.
+    """
+
+    def __init__(self, results):
+        self.results = results
+        self.running = 0
+        self.peak = 0
+
+    def __call__(self, tool, *args):
+        import asyncio
+        result = self.results[args[0]]
+        if isinstance(result, Exception):
+            raise result
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        future = asyncio.ensure_future(asyncio.sleep(0.01, result=result))
+        def finished(future):
+            self.running -= 1
+        future.add_done_callback(finished)
+        return future
+
+class FakeGfal2(object):
+    """Fake gfal2 module to test the Gfal2Backend without a grid connection.
+
+    Files are described by a dictionary of urls and attributes.
+    """
+
+    class GError(Exception):
+        def __init__(self, message, code):
+            Exception.__init__(self, message)
+            self.message = message
+            self.code = code
+
+    class checksum_mode(object):
+        both = 3
+
+    class Stat(object):
+        def __init__(self, mode, size):
+            self.st_mode = mode
+            self.st_nlink = 1
+            self.st_uid = 0
+            self.st_gid = 0
+            self.st_size = size
+            self.st_mtime = 0
+
+    class Dirent(object):
+        def __init__(self, name):
+            self.d_name = name
+
+    class Directory(object):
+        def __init__(self, context, url, names):
+            self.context = context
+            self.url = url
+            self.names = list(names)
+
+        def readpp(self):
+            if len(self.names) == 0:
+                return None, None
+            name = self.names.pop(0)
+            return FakeGfal2.Dirent(name), self.context.stat(self.url + '/' + name)
+
+    class TransferParameters(object):
+        def set_checksum(self, mode, algorithm, value):
+            self.checksum = algorithm
+
+    class Context(object):
+        def __init__(self, module):
+            self.module = module
+            self.files = module.files
+            self.copies = []
+            self.xattrs = []
+
+        def _get(self, url):
+            if url not in self.files:
+                raise FakeGfal2.GError("No such file or directory", errno.ENOENT)
+            return self.files[url]
+
+        def stat(self, url):
+            f = self._get(url)
+            if 'error' in f:
+                raise FakeGfal2.GError(f['error'], errno.EACCES)
+            if 'contents' in f:
+                return FakeGfal2.Stat(stat.S_IFDIR | 0o755, 0)
+            else:
+                return FakeGfal2.Stat(stat.S_IFREG | 0o644, f.get('size', 0))
+
+        def opendir(self, url):
+            return FakeGfal2.Directory(self, url, self._get(url)['contents'])
+
+        def getxattr(self, url, name):
+            f = self._get(url)
+            if name == 'user.replicas':
+                return '\n'.join(f['replicas']) + '\n'
+            elif name == 'user.status':
+                return f['status'] + '\n'
+
+        def setxattr(self, url, name, value, flags):
+            self._get(url)
+            self.xattrs.append((url, name, value))
+
+        def checksum(self, url, algorithm):
+            return self._get(url)['checksum']
+
+        def transfer_parameters(self):
+            return FakeGfal2.TransferParameters()
+
+        def filecopy(self, params, source, destination):
+            if isinstance(source, list):
+                # Bulk copies return a list of errors
+                errors = []
+                for src, dst in zip(source, destination):
+                    try:
+                        self.filecopy(params, src, dst)
+                    except FakeGfal2.GError as e:
+                        errors.append(e)
+                    else:
+                        errors.append(None)
+                return errors
+            self._get(source)
+            if destination in self.files:
+                raise FakeGfal2.GError("File exists", errno.EEXIST)
+            self.copies.append((source, destination))
+            if destination.startswith('file://'):
+                with open(destination[7:], 'wt') as f:
+                    f.write(source)
+
+        def bring_online(self, surls, pintime, timeout, asynchronous):
+            for surl in surls:
+                self._get(surl)['status'] = 'ONLINE_AND_NEARLINE'
+            return [None] * len(surls), 'token'
+
+    def __init__(self, files):
+        self.files = files
+
+    def creat_context(self):
+        return FakeGfal2.Context(self)
+
+def run_offline_tests():
+    # Do not let the test transfers influence real ones
+    transfer_model = storage.transfer_model
+    storage.transfer_model = performance.TransferModel()
+
+    print_("Testing cache...")
+    cache = Cache(60, max_entries=3)
+    calls = []
+    @cache.cached
+    def square(x):
+        calls.append(x)
+        return x*x
+    @cache.cached(cache_time=0.01, max_size=10000)
+    def big(x):
+        return 'x' * x
+    assert([square(x, cached=True) for x in [1, 2, 1, 3, 4]] == [1, 4, 1, 9, 16])
+    assert(calls == [1, 2, 3, 4])
+    # The least recently used entry was evicted
+    assert(len(square.segment) == 3)
+    assert(square.get_entry(2) is None)
+    assert(square.get_entry(1).value == 1)
+    # Functions have their own limits
+    for x in range(10):
+        big(1000 + x, cached=True)
+    assert(len(big.segment) < 10)
+    assert(big.segment.size <= 10000)
+    time.sleep(0.02)
+    # Expired entries are removed on access and by sweeping
+    assert(big.get_entry(1009) is None)
+    cache.clean()
+    assert(len(big.segment) == 0 and big.segment.size == 0)
+    assert(len(square.segment) == 3)
+    cache.flush()
+    assert(len(square.segment) == 0)
+    # Unhashable arguments are pickled
+    @cache.cached
+    def total(numbers, offset=0):
+        calls.append(numbers)
+        return sum(numbers) + offset
+    assert(total([1, 2], offset=1, cached=True) == 4)
+    assert(total([1, 2], offset=1, cached=True) == 4)
+    assert(calls == [1, 2, 3, 4, [1, 2]])
+    assert(total.segment.namespace.endswith('total'))
+    assert(total.segment.namespace != square.segment.namespace)
+
+    print_("Testing persistent cache...")
+    with temp_dir() as tempdir:
+        filename = os.path.join(tempdir, 'cache.sqlite')
+        # Two caches, e.g. in different processes, share the file
+        caches = [Cache(60, persistent=PersistentCache(filename)) for i in range(2)]
+        calls = []
+        def make_cube(cache, persistent_time):
+            @cache.cached(persistent_time=persistent_time)
+            def cube(x):
+                calls.append(x)
+                return [x**3]
+            return cube
+        cube = make_cube(caches[0], 60)
+        other_cube = make_cube(caches[1], 60)
+        assert(cube(2, cached=True) == [8])
+        assert(other_cube(2, cached=True) == [8])
+        assert(calls == [2])
+        assert(stat.S_IMODE(os.stat(filename).st_mode) == 0o600)
+        namespace = cube.segment.namespace
+        assert(namespace.startswith('t2kdm.tests.'))
+        summary = caches[0].persistent.summary()
+        assert(summary[namespace]['entries'] == 1)
+        other_cube.remove_entry(2)
+        assert(cube.get_entry(2) is not None) # Still in memory
+        caches[0].flush()
+        assert(cube(2, cached=True) == [8])
+        assert(calls == [2, 2])
+        # Functions without a persistent time are only cached in memory
+        assert(make_cube(caches[1], 0)(3, cached=True) == [27])
+        assert(make_cube(caches[0], 0)(3, cached=True) == [27])
+        assert(calls == [2, 2, 3, 3])
+        # Expired entries are ignored and cleaned
+        short_cube = make_cube(caches[0], 0.01)
+        short_cube(4, cached=True)
+        time.sleep(0.02)
+        assert(caches[1].persistent.summary()[namespace]['expired'] == 1)
+        caches[1].persistent.clean()
+        assert(caches[1].persistent.summary()[namespace] == {'entries': 1, 'expired': 0, 'bytes': summary[namespace]['bytes']})
+        assert(make_cube(caches[1], 60)(4, cached=True) == [64])
+        assert(calls == [2, 2, 3, 3, 4, 4])
+        # Methods are told apart by the identity of their instance
+        def make_squarer(cache, identity):
+            class Squarer(object):
+                def __init__(self):
+                    self.lock = threading.Lock() # Cannot be pickled
+                def cache_identity(self):
+                    return identity
+                @cache.cached(persistent_time=60)
+                def square(self, x):
+                    calls.append(x)
+                    return [x**2]
+            return Squarer()
+        assert(make_squarer(caches[0], ('local', '/a')).square(5, cached=True) == [25])
+        assert(make_squarer(caches[1], ('local', '/a')).square(5, cached=True) == [25])
+        assert(calls == [2, 2, 3, 3, 4, 4, 5])
+        assert(make_squarer(caches[1], ('gfal', '/a')).square(5, cached=True) == [25])
+        assert(calls == [2, 2, 3, 3, 4, 4, 5, 5])
+        # Entries can be kept out of the persistent cache
+        cube.add_memory_entry([1000], 10)
+        assert(cube.get_entry(10).value == [1000])
+        assert(other_cube.get_entry(10) is None)
+        local = backends.LocalBackend(root=os.path.join(tempdir, 'a'))
+        assert(local.cache_identity() != backends.LocalBackend(root=os.path.join(tempdir, 'b')).cache_identity())
+        assert(local.cache_identity() != backends.GridBackend().cache_identity())
+
+    print_("Testing Gfal2Backend...")
+    lurl = 'lfn:/grid/t2k.org/test'
+    rep1 = 'srm://one.example.org/t2k.org/test/file.txt'
+    rep2 = 'srm://two.example.org/t2k.org/test/file.txt'
+    fake = FakeGfal2({
+        lurl: {'contents': ['file.txt', 'broken.txt']},
+        lurl + '/file.txt': {'size': 42, 'replicas': [rep1, rep2]},
+        lurl + '/broken.txt': {'error': "Permission denied"},
+        rep1: {'status': 'ONLINE', 'checksum': '12345678'},
+        rep2: {'status': 'NEARLINE', 'checksum': '12345678'},
+        })
+    backend = backends.Gfal2Backend(gfal2=fake)
+    entries = backend._ls(lurl + '/file.txt', directory=True)
+    assert(len(entries) == 1)
+    assert(entries[0].mode == '-rw-r--r--')
+    assert(entries[0].size == 42)
+    try:
+        backend._ls(lurl)
+    except backends.DoesNotExistException:
+        raise Exception("Wrong exception for inaccessible file.")
+    except backends.BackendException as e:
+        assert("Permission" in e.args[0])
+    else:
+        raise Exception("Inaccessible file did not raise exception.")
+    # Unknown values survive the compact listing
+    listing = backends.Listing([backends.DirEntry('x'), backends.DirEntry('y', mode='drwxr-xr-x', size=2**40, modified='Sep 12  2015')])
+    assert(listing[0].mode == '?' and listing[0].modified == '?' and listing[0].size == -1)
+    assert(listing[1].mode == 'drwxr-xr-x' and listing[1].modified == 'Sep 12  2015')
+    assert(listing.size_sum() == 2**40 - 1)
+    # So do modes and times like `ls` shows them
+    month = backends._month_names[time.localtime(time.time() - 30*24*60*60).tm_mon - 1]
+    entries = [backends.DirEntry('acl', mode='drwxrwxr-x+', modified=month + '  2 12:00'),
+        backends.DirEntry('setuid', mode='-rwSr--r--', modified='Sep  2  2015')]
+    listing = backends.Listing(entries)
+    assert([(e.mode, e.modified) for e in listing] == [(e.mode, e.modified) for e in entries])
+    assert(listing.is_dir_mask() == [True, False])
+    assert(backends._mode_bits('-rwSr--r--') & (stat.S_IXUSR | stat.S_ISUID) == stat.S_ISUID)
+    # The streaming listing yields the entries before the error
+    entries = backend.iter_ls('/test')
+    assert(next(entries).name == 'file.txt')
+    try:
+        next(entries)
+    except backends.BackendException as e:
+        assert("Permission" in e.args[0])
+    else:
+        raise Exception("Inaccessible file did not raise exception.")
+    try:
+        backend._ls(lurl + '/abcxyz')
+    except backends.DoesNotExistException:
+        pass
+    else:
+        raise Exception("Missing file did not raise DoesNotExistException.")
+    assert(backend._replicas(lurl + '/file.txt') == [rep1, rep2])
+    assert(backend._state(rep2) == 'NEARLINE')
+    assert(backend._state(rep1 + 'xyz') == '?')
+    assert(backend._checksum(rep1) == '12345678')
+    assert(backend._checksum(rep1 + 'xyz') == '?')
+    assert(backend._exists(rep1) == True)
+    assert(backend._exists(rep1 + 'xyz') == False)
+    # Replicating onto an existing file with matching checksum just registers it
+    assert(backend._replicate(rep1, rep2, lurl + '/file.txt') == True)
+    assert(backend.ctx.xattrs[-1] == (lurl + '/file.txt', 'user.replicas', '+' + rep2))
+    rep3 = 'srm://three.example.org/t2k.org/test/file.txt'
+    results = backend._replicate_many([(rep1, rep3, lurl + '/file.txt'), (rep1 + 'xyz', rep3 + 'xyz', lurl + '/xyz')])
+    assert(results[lurl + '/file.txt'] == True)
+    assert(isinstance(results[lurl + '/xyz'], backends.DoesNotExistException))
+    assert(backend.ctx.copies[-1] == (rep1, rep3))
+
+    print_("Testing bulk queries...")
+    reps = backend.replicas_many(['/test/file.txt', '/test/abcxyz'])
+    assert(reps == {'/test/file.txt': [rep1, rep2]})
+    # Results must end up in the cache
+    del fake.files[lurl + '/file.txt']
+    assert(backend.replicas('/test/file.txt', cached=True) == [rep1, rep2])
+    assert(backend.replicas_many(['/test/file.txt'], cached=True) == reps)
+    assert(backend.checksum_many([rep1, rep2]) == {rep1: '12345678', rep2: '12345678'})
+    assert(backend.state_many([rep1, rep2])[rep2] == 'NEARLINE')
+    assert(backend.exists_many([rep1, rep1 + 'xyz']) == {rep1: True, rep1 + 'xyz': False})
+
+    print_("Testing GFALBackend...")
+    with temp_dir() as tempdir:
+        slow_bringonline = 'import time; time.sleep(float(args[1])); sys.exit(1)'
+        with fake_tools(tempdir, {'gfal-copy': fake_gfal_copy, 'gfal-legacy-register': 'pass',
+                'gfal-legacy-bringonline': slow_bringonline}) as log:
+            gfal_backend = backends.GFALBackend()
+            results = gfal_backend._replicate_many([
+                ('srm://one/t2k.org/a/file1', 'srm://two/t2k.org/a/file1', 'lfn:/a/file1'),
+                ('srm://one/t2k.org/b/file2', 'srm://two/t2k.org/b/file2', 'lfn:/b/file2'),
+                ('srm://one/t2k.org/a/missing', 'srm://two/t2k.org/a/missing', 'lfn:/a/missing'),
+                ('srm://one/t2k.org/c/old', 'srm://two/t2k.org/c/new', 'lfn:/c/new'),
+                ])
+            with open(log, 'rt') as f:
+                calls = [json.loads(line) for line in f]
+            # Downloads can be cancelled
+            assert(gfal_backend._get('srm://one/t2k.org/a/file1', os.path.join(tempdir, 'file1')) == True)
+            try:
+                gfal_backend._get('srm://one/t2k.org/a/missing', os.path.join(tempdir, 'missing'))
+            except backends.DoesNotExistException:
+                pass
+            else:
+                raise Exception("Missing file did not raise DoesNotExistException.")
+            cancel = threading.Event()
+            threading.Timer(0.2, cancel.set).start()
+            start = time.time()
+            try:
+                gfal_backend._get('srm://one/t2k.org/a/slow', os.path.join(tempdir, 'slow'), cancel=cancel)
+            except backends.CancelledException:
+                pass
+            else:
+                raise Exception("Cancelled download did not raise CancelledException.")
+            assert(time.time() - start < 5)
+            # Files are requested to be brought online by a few workers,
+            # which stop waiting when the request is released
+            gfal_backend.stage_workers = 2
+            start = time.time()
+            handle = gfal_backend._bringonline_submit(['srm://one/t2k.org/tape/file%d'%(i,) for i in range(5)], 60)
+            time.sleep(0.5)
+            gfal_backend._bringonline_release(handle)
+            assert(time.time() - start < 5)
+            assert(len(handle.errors) == 0)
+            with open(log, 'rt') as f:
+                staged = [call for call in (json.loads(line) for line in f) if call[0] == 'gfal-legacy-bringonline']
+            assert(len(staged) == 2)
+            assert(staged[0][1:3] == ['-t', '10'])
+    assert(results['lfn:/a/file1'] == True)
+    assert(results['lfn:/b/file2'] == True)
+    assert(results['lfn:/c/new'] == True)
+    assert(isinstance(results['lfn:/a/missing'], backends.DoesNotExistException))
+    # One bulk copy per destination directory, renaming copies one by one
+    copies = [call for call in calls if call[0] in ('gfal-copy', 'sources')]
+    assert(len(copies) == 5)
+    assert(copies[0][:7] == ['gfal-copy', '-p', '-T', '1800', '--checksum', 'ADLER32', '--from-file'])
+    assert(copies[0][8:] == ['srm://two/t2k.org/a'])
+    assert(copies[1] == ['sources', 'srm://one/t2k.org/a/file1', 'srm://one/t2k.org/a/missing'])
+    assert(copies[2][8:] == ['srm://two/t2k.org/b'])
+    assert(copies[3] == ['sources', 'srm://one/t2k.org/b/file2'])
+    assert(copies[4][-2:] == ['srm://one/t2k.org/c/old', 'srm://two/t2k.org/c/new'])
+    registered = [call[1:] for call in calls if call[0] == 'gfal-legacy-register']
+    assert(sorted(registered) == [['lfn:/a/file1', 'srm://two/t2k.org/a/file1'],
+        ['lfn:/b/file2', 'srm://two/t2k.org/b/file2'], ['lfn:/c/new', 'srm://two/t2k.org/c/new']])
+
+    if sys.version_info >= (3, 5):
+        print_("Testing AsyncGFALBackend...")
+        import asyncio
+        from t2kdm.asyncgfal import AsyncGFALBackend
+        with temp_dir() as tempdir:
+            with fake_tools(tempdir):
+                async_backend = AsyncGFALBackend()
+        run = FakeRun({
+            'lfn:/a': (0, 'srm://one/a\n\nsrm://two/a\n', ''),
+            'lfn:/b': (2, '', 'gfal-xattr error: 2 (No such file or directory)'),
+            'lfn:/c': (1, '', 'gfal-xattr error: 13 (Permission denied)'),
+            'lfn:/d': (0, 'srm://one/d\n', ''),
+            'lfn:/e': OSError("Too many open files"),
+            })
+        async_backend._run = run
+        async_backend.concurrency = 2
+        # Failed queries are left out
+        lurls = ['lfn:/a', 'lfn:/b', 'lfn:/c', 'lfn:/d']
+        assert(async_backend._replicas_many(lurls) == {'lfn:/a': ['srm://one/a', 'srm://two/a'], 'lfn:/d': ['srm://one/d']})
+        assert(run.peak == 2)
+        run.peak = 0
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(async_backend.gather([async_backend._async_replicas(lurl) for lurl in lurls], limit=1))
+        finally:
+            loop.close()
+        assert(run.peak == 1)
+        assert(results[0] == ['srm://one/a', 'srm://two/a'])
+        assert(type(results[1]) == backends.DoesNotExistException)
+        assert(type(results[2]) == backends.BackendException and "Permission" in results[2].args[0])
+        # Other exceptions are not swallowed
+        try:
+            async_backend._replicas_many(lurls + ['lfn:/e'])
+        except OSError:
+            pass
+        else:
+            raise Exception("OSError was not raised.")
+
+    print_("Testing bulk staging...")
+    tape = storage.SE_by_name[testSEs[2]]
+    tapereps = [tape.get_storage_path('/test/tape%d.txt'%(i,)) for i in range(3)]
+    for i, rep in enumerate(tapereps):
+        fake.files[lurl + '/tape%d.txt'%(i,)] = {'size': 1, 'replicas': [rep]}
+        fake.files[rep] = {'status': 'NEARLINE', 'checksum': '12345678'}
+    backend.poll_interval = 0.01
+    online = []
+    for batch in backend.bringonline_many(tapereps, timeout=10):
+        online.extend(batch)
+    assert(sorted(online) == sorted(tapereps))
+    with temp_dir() as tempdir:
+        for rep in tapereps:
+            fake.files[rep]['status'] = 'NEARLINE'
+        paths = ['/test/tape%d.txt'%(i,) for i in range(3)] + ['/test/abcxyz']
+        results = backend.get_many(paths, tempdir, source=testSEs[2])
+        assert(results['/test/tape1.txt'] == True)
+        assert(os.path.isfile(os.path.join(tempdir, 'tape1.txt')))
+        assert(isinstance(results['/test/abcxyz'], backends.DoesNotExistException))
+    for rep in tapereps:
+        fake.files[rep]['status'] = 'NEARLINE'
+    paths = backend.stage_ahead(['/test/tape%d.txt'%(i,) for i in range(3)], 1, source=testSEs[2])
+    assert(next(paths) == '/test/tape0.txt')
+    # Only the next file is being staged already
+    assert(fake.files[tapereps[1]]['status'] == 'ONLINE_AND_NEARLINE')
+    assert(fake.files[tapereps[2]]['status'] == 'NEARLINE')
+    assert(list(paths) == ['/test/tape1.txt', '/test/tape2.txt'])
+
+    print_("Testing LocalBackend...")
+    with temp_dir() as tempdir:
+        backend = backends.LocalBackend(root=os.path.join(tempdir, 'grid'), nearline_delay=0.2)
+        backend.online_poll_interval = 0.01
+        disk1, disk2, tape = [storage.SE_by_name[SE] for SE in testSEs]
+        localpath = os.path.join(tempdir, 'file.txt')
+        with open(localpath, 'wt') as f:
+            f.write('Hello grid!')
+        lurl = backend.get_lurl('/test/file.txt')
+        rep1 = disk1.get_storage_path('/test/file.txt')
+        rep2 = tape.get_storage_path('/test/file.txt')
+        assert(backend._put(localpath, rep1, lurl) == True)
+        assert(backend._replicas(lurl) == [rep1])
+        entries = backend._ls(backend.get_lurl('/test'))
+        assert([(e.name, e.size) for e in entries] == [('file.txt', 11)])
+        assert(backend._is_dir(backend.get_lurl('/test')) == True)
+        listing = backend.ls('/')
+        assert(isinstance(listing, backends.Listing))
+        assert(listing.is_dir_mask() == [True])
+        assert(listing[0].mode[0] == 'd')
+        listing.extend(entries)
+        assert(listing.size_sum([not d for d in listing.is_dir_mask()]) == 11)
+        assert([(e.name, e.mode, e.size, e.modified) for e in listing[1:]] == [(e.name, e.mode, e.size, e.modified) for e in entries])
+        assert(backend._checksum(rep1) == '17f903dc')
+        assert(backend._replicate(rep1, rep2, lurl) == True)
+        assert(backend._replicas(lurl) == [rep1, rep2])
+        # Tape replicas need to be brought online first
+        assert(backend._state(rep2) == 'NEARLINE')
+        try:
+            backend._get(rep2, localpath)
+        except backends.BackendException:
+            pass
+        else:
+            raise Exception("Reading NEARLINE replica did not raise exception.")
+        assert(backend._bringonline(rep2, timeout=0.01) == False)
+        assert(backend._bringonline(rep2, timeout=10) == True)
+        assert(backend._state(rep2) == 'ONLINE_AND_NEARLINE')
+        assert(backend._get(rep2, os.path.join(tempdir, 'copy.txt')) == True)
+        assert(backend._remove(rep2, lurl) == True)
+        assert(backend._exists(rep2) == False)
+        assert(backend._replicas(lurl) == [rep1])
+        assert(backend._remove(rep1, lurl, last=True) == True)
+        try:
+            backend._replicas(lurl)
+        except backends.DoesNotExistException:
+            pass
+        else:
+            raise Exception("Removed file did not raise DoesNotExistException.")
+        print_("Testing statistics...")
+        backends.statistics.enable()
+        try:
+            assert(backend.put(localpath, '/test/stats.txt', destination=testSEs[0]) == True)
+            backend.checksum(rep1)
+            try:
+                backend.ls('/test/abcxyz')
+            except backends.DoesNotExistException:
+                pass
+            # A streamed listing counts as a single one
+            assert('stats.txt' in [e.name for e in backend.iter_ls('/test')])
+            stats = backend.stats()['operations']
+            assert(stats['put']['bytes'] == 11)
+            assert(stats['put']['SEs'][testSEs[0]]['count'] == 1)
+            assert(stats['checksum']['SEs'][testSEs[0]]['count'] == 1)
+            assert(stats['ls']['errors'] == 1)
+            assert(sum(stats['ls']['histogram'].values()) == 2)
+            # Bulk copies count the bytes of files of known size without asking for them
+            backend._file_size = None
+            try:
+                assert(backend.replicate_many(['/test/stats.txt'], testSEs[1], sizes={'/test/stats.txt': 11}) == {'/test/stats.txt': True})
+            finally:
+                del backend._file_size
+            assert(backend.stats()['operations']['replicate_many']['bytes'] == 11)
+        finally:
+            backends.statistics.disable()
+            backends.statistics.reset()
+        backend.checksum(rep1)
+        assert(backend.stats()['operations'] == {})
+
+        print_("Testing checksums...")
+        assert(checksums.adler32(localpath) == '17f903dc')
+        emptypath = os.path.join(tempdir, 'empty.txt')
+        open(emptypath, 'wt').close()
+        assert(checksums.adler32(emptypath) == '00000001')
+        assert(checksums.equal('017f903dc', '17F903DC') == True)
+        assert(checksums.equal('?', '?') == False)
+        # Verify local copies against the catalogue
+        assert(backend.put(localpath, '/test/verify.txt', destination=testSEs[0]) == True)
+        default_backend = t2kdm.backend
+        t2kdm.backend = backend
+        try:
+            assert(t2kdm.interactive.verify('/test/verify.txt', localpath) == 0)
+            assert(t2kdm.interactive.verify('/test/verify.txt', emptypath, quiet=True) == 1)
+        finally:
+            t2kdm.backend = default_backend
+
+        print_("Testing checksum store...")
+        store = checksums.ChecksumStore(os.path.join(tempdir, 'store', 'checksums.sqlite'), max_age=60)
+        store.set('srm://a', '12345678')
+        store.set('srm://b', '?')
+        assert(store.get('srm://a') == '12345678')
+        assert(store.get('srm://b') is None)
+        # Checksums without catalogue information adopt it
+        store.validate('srm://a', 11, 0.)
+        assert(store.get('srm://a') == '12345678')
+        store.validate('srm://a', 11, 0.)
+        assert(store.get('srm://a') == '12345678')
+        # Changed files need new checksums
+        store.validate('srm://a', 12, 0.)
+        assert(store.get('srm://a') is None)
+        # Old checksums are not used
+        store.set('srm://a', '12345678')
+        time.sleep(0.01)
+        assert(checksums.ChecksumStore(store.filename, max_age=0.001).get('srm://a') is None)
+        assert(checksums.ChecksumStore(store.filename, max_age=60).get('srm://a') == '12345678')
+        # The backends remember checksums
+        rep = disk1.get_storage_path('/test/stats.txt')
+        stored = backends.LocalBackend(root=os.path.join(tempdir, 'grid'))
+        stored.checksum_store = store
+        assert(stored.checksum(rep) == '17f903dc')
+        broken = backends.LocalBackend(root=os.path.join(tempdir, 'grid'), failure_rate={'checksum': 1})
+        broken.checksum_store = store
+        assert(broken.checksum(rep) == '17f903dc')
+        assert(broken.checksum_many([rep]) == {rep: '17f903dc'})
+        broken._forget('/test/stats.txt', rep)
+        assert(broken.checksum(rep) == '?')
+
+        print_("Testing sync mode of get...")
+        rep = disk1.get_storage_path('/test/stats.txt')
+        copypath = os.path.join(tempdir, 'sync.txt')
+        with open(copypath, 'wt') as f:
+            f.write('Hello')
+        assert(backend._is_identical(rep, copypath, 11) == False)
+        # Partial files are completed
+        assert(backend._resume(rep, disk1, copypath, 11) == True)
+        with open(copypath, 'rt') as f:
+            assert(f.read() == 'Hello grid!')
+        assert(backend._is_identical(rep, copypath, 11) == True)
+        with open(copypath, 'wt') as f:
+            f.write('Hello you!!')
+        assert(backend._is_identical(rep, copypath, 11) == False)
+        assert(backend._resume(rep, disk1, copypath, 11) == False)
+
+        print_("Testing transfers of files of known size...")
+        sized = backends.LocalBackend(root=os.path.join(tempdir, 'grid'))
+        sized._file_size = lambda remotepath: calls.append(remotepath) or 11
+        calls = []
+        # The storage elements look up the replicas with the default backend
+        default_backend, default_replicas = t2kdm.backend, t2kdm.replicas
+        t2kdm.backend, t2kdm.replicas = sized, sized.replicas
+        try:
+            assert(sized.replicate('/test/stats.txt', testSEs[1], size=11) == True)
+            assert(sized.get('/test/stats.txt', os.path.join(tempdir, 'sized.txt')) == True)
+            assert(sized.get('/test/stats.txt', os.path.join(tempdir, 'sized.txt'), force=True, size=11) == True)
+            assert(sized.get_many(['/test/stats.txt'], tempdir, force=True) == {'/test/stats.txt': True})
+            assert(calls == [])
+            # Unless it is needed
+            assert(sized.get('/test/stats.txt', os.path.join(tempdir, 'sized.txt'), sync=True) == True)
+            assert(calls == ['/test/stats.txt'])
+        finally:
+            t2kdm.backend, t2kdm.replicas = default_backend, default_replicas
+
+        print_("Testing cached console commands...")
+        # Entries that only exist in the cache, e.g. from `t2kdm-cache warm`
+        sized.ls.add_entry(backends.Listing([backends.DirEntry('cached.txt')]), sized, '/test/cached')
+        sized.replicas.add_entry(['srm://cached/test/cached.txt'], sized, '/test/cached.txt')
+        default = (t2kdm.backend, t2kdm.replicas, t2kdm.iter_ls)
+        t2kdm.backend, t2kdm.replicas, t2kdm.iter_ls = sized, sized.replicas, sized.iter_ls
+        try:
+            assert(t2kdm.interactive.ls('/test/cached', long=True) == 0)
+            assert(t2kdm.interactive.replicas('/test/cached.txt') == 0)
+            # Complete listings are remembered, e.g. by the daemon
+            assert(sized.ls.get_entry(sized, '/test') is None)
+            assert(t2kdm.interactive.ls('/test') == 0)
+            assert(len(sized.ls.get_entry(sized, '/test').value) == len(sized.ls('/test')))
+        finally:
+            t2kdm.backend, t2kdm.replicas, t2kdm.iter_ls = default
+
+        print_("Testing transfers with known replicas...")
+        planned = backends.LocalBackend(root=os.path.join(tempdir, 'grid'))
+        assert(planned.put(localpath, '/test/planned.txt', destination=disk1.name) == True)
+        known = [disk1.get_storage_path('/test/planned.txt'), disk2.get_storage_path('/test/planned.txt')]
+        sources = list(planned.iter_file_sources('/test/planned.txt', replicas=known, preferred=disk2.name))
+        assert([src for replica, src in sources] == [disk2, disk1])
+        sources = list(planned.iter_file_sources('/test/planned.txt', replicas=known, preferred=disk1.name))
+        assert([src for replica, src in sources] == [disk1])
+        # The catalogue is not asked whether the replica is present already,
+        # the default backend would fail to do so
+        assert(planned.replicate('/test/planned.txt', disk1.name, replicas=known) == True)
+        # The replica at the preferred SE is actually missing, so the next one is used
+        attempts = []
+        planned._get_from = lambda replica, src, *args, **kwargs: attempts.append(src) or backends.LocalBackend._get_from(planned, replica, src, *args, **kwargs)
+        assert(planned.get('/test/planned.txt', os.path.join(tempdir, 'planned.txt'), replicas=known, preferred=disk2.name) == True)
+        assert(attempts == [disk2, disk1])
+        disk2.circuit = storage.CircuitBreaker()
+
+        print_("Testing scheduled recursive transfers...")
+        pulled = []
+        finished = []
+        def lookahead(remotepaths, ahead, *args, **kwargs):
+            for path in remotepaths:
+                pulled.append(path)
+                yield path
+        def transfer(remotepath, *args, **kwargs):
+            # The workers never get further ahead than requested
+            assert(len(pulled) - len(finished) <= 2 + 1)
+            if remotepath == paths[0]:
+                time.sleep(0.5)
+            finished.append(remotepath)
+            return 0
+        for i in range(4):
+            assert(sized.put(localpath, '/test/scheduled/%d.txt'%(i,), destination=testSEs[1]) == True)
+        # The listing is done with the default backend
+        default = (t2kdm.backend, t2kdm.is_dir, t2kdm.iter_ls)
+        t2kdm.backend, t2kdm.is_dir, t2kdm.iter_ls = sized, sized.is_dir, sized.iter_ls
+        try:
+            paths = list(utils.remote_iter_recursively('/test/scheduled'))
+            assert(len(paths) == 4)
+            scheduled = t2kdm.interactive._recursive(lookahead=lookahead)(transfer)
+            assert(scheduled('/test/scheduled', recursive=True, jobs=2, ahead=1, schedule='listing') == 0)
+        finally:
+            t2kdm.backend, t2kdm.is_dir, t2kdm.iter_ls = default
+        # The free worker does not wait for the slow first file
+        assert(finished[-1] == paths[0])
+
+        print_("Testing circuit breaker...")
+        assert(backend.put(localpath, '/test/circuit.txt', destination=testSEs[1]) == True)
+        rep = disk2.get_storage_path('/test/circuit.txt')
+        attempts = []
+        class FailingBackend(backends.LocalBackend):
+            message = None
+            def _get(self, surl, localpath, **kwargs):
+                attempts.append(surl)
+                if self.message is not None:
+                    raise backends.BackendException(self.message)
+                return backends.LocalBackend._get(self, surl, localpath, **kwargs)
+        broken = FailingBackend(root=os.path.join(tempdir, 'grid'), failure_rate={'get': 1})
+        broken.retry_delay = 0
+        try:
+            for i in range(disk2.circuit.threshold):
+                assert(not disk2.circuit.is_open())
+                try:
+                    broken._get_from(rep, disk2, os.path.join(tempdir, 'circuit.txt'))
+                except backends.BackendException as e:
+                    assert("Simulated" in e.args[0])
+                else:
+                    raise Exception("Simulated failure did not raise exception.")
+            # Transient failures are retried, but every file counts only once
+            assert(len(attempts) == disk2.circuit.threshold * (broken.retries + 1))
+            # All files failed, so the SE is skipped
+            assert(disk2.circuit.is_open())
+            try:
+                broken._get_from(rep, disk2, os.path.join(tempdir, 'circuit.txt'))
+            except backends.BackendException as e:
+                assert("Skipping" in e.args[0])
+            else:
+                raise Exception("Open circuit did not raise exception.")
+            assert(storage.get_closest_SE(replicas=[rep, rep1], location=disk2.location) == disk1)
+            # The failures are remembered by the transfer model as well
+            assert(storage.transfer_model.penalties([disk2.name], 'local')[disk2.name] > 1.)
+        finally:
+            disk2.circuit.reset()
+            storage.transfer_model = performance.TransferModel()
+        assert(storage.get_closest_SE(replicas=[rep, rep1], location=disk2.location) == disk2)
+        # Lasting errors are not retried and errors of the destination are not blamed on the source
+        failing = FailingBackend(root=os.path.join(tempdir, 'grid'))
+        failing.retry_delay = 0
+        for message, tries in [("File exists", 1), ("DESTINATION OVERWRITE: Connection timed out", failing.retries + 1)]:
+            failing.message = message
+            del attempts[:]
+            for i in range(disk2.circuit.threshold):
+                try:
+                    failing._get_from(rep, disk2, os.path.join(tempdir, 'circuit.txt'))
+                except backends.BackendException as e:
+                    assert(e.args[0] == message)
+                else:
+                    raise Exception("Failure did not raise exception.")
+            assert(len(attempts) == disk2.circuit.threshold * tries)
+            assert(not disk2.circuit.is_open())
+        assert(backend._get_from(rep, disk2, os.path.join(tempdir, 'circuit.txt')) == True)
+
+        print_("Testing hedged downloads...")
+        slow_rep = disk1.get_storage_path('/test/circuit.txt')
+        assert(backend._replicate(rep, slow_rep, backend.get_lurl('/test/circuit.txt')) == True)
+        cancelled = []
+        class SlowBackend(backends.LocalBackend):
+            def _get(self, surl, localpath, verbose=False, streams=1, cancel=None, **kwargs):
+                if surl == slow_rep:
+                    # Stalled transfer that only ends when cancelled
+                    with open(localpath, 'wt') as f:
+                        f.write('He')
+                    cancel.wait(10)
+                    cancelled.append(cancel.is_set())
+                    raise backends.CancelledException("Cancelled.")
+                return backends.LocalBackend._get(self, surl, localpath, verbose=verbose, streams=streams, cancel=cancel, **kwargs)
+        slow = SlowBackend(root=os.path.join(tempdir, 'grid'))
+        hedgepath = os.path.join(tempdir, 'hedge.txt')
+        assert(slow._get_hedged([(slow_rep, disk1), (rep, disk2)], hedgepath, 0.1, 11) == True)
+        assert(cancelled == [True])
+        with open(hedgepath, 'rt') as f:
+            assert(f.read() == 'Hello grid!')
+        assert(not os.path.exists(hedgepath + '.part0'))
+        assert(not os.path.exists(hedgepath + '.part1'))
+        cancel = threading.Event()
+        cancel.set()
+        try:
+            backend._get(rep, os.path.join(tempdir, 'cancelled.txt'), cancel=cancel)
+        except backends.CancelledException:
+            pass
+        else:
+            raise Exception("Cancelled download did not raise exception.")
+
+        print_("Testing StreamController...")
+        controller = performance.StreamController(os.path.join(tempdir, 'streams.json'))
+        big = controller.min_size * 10
+        assert(controller.streams('SE', 1000) == 1)
+        assert(controller.streams('SE', big) == 1)
+        controller.record('SE', 1, big, 10.)
+        assert(controller.streams('SE', big) == 2)
+        controller.record('SE', 2, big, 6.)
+        assert(controller.streams('SE', big) == 4)
+        controller.record('SE', 4, big, 8.)
+        # More streams were slower
+        assert(controller.streams('SE', big) == 2)
+        # Remembered across instances
+        controller.save()
+        controller = performance.StreamController(os.path.join(tempdir, 'streams.json'))
+        assert(controller.streams('SE', big) == 2)
+        assert(controller.streams('other SE', big) == 1)
+
+        print_("Testing TransferModel...")
+        model = performance.TransferModel(os.path.join(tempdir, 'model.json'))
+        assert(model.penalties(['A', 'B'], 'local') == {'A': 0., 'B': 0.})
+        for i in range(5):
+            model.record('A', 'local', big, 1.)
+            model.record('B', 'local', big, 4.)
+        penalties = model.penalties(['A', 'B', 'C'], 'local')
+        assert(penalties['A'] == 0. and penalties['C'] == 0.)
+        assert(1. < penalties['B'] <= model.max_throughput_penalty)
+        assert(model.penalties(['A', 'B'], 'SE') == {'A': 0., 'B': 0.})
+        model.record('A', 'local', error=True)
+        assert(model.penalties(['A'], 'local')['A'] > 0.)
+        # Remembered across instances, but forgotten over time
+        model.save()
+        model = performance.TransferModel(os.path.join(tempdir, 'model.json'))
+        assert(model.penalties(['A', 'B'], 'local')['B'] > 1.)
+        model.half_life = 1e-3
+        time.sleep(0.01)
+        assert(model.penalties(['A', 'B'], 'local')['B'] < 0.01)
+        # Concurrent instances add to each other's observations, and save only now and then
+        models = [performance.TransferModel(os.path.join(tempdir, 'merged.json')) for i in range(2)]
+        models[0].record('A', 'local', big, 1.)
+        models[1].record('B', 'local', big, 1.)
+        models[0].record('A', 'local', big, 1.)
+        assert(len(models[0].pending) == 1)
+        for m in models:
+            m.save()
+        merged = performance.TransferModel(os.path.join(tempdir, 'merged.json'))
+        assert(merged.throughput('A', 'local') is not None and merged.throughput('B', 'local') is not None)
+        assert(abs(merged.state['A>local']['transfers'] - 2.) < 1e-3)
+        # Slow SEs lose against ones that are a bit further away
+        storage.transfer_model = performance.TransferModel()
+        for i in range(5):
+            storage.transfer_model.record(disk1.name, 'local', big, 10.)
+            storage.transfer_model.record(disk2.name, 'local', big, 1.)
+        assert(storage.get_closest_SE(replicas=[rep, rep1], location=disk1.location) == disk2)
+
+        print_("Testing scheduling...")
+        model = performance.TransferModel()
+        sizes = {'a': 1e8, 'b': 5e8, 'c': 1e7, 'd': 1e9}
+        paths, duration = scheduling.schedule(sorted(sizes), sizes, workers=2, model=model)
+        assert(paths == ['d', 'b', 'a', 'c'])
+        # Largest first balances the workers
+        predicted = lambda size: scheduling.overhead + size / scheduling.default_throughput
+        assert(abs(duration - predicted(1e9)) < 1e-6)
+        paths, duration = scheduling.schedule(sorted(sizes), sizes, workers=2, model=model, policy='listing')
+        assert(paths == ['a', 'b', 'c', 'd'])
+        assert(duration > predicted(1e9))
+        # Busy sources are deferred
+        sources = {'a': 'Y', 'b': 'X', 'c': 'Y', 'd': 'X'}
+        paths, duration = scheduling.schedule(sorted(sizes), sizes, sources, workers=2, per_source=1, model=model)
+        assert(paths == ['d', 'a', 'c', 'b'])
+        model.record('X', 'local', 1e9, 1.)
+        paths, duration = scheduling.schedule(sorted(sizes), sizes, sources, workers=1, per_source=1, model=model, policy='smallest')
+        assert(paths == ['c', 'a', 'b', 'd'])
+        # Unknown sources are assumed to be as fast as the known ones
+        assert(abs(duration - (4*scheduling.overhead + sum(sizes.values()) / 1e9)) < 1e-6)
+
+        print_("Testing plans...")
+        plan = {'version': planning.version, 'operation': 'replicate', 'args': [testSEs[1]], 'kwargs': {},
+            'destination': testSEs[1], 'files': [
+                {'path': '/a', 'size': 1000, 'action': 'transfer', 'source': testSEs[0], 'tape': False},
+                {'path': '/b', 'size': 3000, 'action': 'transfer', 'source': testSEs[2], 'tape': True},
+                {'path': '/c', 'size': 2000, 'action': 'skip', 'reason': "Replica already present at destination."},
+                {'path': '/d', 'size': 0, 'action': 'fail', 'reason': "Could not get replicas of /d."},
+            ]}
+        plan['summary'] = planning.summarise(plan, workers=2)
+        summary = plan['summary']
+        assert(summary['active_files'] == 2 and summary['active_bytes'] == 4000)
+        assert(summary['skipped_files'] == 1 and summary['failing_files'] == 1)
+        assert(summary['tape_fraction'] == 0.75)
+        assert(summary['sources'][testSEs[2]] == {'files': 1, 'bytes': 3000})
+        assert(summary['duration'] > scheduling.overhead)
+        planfile = os.path.join(tempdir, 'plan.json')
+        planning.save(plan, planfile)
+        assert(planning.load(planfile) == plan)
+        out = StringIO()
+        planning.print_summary(plan, output=out)
+        assert("from %s: 1 files"%(testSEs[2],) in out.getvalue())
+        assert("75.0%" in out.getvalue())
+        with open(planfile, 'wt') as f:
+            f.write('{"version": 0}')
+        try:
+            planning.load(planfile)
+        except ValueError:
+            pass
+        else:
+            raise Exception("Invalid plan did not raise exception.")
+
+        print_("Testing Progress...")
+        recorded = Stats()
+        filename = os.path.join(tempdir, 'progress.json')
+        with open(os.devnull, 'wt') as null:
+            prog = progress.Progress(4, 4000, interval=0, filename=filename, stats=recorded, output=null)
+            prog.start()
+            assert(prog.state()['eta'] is None)
+            recorded.record('get', 1., SEs=[testSEs[0]], nbytes=1000)
+            prog.done(1000)
+            prog.done(-1, failed=True)
+            state = prog.state()
+            assert(state['files'] == 2 and state['failed'] == 1 and state['bytes'] == 1000)
+            assert(state['eta'] > 0)
+            # Failed files count towards the ETA, but not the throughput
+            prog.done(1000, failed=True)
+            state = prog.state()
+            assert(state['bytes'] == 1000 and state['failed_bytes'] == 1000)
+            assert(state['throughput'] == 0)
+            assert(abs(state['average_throughput'] * state['elapsed'] - 1000) < 1e-6)
+            assert(abs(state['eta'] - state['elapsed']) < 1e-6)
+            assert(state['SEs'][testSEs[0]]['bytes'] == 1000)
+            # Nothing happened in this interval
+            assert(prog.state()['SEs'][testSEs[0]]['throughput'] == 0)
+            prog.done(2000)
+            prog.stop()
+        with open(filename, 'rt') as f:
+            state = json.loads(f.read())
+        assert(state['files'] == 4 and state['bytes'] == 3000 and state['eta'] == 0)
+        assert(progress.format_bytes(1234567) == '1.2 MB')
+        assert(progress.format_duration(24*60*60 + 62) == '1d 00:01:02')
+
+        print_("Testing daemon...")
+        socket_path = os.path.join(tempdir, 'daemon.sock')
+        assert(daemon.forward('SEs', [], path=socket_path) is None)
+        server = daemon.Daemon(socket_path)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            assert(daemon.is_running(socket_path))
+            out = StringIO()
+            err = StringIO()
+            assert(daemon.forward('SEs', [], path=socket_path, stdout=out, stderr=err) == 0)
+            assert(testSEs[0] in out.getvalue())
+            assert(daemon.forward('SEs', ['--abcxyz'], path=socket_path, stdout=out, stderr=err) == 2)
+            assert('usage' in err.getvalue())
+            assert(daemon.forward('abcxyz', [], path=socket_path) is None)
+            # Long running commands are not forwarded
+            assert(daemon.forward('get', ['/test/file.txt'], path=socket_path) is None)
+            assert(daemon._request(socket_path, {'command': 'get', 'args': [], 'cwd': tempdir,
+                'config': server.config_file}) is None)
+            # A busy daemon lets the caller run the command
+            with server.lock:
+                assert(daemon.forward('SEs', [], path=socket_path) is None)
+            # Commands stop when the client is gone
+            import socket
+            sender, receiver = socket.socketpair()
+            receiver.close()
+            output = daemon._SocketOutput(sender.makefile('wb'), 'out')
+            try:
+                output.write("Hello")
+                output.write("Hello")
+            except IOError as e:
+                assert(e.errno == errno.EPIPE)
+            else:
+                raise Exception("Writing to a closed connection did not raise exception.")
+            finally:
+                sender.close()
+            # Statistics must be recorded locally
+            assert(daemon.forward('SEs', ['--stats', 'stats.json'], path=socket_path) is None)
+            try:
+                daemon.Daemon(socket_path)
+            except RuntimeError:
+                pass
+            else:
+                raise Exception("Second daemon did not raise exception.")
+        finally:
+            assert(daemon.stop(socket_path) == True)
+            thread.join()
+            server.server_close()
+        assert(not os.path.exists(socket_path))
+        # The console commands are forwarded without loading t2kdm
+        client = sh.Command(sys.executable)('-c', "import sys; import t2kdm_client; "
+            "sys.stdout.write(str(t2kdm_client.forward('SEs', [], path=%r)) + ' ' + str('t2kdm' in sys.modules))"%(socket_path,),
+            _env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(t2kdm.__file__)))))
+        assert(str(client) == 'None False')
+
+        # Failures are reproducible
+        backend = backends.LocalBackend(root=os.path.join(tempdir, 'grid'), failure_rate={'ls': 0.5}, seed=1)
+        failures = []
+        for i in range(20):
+            try:
+                backend._ls(backend.get_lurl('/test'))
+            except backends.BackendException:
+                failures.append(i)
+        assert(0 < len(failures) < 20)
+        backend.random.seed(1)
+        for i in range(20):
+            try:
+                backend._ls(backend.get_lurl('/test'))
+            except backends.BackendException:
+                assert(i in failures)
+            else:
+                assert(i not in failures)
+    storage.transfer_model = transfer_model
+
 def run_read_only_tests():
     print_("Testing ls...")
 
@@ -109,6 +1172,13 @@ def run_read_only_tests():
         assert(t2kdm.interactive.get(testdir, tempdir, recursive=True) == 0)
         assert(os.path.isfile(filename))
 
+        # Test verify
+        with open(filename, 'at') as f:
+            f.write('corrupted')
+        with no_output(True):
+            assert(t2kdm.interactive.verify(path, tempdir) != 0)
+            assert(t2kdm.interactive.verify(path, os.path.join(tempdir, 'abcxyz.txt')) != 0)
+
     print_("Testing check...")
     with temp_dir() as tempdir:
         filename = os.path.join(tempdir, 'faulty.txt')
@@ -154,6 +1224,17 @@ def run_read_only_tests():
         assert(cli.completedefault('"us', 'lls "us', 0, 0) == [])
 
 def run_read_write_tests():
+    print_("Testing replicate plans...")
+    with temp_dir() as tempdir:
+        planfile = os.path.join(tempdir, 'plan.json')
+        with no_output():
+            assert(t2kdm.interactive.replicate(testdir, testSEs[1], recursive=r'^test[1]\.t.t$', plan=planfile) == 0)
+        plan = planning.load(planfile)
+        assert([e['path'] for e in plan['files']] == [posixpath.join(testdir, testfiles[0])])
+        with no_output():
+            assert(t2kdm.interactive.execute(planfile) == 0)
+        assert(storage.SE_by_name[testSEs[1]].has_replica(posixpath.join(testdir, testfiles[0])))
+
     print_("Testing replicate...")
     with no_output():
         assert(t2kdm.interactive.replicate(testdir, testSEs[1], recursive=r'^test[1]\.t.t$', verbose=True) == 0)
@@ -209,6 +1290,42 @@ def run_read_write_tests():
     else:
         raise Exception("This should have raised a DoesNotExistException at some point.")
 
+def run_benchmarks(number=100000, output=None):
+    """Print the time per cache lookup, compared to a plain dictionary lookup.
+
+    Returns a dictionary of the times in seconds.
+    """
+    if output is None:
+        output = sys.stdout
+    print_("Benchmarking cache lookups...", file=output)
+    backend = t2kdm.backend
+    path = '/nd280/file.txt'
+    cache = Cache(60)
+    @cache.cached
+    def ls(self, remotepath, **kwargs):
+        return backends.Listing([backends.DirEntry(posixpath.basename(remotepath))])
+    ls(backend, path, directory=True, cached=True)
+    dictionary = {(backend, path, True): ls(backend, path, directory=True)}
+    kwargs = {'directory': True}
+    key = cache.key(ls, backend, path, directory=True)
+
+    def pickled_key():
+        # How the keys used to be made
+        return hash(dumps(('ls', (backend, path), kwargs), 2))
+
+    timers = [
+        ('dict', "dictionary lookup with a tuple key", lambda: dictionary[(backend, path, True)]),
+        ('key', "making a key", lambda: cache.key(ls, backend, path, directory=True)),
+        ('pickled_key', "making a key by pickling the arguments", pickled_key),
+        ('segment', "lookup in the cache segment", lambda: ls.segment.get(key)),
+        ('hit', "cached function call", lambda: ls(backend, path, directory=True, cached=True)),
+    ]
+    times = {}
+    for name, description, timer in timers:
+        times[name] = min(timeit.repeat(timer, number=number, repeat=3)) / number
+        print_("{description:<40} {time:8.3f} us".format(description=description, time=times[name]*1e6), file=output)
+    return times
+
 def run_tests():
     """Test the functions of the t2kdm."""
 
@@ -217,12 +1334,25 @@ def run_tests():
         help="do write tests. Default: read only")
     parser.add_argument('-b', '--backend', default=None,
         help="specify which backend to use")
+    parser.add_argument('-o', '--offline', action='store_true',
+        help="only do tests that do not need a grid connection")
+    parser.add_argument('-m', '--benchmark', action='store_true',
+        help="measure the cost of cache lookups instead of testing")
 
     args = parser.parse_args()
     if args.backend is not None:
         t2kdm.config.backend = args.backend
         t2kdm.backend = backends.get_backend(t2kdm.config)
 
+    if args.benchmark:
+        run_benchmarks()
+        return
+
+    run_offline_tests()
+    if args.offline:
+        print_("All done.")
+        return
+
     run_read_only_tests()
     if args.write:
         run_read_write_tests()
@@ -6,32 +6,89 @@ from six import print_
 import sys, sh
 from contextlib import contextmanager
 import re
+import itertools
 import t2kdm
 from t2kdm import backends
 from t2kdm import storage
 
-def remote_iter_recursively(remotepath, regex=None):
+def remote_iter_recursively(remotepath, regex=None, entries=False):
     """Iter over remote paths recursively.
 
     If `regex` is given, only consider files/folders that match the reular expression.
+    If `entries` is `True`, iterate over `(path, DirEntry)` tuples instead,
+    e.g. to get the sizes of the files.
     """
 
     if isinstance(regex, str):
         regex = re.compile(regex)
 
     if t2kdm.is_dir(remotepath):
-        for entry in t2kdm.ls(remotepath):
-            if regex is None or regex.search(entry.name):
-                new_path = posixpath.join(remotepath, entry.name)
-                for path in remote_iter_recursively(new_path, regex):
-                    yield path
+        for path, entry in _remote_iter_directory(remotepath, regex):
+            if entries:
+                yield path, entry
+            else:
+                yield path
     else:
-        yield remotepath
+        if entries:
+            yield remotepath, t2kdm.ls(remotepath, directory=True, cached=True)[0]
+        else:
+            yield remotepath
+
+def _remote_iter_directory(remotepath, regex):
+    """Iter over the paths and entries of a remote directory recursively."""
+
+    for entry in t2kdm.iter_ls(remotepath):
+        if regex is None or regex.search(entry.name):
+            new_path = posixpath.join(remotepath, entry.name)
+            # The long listing already tells us whether the entry is a directory
+            if entry.mode[0] == 'd':
+                for ret in _remote_iter_directory(new_path, regex):
+                    yield ret
+            else:
+                # Remember that, so later `is_dir` and `ls` calls with `cached=True` need not ask again.
+                # Only in memory, as writing every file to the shared cache would slow down the walk.
+                t2kdm.backend.is_dir.add_memory_entry(False, t2kdm.backend, new_path)
+                t2kdm.backend.ls.add_memory_entry(backends.Listing([entry]), t2kdm.backend, new_path, directory=True)
+                yield new_path, entry
+
+def iter_chunks(iterable, size):
+    """Iterate over lists of `size` consecutive elements of `iterable`.
+
+    The last list can be shorter.
+    """
+
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+def validate_stored_checksums(remotepath, replicas, cached=False):
+    """Forget the stored checksums of the replicas if the file has changed in the catalogue since.
+
+    See `checksums.ChecksumStore.validate`.
+    """
+
+    store = t2kdm.backend.checksum_store
+    if not store.enabled:
+        return
+    try:
+        listing = t2kdm.ls(remotepath, directory=True, cached=cached)
+    except backends.BackendException:
+        return
+    for rep in replicas:
+        store.validate(rep, listing.sizes[0], listing.mtimes[0])
 
 def check_checksums(remotepath, cached=False):
-    """Check if the checksums of all replicas are identical."""
+    """Check if the checksums of all replicas are identical.
+
+    Checksums that are remembered in the checksum store are only used
+    if the file has not changed in the catalogue since.
+    """
 
     replicas = t2kdm.replicas(remotepath, cached=cached)
+    validate_stored_checksums(remotepath, replicas, cached=cached)
     checksum = t2kdm.checksum(replicas[0], cached=cached)
 
     if '?' in checksum:
@@ -74,7 +131,7 @@ def fix_known_bad_SEs(remotepath, verbose=False):
 
     success = True
 
-    replicas = t2kdm.replicas(remotepath)
+    replicas = t2kdm.replicas(remotepath, cached=True)
     for replica in replicas:
         se = storage.get_SE(replica)
         if se is None:
@@ -100,7 +157,7 @@ def fix_missing_files(remotepath, verbose=False):
 
     success = True
 
-    replicas = t2kdm.replicas(remotepath)
+    replicas = t2kdm.replicas(remotepath, cached=True)
     existing = []
     for rep in replicas:
         se = storage.get_SE(rep)
@@ -112,7 +169,7 @@ def fix_missing_files(remotepath, verbose=False):
             success = False
         else:
             try:
-                exists = t2kdm.exists(rep)
+                exists = t2kdm.exists(rep, cached=True)
             except backends.BackendException:
                 if verbose:
                     print_("WARNING: Could not check whether replica exists: "+rep)
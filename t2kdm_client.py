@@ -0,0 +1,138 @@
+"""Client of the `t2kdm-daemon`.
+
+The console commands in `forwarded_commands` start here. They
+are forwarded to the daemon if it is running, and only loaded from
+`t2kdm.commands` if it does not run them. This module must not import
+`t2kdm`, as that already loads the configuration and backend, which is
+what the daemon is there to avoid.
+"""
+
+import os, sys
+import socket
+import json
+from six import print_, PY2
+from appdirs import AppDirs
+
+app_dirs = AppDirs('t2kdm', 't2k.org')
+
+default_socket = os.path.join(app_dirs.user_cache_dir, 'daemon.sock')
+
+# Commands that are run by the daemon.
+# Long transfers would block it for everyone else, so they are always run locally.
+forwarded_commands = ['ls', 'replicas', 'SEs']
+
+def find_config_file():
+    """Return the path of the standard configuration file, or `None` if there is none."""
+
+    # Try different paths to find the configuration file
+    for testpath in [
+            os.path.join(os.getcwd(), '.t2kdm.conf'), # 1. ./.t2kdm.conf
+            os.path.join(app_dirs.user_config_dir, 't2kdm.conf'), # 2. user_config_dir, on linux: ~/.config/t2kdm/t2kdm.conf
+            os.path.join(app_dirs.site_config_dir, 't2kdm.conf'), # 2. site_config_dir, on linux: /etc/t2kdm/t2kdm.conf
+            ]:
+        if os.path.isfile(testpath):
+            return testpath
+    return None
+
+def _text(data):
+    if isinstance(data, bytes):
+        return data.decode('utf-8', 'replace')
+    return data
+
+def _connect(path):
+    """Return a socket connected to the daemon, or `None` if it is not running."""
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+def is_running(path=default_socket):
+    """Is a daemon listening on the socket?"""
+    sock = _connect(path)
+    if sock is None:
+        return False
+    sock.close()
+    return True
+
+def _request(path, request, stdout=None, stderr=None):
+    """Send a request to the daemon and print the output.
+
+    Returns the exit code, or `None` if the request was not served.
+    """
+    sock = _connect(path)
+    if sock is None:
+        return None
+    if stdout is None:
+        stdout = sys.stdout
+    if stderr is None:
+        stderr = sys.stderr
+    try:
+        f = sock.makefile('rwb')
+        f.write((json.dumps(request) + '\n').encode('utf-8'))
+        f.flush()
+        for line in f:
+            message = json.loads(_text(line))
+            for key, output in [('out', stdout), ('err', stderr)]:
+                if key in message:
+                    data = message[key]
+                    if PY2:
+                        data = data.encode('utf-8')
+                    output.write(data)
+                    output.flush()
+            if 'exit' in message:
+                return message['exit']
+            if 'refused' in message:
+                return None
+    finally:
+        sock.close()
+    print_("Lost connection to the t2kdm-daemon.", file=stderr)
+    return 1
+
+def forward(command, args, path=default_socket, stdout=None, stderr=None):
+    """Let the daemon run the command with the given command line arguments.
+
+    Returns the exit code, or `None` if the command was not run by the daemon,
+    e.g. because it is not running or busy.
+    """
+    if command not in forwarded_commands:
+        return None
+    if any(arg.startswith('--stats') for arg in args):
+        # The statistics must be recorded by this process
+        return None
+    request = {
+        'command': command,
+        'args': list(args),
+        'cwd': os.getcwd(),
+        'config': find_config_file(),
+        'prog': os.path.basename(sys.argv[0]),
+    }
+    return _request(path, request, stdout=stdout, stderr=stderr)
+
+def stop(path=default_socket):
+    """Stop a running daemon.
+
+    Returns `True` if there was a daemon to stop.
+    """
+    return _request(path, {'stop': True}) is not None
+
+def _console_command(name):
+    """Return the console entry point of a forwarded command."""
+
+    def run_from_console():
+        ret = forward(name, sys.argv[1:])
+        if ret is not None:
+            return ret
+        # Not served by the daemon, so run it as usual
+        import t2kdm.commands
+        return getattr(t2kdm.commands, name).run_from_console()
+
+    return run_from_console
+
+ls = _console_command('ls')
+replicas = _console_command('replicas')
+SEs = _console_command('SEs')